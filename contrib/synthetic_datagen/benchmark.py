@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+
+import synthetic_datagen
+from llm_load_test import synthetic
+
+logger = logging.getLogger("synthetic-datagen-benchmark")
+logging.basicConfig(level=logging.INFO)
+
+
+def timed(label: str, count: Optional[int], func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    rate = f"{count / elapsed:14,.0f} samples/s" if count else ""
+    print(f"{label:<40} {elapsed:8.3f} s {rate}")
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Measure synthetic dataset generation throughput",
+        formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=80)
+    )
+    parser.add_argument(
+        "-m", "--model",
+        help="HuggingFace model name or path to model",
+        required=True,
+    )
+    parser.add_argument(
+        "-c", "--samples",
+        metavar="COUNT",
+        type=int,
+        default=100000,
+        help="number of samples to generate",
+    )
+    parser.add_argument(
+        "--input-normal",
+        metavar=("MEAN", "SD"),
+        type=int,
+        nargs=2,
+        default=[4096, 1024],
+        help="normal distribution for input tokens",
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        metavar="COUNT",
+        type=int,
+        nargs="+",
+        default=sorted({1, os.cpu_count() or 1}),
+        help="worker counts to compare",
+    )
+    args = parser.parse_args()
+
+    corpus = synthetic.read_corpus([synthetic_datagen.CORPUS_GLOB])
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # A cold run tokenizes the corpus, a warm run maps the cached offsets
+        synthetic._offsets_cache.clear()
+        timed("corpus offsets (cold cache)", None, synthetic_datagen.cached_offsets, args.model, corpus, cache_dir)
+        synthetic._offsets_cache.clear()
+        timed("corpus offsets (warm cache)", None, synthetic_datagen.cached_offsets, args.model, corpus, cache_dir)
+
+        rand = np.random.default_rng(seed=42)
+        input_dist = timed("normal input lengths", args.samples,
+                           synthetic_datagen.NormalDist, args.samples, rand, *args.input_normal)
+        output_dist = synthetic_datagen.NormalDist(args.samples, rand, 256, 64)
+
+        for workers in args.workers:
+            with open(os.devnull, "w") as f:
+                timed(f"generate dataset ({workers} workers)", args.samples,
+                      synthetic_datagen.generate_dataset, f, args.model, args.samples, input_dist, output_dist,
+                      corpus, generator=np.random.default_rng(seed=42), cache_dir=cache_dir, workers=workers)
@@ -63,9 +63,7 @@ if __name__ == "__main__":
     in_files = [argparse.FileType('r')(f) for f in glob(synthetic_datagen.CORPUS_GLOB)]
     corpus = "".join(synthetic_datagen.read_files(in_files))
 
-    dataset = synthetic_datagen.make_dataset(args.model, SAMPLES, input_dist, output_dist, corpus)
-
     model_name = Path(args.model).name
     dataset_dest = f"{args.input.value}I{args.output.value}O_normal_{model_name}.jsonl"
     with open(dataset_dest, 'w') as f:
-        synthetic_datagen.write_dataset(dataset, f)
+        synthetic_datagen.generate_dataset(f, args.model, SAMPLES, input_dist, output_dist, corpus)
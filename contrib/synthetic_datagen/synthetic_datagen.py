@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 
-from abc import ABC
 import os
-from typing import IO, Any, Iterator, Optional
-from tokenizers import Tokenizer
+from typing import IO, Any, Optional
+import multiprocessing
 import random
 import numpy as np
 import json
@@ -11,6 +10,18 @@ import logging
 from glob import glob
 from copy import deepcopy
 
+# Distributions and corpus offsets are shared with the synthetic dataset
+# type of llm-load-test
+from llm_load_test.synthetic import (  # noqa: F401
+    Distribution,
+    EqualDist,
+    NormalDist,
+    UniformDist,
+    cached_offsets,
+    calculate_offsets,
+    sample_spans,
+)
+
 logger = logging.getLogger("synthetic-datagen")
 logging.basicConfig(level=logging.INFO)
 
@@ -18,6 +29,12 @@ logging.basicConfig(level=logging.INFO)
 
 CORPUS_GLOB=f"{os.path.dirname(os.path.realpath(__file__))}/corpus/*.txt"
 
+# Tokenized corpus offsets are kept here, keyed by tokenizer and corpus hash
+DEFAULT_CACHE_DIR = "~/.cache/llm-load-test/synthetic"
+
+# Samples encoded per task by the generate_dataset() workers
+CHUNK_SIZE = 1024
+
 METADATA_DICT: dict[str, Any] = {
     "name": "synthetic-data", 
     "version": "0.1.1", 
@@ -25,79 +42,6 @@ METADATA_DICT: dict[str, Any] = {
 }
 
 
-class Distribution(ABC):
-    _samples: list
-
-    def __init__(self, samples: int, generator: np.random.Generator, *args) -> None:
-        self.n = samples
-        self.argv = args
-
-    def __iter__(self) -> Iterator[int]:
-        return iter(self._samples)
-
-    def __getitem__(self, key) -> int:
-        return self._samples[key]
-
-    def __len__(self) -> int:
-        return len(self._samples)
-
-    @property
-    def description(self) -> dict:
-        return dict(
-            distribution=type(self).__name__,
-            args=self.argv,
-            n=self.n,
-        )
-
-
-class NormalDist(Distribution):
-    def __init__(
-            self,
-            samples: int,
-            generator: np.random.Generator,
-            mean: int,
-            stdev: int,
-            range_min: Optional[int] = None,
-            range_max: Optional[int] = None
-    ) -> None:
-        self._samples = []
-
-        if range_min is None:
-            range_min = mean - 3*stdev
-        range_min = max(1, range_min)
-
-        if range_max is None:
-            range_max = mean + 3*stdev
-
-        if range_min > range_max:
-            raise ValueError("Minimum value must be less than maximum value")
-
-        discarded = 0
-        while len(self._samples) < samples:
-            sample = int(generator.normal(loc=mean, scale=stdev))
-            if sample < range_min or sample > range_max:
-                discarded += 1
-            else:
-                self._samples.append(sample)
-
-        if discarded > 0:
-            logger.warning(f"Replaced {discarded} of {samples} samples which were outside range [{range_min}, {range_max}]")
-
-        super().__init__(samples, generator, mean, stdev)
-
-
-class UniformDist(Distribution):
-    def __init__(self, samples: int, generator: np.random.Generator, minimum: int, maximum: int) -> None:
-        self._samples = generator.uniform(low=minimum, high=maximum, size=samples).astype(dtype=int).tolist()
-        super().__init__(samples, generator, minimum, maximum)
-
-
-class EqualDist(Distribution):
-    def __init__(self, samples: int, generator: np.random.Generator, length: int) -> None:
-        self._samples = generator.normal(loc=length, scale=0, size=samples).astype(dtype=int).tolist()
-        super().__init__(samples, generator, length)
-
-
 def read_files(files: list[IO[str]]):
     for f in files:
         for line in f:
@@ -112,53 +56,259 @@ def write_dataset(dataset: list[dict], f: IO[str]):
     logger.info(f"Dataset saved to : {f.name}")
 
 
-def calculate_offsets(model, corpus):
-    if os.path.isfile(f"{model}/tokenizer.json"):
-        tokenizer = Tokenizer.from_file(f"{model}/tokenizer.json")
-    else:
-        tokenizer = Tokenizer.from_pretrained(model)
-    tokenized_corpus = tokenizer.encode(corpus)
-    return tokenized_corpus.offsets
+class PrefixStructure:
+    """Shared prompt prefixes, for prefix caching benchmarks.
 
+    Samples start with one of `system_prompts` shared system prompts of
+    `system_prompt_length` tokens. With `documents`, the question of each
+    sample also starts with one of the shared documents of `document_length`
+    tokens, and each document belongs to one system prompt, so the prefixes
+    form a tree. A `hit_ratio` share of the samples use a shared top-level
+    prefix, the others get a unique prefix of the same length.
+    """
 
-def make_one_sample(corpus, offsets, req_sample_size : int):
-    start = random.randrange(len(offsets) - req_sample_size)
-    end = start + req_sample_size # req_sample_size tokens from start
-    start_idx = offsets[start][0]
-    end_idx = offsets[end][0]
-    tokens = corpus[start_idx:end_idx]
-    return tokens
+    def __init__(
+            self,
+            system_prompts: int = 0,
+            system_prompt_length: int = 0,
+            documents: int = 0,
+            document_length: int = 0,
+            hit_ratio: float = 1.0,
+    ) -> None:
+        if system_prompts and system_prompt_length <= 0:
+            raise ValueError("Shared system prompts require a positive system prompt length")
+        if documents and document_length <= 0:
+            raise ValueError("Shared documents require a positive document length")
+        if not 0 <= hit_ratio <= 1:
+            raise ValueError("Prefix hit ratio must be between 0 and 1")
+        self.system_prompts = system_prompts
+        self.system_prompt_length = system_prompt_length
+        self.documents = documents
+        self.document_length = document_length
+        self.hit_ratio = hit_ratio
 
+    @property
+    def enabled(self) -> bool:
+        return bool(self.system_prompts or self.documents)
 
-def make_dataset(model: str, samples: int, input_dist: Distribution, output_dist: Distribution, corpus: str):
+    @property
+    def description(self) -> dict:
+        return dict(
+            system_prompts=self.system_prompts,
+            system_prompt_length=self.system_prompt_length,
+            documents=self.documents,
+            document_length=self.document_length,
+            hit_ratio=self.hit_ratio,
+        )
+
+
+def make_metadata(
+        model: str,
+        samples: int,
+        input_dist: Distribution,
+        output_dist: Distribution,
+        prefix: Optional[PrefixStructure] = None,
+) -> dict:
     dataset_info = {
         'tokenizer': model,
         'n': samples,
         'input': input_dist.description,
         'output': output_dist.description,
     }
+    if prefix is not None and prefix.enabled:
+        dataset_info['prefix'] = prefix.description
 
     # Make the metadata header
     metadata = deepcopy(METADATA_DICT)
     metadata['dataset_info'] = dataset_info
+    return metadata
+
+
+def sample_prefixes(generator: np.random.Generator, offsets, samples: int, prefix: PrefixStructure) -> dict:
+    """Assign the shared or unique prefixes of every sample.
+
+    Returns the prefix ids (-1 for a unique prefix) and character spans of
+    the system prompt and document of each sample.
+    """
+    empty = np.zeros(samples, dtype=np.int64)
+    columns = {
+        "system_prompt_id": empty - 1, "system_prompt_start": empty, "system_prompt_end": empty,
+        "document_id": empty - 1, "document_start": empty, "document_end": empty,
+    }
 
-    offsets = calculate_offsets(model, corpus)
+    if prefix.documents:
+        doc_starts, doc_ends = sample_spans(generator, offsets, np.full(prefix.documents, prefix.document_length))
+        doc_ids = generator.integers(0, prefix.documents, size=samples)
+        columns["document_id"] = doc_ids
+        columns["document_start"], columns["document_end"] = doc_starts[doc_ids], doc_ends[doc_ids]
+    if prefix.system_prompts:
+        sp_starts, sp_ends = sample_spans(generator, offsets, np.full(prefix.system_prompts, prefix.system_prompt_length))
+        if prefix.documents:
+            # Each document belongs to one system prompt
+            sp_ids = columns["document_id"] % prefix.system_prompts
+        else:
+            sp_ids = generator.integers(0, prefix.system_prompts, size=samples)
+        columns["system_prompt_id"] = sp_ids
+        columns["system_prompt_start"], columns["system_prompt_end"] = sp_starts[sp_ids], sp_ends[sp_ids]
+
+    # Misses replace the top-level prefix with a unique one of the same length
+    top, length = ("system_prompt", prefix.system_prompt_length) if prefix.system_prompts \
+        else ("document", prefix.document_length)
+    miss = np.flatnonzero(generator.random(samples) >= prefix.hit_ratio)
+    miss_starts, miss_ends = sample_spans(generator, offsets, np.full(len(miss), length))
+    columns[f"{top}_id"][miss] = -1
+    columns[f"{top}_start"][miss] = miss_starts
+    columns[f"{top}_end"][miss] = miss_ends
+
+    logger.info(f"{samples - len(miss)} of {samples} samples share a {top.replace('_', ' ')} prefix")
+    return columns
+
+
+def sample_dataset(
+        model: str,
+        samples: int,
+        input_dist: Distribution,
+        output_dist: Distribution,
+        corpus: str,
+        generator: Optional[np.random.Generator] = None,
+        cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+        prefix: Optional[PrefixStructure] = None,
+) -> dict:
+    """Pick the corpus spans of every sample at once.
+
+    Returns a dict of NumPy arrays with the character start and end of each
+    question, the input and output lengths, and the prefix columns of
+    sample_prefixes() when a prefix structure is given.
+    """
+    if generator is None:
+        # Follow the python random seed, which used to pick the spans
+        generator = np.random.default_rng(random.getrandbits(64))
+
+    offsets = cached_offsets(model, corpus, cache_dir)
     logger.info(f"Found {len(offsets)} tokens in corpus")
 
-    dict_items = [ metadata ]
-    for si, (input_len, output_len) in enumerate(zip(input_dist, output_dist)):
-        sample = make_one_sample(corpus, offsets, input_len)
-        logger.debug(f"Sample : {sample}")
-        dict_items.append({
-            "index": si,
-            "question": sample,
-            "tok_input_length": input_len,
+    input_lens = np.asarray(list(input_dist), dtype=np.int64)[:samples]
+    output_lens = np.asarray(list(output_dist), dtype=np.int64)[:samples]
+    char_starts, char_ends = sample_spans(generator, offsets, input_lens)
+    columns = {
+        "question_start": char_starts,
+        "question_end": char_ends,
+        "input_length": input_lens,
+        "output_length": output_lens,
+    }
+    if prefix is not None and prefix.enabled:
+        columns.update(sample_prefixes(generator, offsets, samples, prefix))
+        columns["system_prompt_length"] = np.full(samples, prefix.system_prompt_length)
+        columns["document_length"] = np.full(samples, prefix.document_length)
+    return columns
+
+
+def make_samples(corpus: str, first_index: int, columns: dict) -> list[dict]:
+    if "system_prompt_id" not in columns:
+        return [
+            {
+                "index": first_index + i,
+                "question": corpus[start:end],
+                "tok_input_length": input_len,
+                "tok_output_length": output_len,
+                "system_prompt": "",
+                "output_tokens" : output_len # to maintain consistency with existing sample dataset
+            }
+            for i, (start, end, input_len, output_len) in enumerate(zip(
+                columns["question_start"].tolist(), columns["question_end"].tolist(),
+                columns["input_length"].tolist(), columns["output_length"].tolist(),
+            ))
+        ]
+
+    items = []
+    rows = zip(*(columns[name].tolist() for name in (
+        "question_start", "question_end", "input_length", "output_length",
+        "system_prompt_id", "system_prompt_start", "system_prompt_end", "system_prompt_length",
+        "document_id", "document_start", "document_end", "document_length",
+    )))
+    for i, (start, end, input_len, output_len, sp_id, sp_start, sp_end, sp_len,
+            doc_id, doc_start, doc_end, doc_len) in enumerate(rows):
+        question = corpus[start:end]
+        if doc_end > doc_start:
+            question = corpus[doc_start:doc_end] + "\n\n" + question
+        items.append({
+            "index": first_index + i,
+            "question": question,
+            "tok_input_length": input_len + doc_len,
             "tok_output_length": output_len,
-            "system_prompt": "",
-            "output_tokens" : output_len # to maintain consistency with existing sample dataset
+            "system_prompt": corpus[sp_start:sp_end],
+            "output_tokens" : output_len, # to maintain consistency with existing sample dataset
+            "tok_system_prompt_length": sp_len,
+            "prefix_id": sp_id,
+            "document_id": doc_id,
         })
+    return items
+
+
+def make_dataset(
+        model: str,
+        samples: int,
+        input_dist: Distribution,
+        output_dist: Distribution,
+        corpus: str,
+        generator: Optional[np.random.Generator] = None,
+        cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+        prefix: Optional[PrefixStructure] = None,
+):
+    metadata = make_metadata(model, samples, input_dist, output_dist, prefix)
+    columns = sample_dataset(model, samples, input_dist, output_dist, corpus, generator, cache_dir, prefix)
+    return [ metadata ] + make_samples(corpus, 0, columns)
+
+
+# Corpus of a generate_dataset() worker process, sent once per worker
+_worker_corpus = None
+
+
+def _init_worker(corpus: str):
+    global _worker_corpus
+    _worker_corpus = corpus
+
+
+def _encode_chunk(chunk) -> str:
+    return "".join(json.dumps(item) + "\n" for item in make_samples(_worker_corpus, *chunk))
+
+
+def generate_dataset(
+        f: IO[str],
+        model: str,
+        samples: int,
+        input_dist: Distribution,
+        output_dist: Distribution,
+        corpus: str,
+        generator: Optional[np.random.Generator] = None,
+        cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+        workers: Optional[int] = None,
+        prefix: Optional[PrefixStructure] = None,
+):
+    """Write a dataset to f, slicing and encoding the samples in worker processes.
+
+    Writes the same file as make_dataset() followed by write_dataset(),
+    without holding every sample in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    metadata = make_metadata(model, samples, input_dist, output_dist, prefix)
+    columns = sample_dataset(model, samples, input_dist, output_dist, corpus, generator, cache_dir, prefix)
+
+    chunks = (
+        (i, {name: array[i:i + CHUNK_SIZE] for name, array in columns.items()})
+        for i in range(0, samples, CHUNK_SIZE)
+    )
+    f.write(json.dumps(metadata) + "\n")
+    if workers == 1:
+        _init_worker(corpus)
+        for text in map(_encode_chunk, chunks):
+            f.write(text)
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(corpus,)) as pool:
+            for text in pool.imap(_encode_chunk, chunks):
+                f.write(text)
 
-    return dict_items
+    logger.info(f"Dataset saved to : {f.name}")
 
 
 if __name__ == "__main__":
@@ -207,6 +357,56 @@ if __name__ == "__main__":
         default=42,
         help="random sample seed",
     )
+    parser.add_argument(
+        "-w", "--workers",
+        metavar="COUNT",
+        type=positive_int,
+        default=os.cpu_count(),
+        help="number of processes that write samples",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        default=DEFAULT_CACHE_DIR,
+        help="directory of the tokenized corpus cache",
+    )
+
+    prefix_group = parser.add_argument_group("shared prefixes")
+    prefix_group.add_argument(
+        "--system-prompts",
+        metavar="COUNT",
+        type=int,
+        default=0,
+        help="number of shared system prompts",
+    )
+    prefix_group.add_argument(
+        "--system-prompt-length",
+        metavar="LEN",
+        type=int,
+        default=0,
+        help="tokens per shared system prompt",
+    )
+    prefix_group.add_argument(
+        "--documents",
+        metavar="COUNT",
+        type=int,
+        default=0,
+        help="number of shared documents that questions start with",
+    )
+    prefix_group.add_argument(
+        "--document-length",
+        metavar="LEN",
+        type=int,
+        default=0,
+        help="tokens per shared document",
+    )
+    prefix_group.add_argument(
+        "--prefix-hit-ratio",
+        metavar="RATIO",
+        type=float,
+        default=1.0,
+        help="share of samples that start with a shared prefix",
+    )
 
     input_group = parser.add_mutually_exclusive_group(required=True)
     input_group.add_argument(
@@ -283,6 +483,13 @@ if __name__ == "__main__":
     corpus = "".join(read_files(args.corpus))
     logger.info(f"Loaded corpus")
 
-    dataset = make_dataset(args.model, args.samples, input_dist, output_dist, corpus)
+    prefix = PrefixStructure(
+        system_prompts=args.system_prompts,
+        system_prompt_length=args.system_prompt_length,
+        documents=args.documents,
+        document_length=args.document_length,
+        hit_ratio=args.prefix_hit_ratio,
+    )
 
-    write_dataset(dataset, args.dataset)
+    generate_dataset(args.dataset, args.model, args.samples, input_dist, output_dist, corpus,
+                     cache_dir=args.cache_dir, workers=args.workers, prefix=prefix)
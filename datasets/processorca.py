@@ -17,13 +17,15 @@
 import os
 import time
 import argparse
+import hashlib
+import numpy as np
 import pandas as pd
-import pickle
+import pyarrow.parquet as pq
 import json
 from tqdm import tqdm
-tqdm.pandas()
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
-from functools import partial
 from pathlib import Path
 from transformers import LlamaTokenizerFast
 from typing import Dict
@@ -38,17 +40,29 @@ def is_english(s):
     return True
 
 
-def _tokenize_helper(x, llama_tokenizer=None, append_response_init_token=False):
-    if not isinstance(x, str):
-        return []
+def _token_length_helper(texts, llama_tokenizer=None):
+    # One batched call per chunk, non-string values have no tokens
+    valid = [i for i, x in enumerate(texts) if isinstance(x, str)]
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    if valid:
+        input_ids = llama_tokenizer([texts[i] for i in valid])["input_ids"]
+        lengths[valid] = [len(ids) for ids in input_ids]
+    return lengths
 
-    tokens = llama_tokenizer(x)["input_ids"]
 
-    if append_response_init_token:
-        # Workaround to enable cheat checking for first token: Llama always outputs token 29871 first
-        # It is possible for submitters to just immediately output this token to achieve a very fast TTFT.
-        tokens.append(29871)
-    return tokens
+# Tokenizer of a get_token_lengths() worker process, loaded once per worker
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(model_dir):
+    global _worker_tokenizer
+    # Each worker is one process, the Rust tokenizer should not spawn more threads
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = LlamaTokenizerFast.from_pretrained(model_dir)
+
+
+def _token_length_worker(texts):
+    return _token_length_helper(texts, llama_tokenizer=_worker_tokenizer)
 
 
 @dataclass
@@ -65,32 +79,155 @@ class OpenOrcaDatasetGenerator:
                  model_dir: os.PathLike,
                  io_token_limit: int,
                  output_json_file: str,
-                 calibration_subset_size: int = 1000
+                 calibration_subset_size: int = 1000,
+                 tokenizer_workers: int = os.cpu_count(),
+                 tokenizer_batch_size: int = 1000,
                  ):
         self.pq_path = Path(pq_path)
         self.model_dir = Path(model_dir)
         self.io_token_limit = io_token_limit
         self.keyphrases = []
         self.calibration_subset_size = calibration_subset_size
+        self.tokenizer_workers = tokenizer_workers
+        self.tokenizer_batch_size = tokenizer_batch_size
+        self.tokenized_samples = 0
+        self._llama_tokenizer = None
+
+    def tokenizer_pool(self):
+        """Return the worker pool that tokenizes in parallel, or a null context with a single worker.
+
+        Workers start on the first batch and load the tokenizer once, so
+        the same pool should serve every row group.
+        """
+        if self.tokenizer_workers <= 1:
+            return nullcontext()
+        return ProcessPoolExecutor(self.tokenizer_workers,
+                                   initializer=_init_tokenizer_worker,
+                                   initargs=(self.model_dir,))
+
+    def _count_tokens(self, texts: list, pool: ProcessPoolExecutor = None) -> np.ndarray:
+        batches = [texts[i:i + self.tokenizer_batch_size] for i in range(0, len(texts), self.tokenizer_batch_size)]
+        if not batches:
+            return np.zeros(0, dtype=np.int64)
+        if pool is None:
+            if self._llama_tokenizer is None:
+                self._llama_tokenizer = LlamaTokenizerFast.from_pretrained(self.model_dir)
+            lengths = [_token_length_helper(batch, llama_tokenizer=self._llama_tokenizer) for batch in tqdm(batches)]
+        else:
+            lengths = list(tqdm(pool.map(_token_length_worker, batches), total=len(batches)))
+        return np.concatenate(lengths)
+
+    def _token_lengths_cache_path(self, export_dir: Path) -> Path:
+        key = hashlib.blake2b(digest_size=8)
+        key.update(str(self.model_dir.resolve()).encode())
+        key.update(str(self.pq_path.resolve()).encode())
+        stat = self.pq_path.stat()
+        key.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return export_dir / f"token_lengths.{self.model_dir.name}.{key.hexdigest()}.parquet"
+
+    def load_token_lengths(self, cache_path: os.PathLike) -> pd.DataFrame:
+        """Read the cached token lengths, indexed by sample id."""
+        if not Path(cache_path).exists():
+            return None
+        cached = pd.read_parquet(cache_path).set_index('id')
+        print(f"Read {len(cached)} token lengths from {cache_path}")
+        return cached
+
+    def iter_row_groups(self, columns: list = None):
+        """Read the parquet one row group at a time.
+
+        Yields the row group number and its rows as a DataFrame.
+        """
+        pq_file = pq.ParquetFile(self.pq_path)
+        for row_group in range(pq_file.num_row_groups):
+            df = pq_file.read_row_group(row_group, columns=columns).to_pandas()
+            df.rename(columns={'response': 'output'}, inplace=True)
+            yield row_group, df
+
+    def filter_row_group(self, df: pd.DataFrame, row_group: int, cached: pd.DataFrame = None,
+                         pool: ProcessPoolExecutor = None):
+        """Filter and tokenize one row group.
+
+        Returns the token lengths of every tokenized sample, for the cache,
+        and the compact table of the samples that pass all filters: their
+        location in the parquet and their token lengths.
+        """
+        df['row_group'] = row_group
+        df['row'] = np.arange(len(df))
+        df = self.set_origins(df)
+
+        # Apply filters
+        df = self.filter_english(df)
+        df = self.filter_bad_prompts(df)
+
+        df = self.get_token_lengths(df, cached, pool)
+        lengths = df[['id', 'tok_input_length', 'tok_output_length']]
+        df = self.filter_seqlen_oob(df)
+        df = self.filter_output_oob(df)
+        df = self.filter_short_expected_response(df)
+        return lengths, df[['row_group', 'row', 'tok_input_length', 'tok_output_length']]
+
+    def load_lengths_table(self, cache_path: os.PathLike = None) -> pd.DataFrame:
+        """Stream the parquet through the filters, keeping only token lengths.
+
+        Only one row group of text is held in memory at a time.
+        """
+        cached = self.load_token_lengths(cache_path) if cache_path is not None else None
+        all_lengths, tables = [], []
+        with self.tokenizer_pool() as pool:
+            for row_group, df in self.iter_row_groups():
+                print(f"Row group {row_group}: {len(df)} samples")
+                lengths, table = self.filter_row_group(df, row_group, cached, pool)
+                all_lengths.append(lengths)
+                tables.append(table)
+                del df
+
+        if cache_path is not None and self.tokenized_samples:
+            pd.concat(all_lengths, ignore_index=True).to_parquet(cache_path, index=False)
+        return pd.concat(tables, ignore_index=True)
+
+    def fetch_rows(self, table: pd.DataFrame) -> pd.DataFrame:
+        """Read the text of the rows of a lengths table, keeping its order."""
+        parts = []
+        for row_group, df in self.iter_row_groups():
+            selected = table[table['row_group'] == row_group]
+            if selected.empty:
+                continue
+            rows = df.iloc[selected['row'].to_numpy()].copy()
+            rows.index = selected.index
+            parts.append(rows)
+            del df
+
+        df = pd.concat(parts).loc[table.index]
+        df = self.set_origins(df)
+        df['tok_input_length'] = table['tok_input_length']
+        df['tok_output_length'] = table['tok_output_length']
+        return df.reset_index(drop=True)
 
-    def load_parquet(self, parquet_elements=None) -> pd.DataFrame:
-        df = pd.read_parquet(self.pq_path)
-        df.rename(columns={'response': 'output'}, inplace=True)
-        if parquet_elements is not None:
-            return df[:parquet_elements]
-        return df
+    def get_token_lengths(self, df, cached: pd.DataFrame = None, pool: ProcessPoolExecutor = None) -> pd.DataFrame:
+        """Add the tok_input_length and tok_output_length columns.
 
-    def get_token_lengths(self, df) -> pd.DataFrame:
+        Only samples whose id is not in the cached lengths are tokenized,
+        by the workers of pool if given.
+        """
         print(f"Tokenizing input")
 
-        llama_tokenizer = LlamaTokenizerFast.from_pretrained(self.model_dir)
-
         tik = time.time()
 
-        input_tokenizer = partial(_tokenize_helper, llama_tokenizer=llama_tokenizer)
-        output_tokenizer = partial(_tokenize_helper, llama_tokenizer=llama_tokenizer, append_response_init_token=False)
-        df['tok_input'] = df['question'].progress_apply(input_tokenizer)
-        df['tok_output'] = df['output'].progress_apply(output_tokenizer)
+        lengths = pd.DataFrame(index=pd.Index(df['id']), columns=['tok_input_length', 'tok_output_length'], dtype="Int64")
+        if cached is not None:
+            known = lengths.index.isin(cached.index)
+            lengths.loc[known] = cached.loc[lengths.index[known]].to_numpy()
+        missing = lengths['tok_input_length'].isna().to_numpy()
+        self.tokenized_samples += int(missing.sum())
+
+        if missing.any():
+            print(f"Tokenizing {missing.sum()} samples with {self.tokenizer_workers} workers")
+            lengths.loc[missing, 'tok_input_length'] = self._count_tokens(df['question'][missing].tolist(), pool)
+            lengths.loc[missing, 'tok_output_length'] = self._count_tokens(df['output'][missing].tolist(), pool)
+
+        df['tok_input_length'] = lengths['tok_input_length'].to_numpy(dtype=np.int64)
+        df['tok_output_length'] = lengths['tok_output_length'].to_numpy(dtype=np.int64)
         tok = time.time()
         print(f"Tokenized in {tok-tik} sec.")
         return df
@@ -105,9 +242,6 @@ class OpenOrcaDatasetGenerator:
         return df.reset_index(drop=True)
 
     def filter_seqlen_oob(self, df: pd.DataFrame) -> pd.DataFrame:
-        df['tok_input_length'] = df['tok_input'].apply(lambda x: len(x))
-        df['tok_output_length'] = df['tok_output'].apply(lambda x: len(x))
-
         # Filter based on sequence length (2048, 2048)
         df = df[df["tok_input_length"] < self.io_token_limit]
         df = df[df["tok_output_length"] < self.io_token_limit]
@@ -160,33 +294,40 @@ class OpenOrcaDatasetGenerator:
         return df.sample(n=_N, random_state=rng_seed)
 
 
-    def _get_distributed_subset(self, df, step_size: int = 64, rng_seed: int = 1337):
+    def _get_distributed_subset(self, df, step_size: int = 64, rng_seed: int = 1337, max_length: int = 12288):
+        input_lengths = df['tok_input_length'].to_numpy()
+        output_lengths = df['tok_output_length'].to_numpy()
+
+        # Tiles are open intervals (lower, upper), so lengths on a tile
+        # boundary belong to no tile
+        in_tile = ((input_lengths % step_size != 0) & (output_lengths % step_size != 0)
+                   & (input_lengths > 0) & (input_lengths < max_length)
+                   & (output_lengths > 0) & (output_lengths < max_length))
+        tiles = df[in_tile]
+        input_tiles = input_lengths[in_tile] // step_size
+        output_tiles = output_lengths[in_tile] // step_size
+
         outputs=[]
-        for input_lower in range(0, 12288, step_size):
-            input_upper = input_lower + step_size
-            for output_lower in range(0, 12288, step_size):
-                output_upper = output_lower + step_size
-                
-                data_subset = df[(df['tok_input_length'] > input_lower) & (df['tok_input_length'] < input_upper) & (df['tok_output_length'] > output_lower) & (df['tok_output_length'] < output_upper)]
-                elements_in_region = len(data_subset)
-                if elements_in_region > 0:
-                    # If there are 4 or fewer elements in the region, just take all of them
-                    # otherwise take fourth root+3 of the elements in the region
-                    if elements_in_region < 5:
-                        subset_sample_size = elements_in_region
-                    else:
-                        subset_sample_size = 3 + ((elements_in_region - 3))**(1/4)
-                    print(f"In tile: {input_lower}:{input_upper}, {output_lower}:{output_upper}, subset_sample_size: {subset_sample_size}")
-                    #subset_sample=max(1, (len(data_subset))**(1./3.))
-                    # sample from the subset
-                    sample = data_subset.sample(n=int(subset_sample_size), random_state=rng_seed)
-                    outputs.append(sample)
+        # Groups come in the tile order of input then output, rows in df order
+        for (input_tile, output_tile), data_subset in tiles.groupby([input_tiles, output_tiles], sort=True):
+            input_lower, output_lower = input_tile * step_size, output_tile * step_size
+            input_upper, output_upper = input_lower + step_size, output_lower + step_size
+            elements_in_region = len(data_subset)
+            # If there are 4 or fewer elements in the region, just take all of them
+            # otherwise take fourth root+3 of the elements in the region
+            if elements_in_region < 5:
+                subset_sample_size = elements_in_region
+            else:
+                subset_sample_size = 3 + ((elements_in_region - 3))**(1/4)
+            print(f"In tile: {input_lower}:{input_upper}, {output_lower}:{output_upper}, subset_sample_size: {subset_sample_size}")
+            # sample from the subset
+            sample = data_subset.sample(n=int(subset_sample_size), random_state=rng_seed)
+            outputs.append(sample)
 
         return pd.concat(outputs, ignore_index=True).reset_index(drop=True)
 
     def _write_to_json_and_jsonl(self, df, output_name):
-            df = df.drop('tok_input', axis=1)
-            df = df.drop('tok_output', axis=1)
+            df = df.drop(columns=['tok_input', 'tok_output', 'row_group', 'row'], errors='ignore')
             df = df.rename(columns={"output": "expected_output"})
             df = df.sort_values(by=['tok_input_length', 'tok_output_length'])
             df = df.reset_index(drop=True).reset_index()
@@ -195,19 +336,21 @@ class OpenOrcaDatasetGenerator:
             metadata = {"name": "openorca-subset", 
                         "version": "0.1.1", 
                         "license": "MIT License\n\nCopyright (c) [year] [fullname]\n\nPermission is hereby granted, free of charge, to any person obtaining a copy\nof this software and associated documentation files (the \"Software\"), to deal\nin the Software without restriction, including without limitation the rights\nto use, copy, modify, merge, publish, distribute, sublicense, and/or sell\ncopies of the Software, and to permit persons to whom the Software is\nfurnished to do so, subject to the following conditions:\n\nThe above copyright notice and this permission notice shall be included in all\ncopies or substantial portions of the Software.\n\nTHE SOFTWARE IS PROVIDED \"AS IS\", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR\nIMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,\nFITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE\nAUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER\nLIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,\nOUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE\nSOFTWARE.\n"}
-            ### .json file
-            json_obj = {"dataset": df.to_dict(), "metadata": metadata}
-                        
+            ### .json file, written one column at a time
             with open(f"{output_name}.json", 'w') as f:
-                json.dump(json_obj, f, indent=4)
-            
-
-            ### jsonl file
-            list_of_dicts = df.to_dict('records')
-            list_of_dicts.insert(0, metadata)
+                f.write('{"dataset": {')
+                for i, column in enumerate(df.columns):
+                    values = {str(index): value for index, value in zip(df.index, df[column].tolist())}
+                    f.write(("" if i == 0 else ", ") + json.dumps(column) + ": " + json.dumps(values))
+                f.write('}, "metadata": ' + json.dumps(metadata) + '}')
+
+            ### jsonl file, written one row at a time
+            columns = list(df.columns)
             with open(f"{output_name}.jsonl", 'w') as f:
-                for d in list_of_dicts:
-                    json.dump(d, f)
+                json.dump(metadata, f)
+                f.write('\n')
+                for row in zip(*(df[column].tolist() for column in columns)):
+                    json.dump(dict(zip(columns, row)), f)
                     f.write('\n')
             #df.to_json("openorca_large_subset_011.jsonl", orient='records', lines=True)
             #df.to_json("openorca_large_subset_011.json", orient='records', lines=False)
@@ -226,29 +369,19 @@ class OpenOrcaDatasetGenerator:
         if export_dir.is_file():
             raise ValueError(f"Cannot export to file {export_dir}. Must be a directory.")
 
-        full_fpath = export_dir / f"open_orca_gpt4_tokenized_llama.full.pkl"
+        # Only the location and token lengths of the filtered samples are
+        # kept, the text is read again for the sampled rows only
+        full_fpath = export_dir / f"open_orca_gpt4_tokenized_llama.lengths.parquet"
         if full_fpath.exists() and use_cached:
-            print(f"{full_fpath} exists, reading from pickle file")
-            df = pd.read_pickle(full_fpath)
+            print(f"{full_fpath} exists, reading from parquet file")
+            table = pd.read_parquet(full_fpath)
         else:
-            df = self.load_parquet()
-            df = self.set_origins(df)
-
-            # Apply filters
-            df = self.filter_english(df)
-            df = self.filter_bad_prompts(df)
-
-            print("df length: {}".format(len(df)))
-            df = self.get_token_lengths(df)
-            df = self.filter_seqlen_oob(df)
-            df = self.filter_output_oob(df)
-            df = self.filter_short_expected_response(df)
-            #df = self._get_sampling(df, n_samples)
-            #df = self.filter_keyphrases(df)
-            df.to_pickle(full_fpath)
-            print(df.head())
-        
-        df = self._get_distributed_subset(df)
+            table = self.load_lengths_table(cache_path=self._token_lengths_cache_path(export_dir))
+            table.to_parquet(full_fpath, index=False)
+            print("df length: {}".format(len(table)))
+
+        table = self._get_distributed_subset(table)
+        df = self.fetch_rows(table)
 
         print(len(df))
         df.to_pickle(export_dir / f"open_orca_gpt4_tokenized_llama.sampled.pkl")
@@ -269,6 +402,8 @@ def parse_arguments():
     parser.add_argument('--num_total_samples', type=int, default=24576, help="Number of samples to generate")
     parser.add_argument('--output_json_file', type=str, default="openorca_large_subset_011", help="Number of samples to generate")
     parser.add_argument('--calibration_subset_size', type=int, default=1000, help="Number of samples for calibration subset")
+    parser.add_argument('--tokenizer_workers', type=int, default=os.cpu_count(), help="Number of tokenizer processes")
+    parser.add_argument('--tokenizer_batch_size', type=int, default=1000, help="Number of texts per tokenizer call")
     return parser.parse_args()
 
 
@@ -280,7 +415,9 @@ if __name__ == "__main__":
         model_dir=args.model_dir,
         io_token_limit=args.seqlen_limit,
         calibration_subset_size=args.calibration_subset_size,
-        output_json_file=args.output_json_file
+        output_json_file=args.output_json_file,
+        tokenizer_workers=args.tokenizer_workers,
+        tokenizer_batch_size=args.tokenizer_batch_size,
     )
     ds_gen.generate(
         export_dir=args.export_dir,
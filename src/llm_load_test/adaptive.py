@@ -0,0 +1,155 @@
+"""Adaptive run length, stop a level once its metrics have converged."""
+
+import logging
+import math
+import statistics
+import time
+from typing import Optional
+
+from llm_load_test.result import ResultBlock
+from llm_load_test.sketch import LatencySketches
+
+import numpy as np
+
+"""
+Example config.yaml:
+
+load_options:
+  duration: 30 # Minimum duration with adaptive
+  adaptive:
+    target_width: 0.1 # Relative width of the confidence intervals to stop at
+    confidence: 0.95
+    max_duration: 600 # In seconds, stop even if the metrics have not converged
+    quantile: 0.99 # Latency percentile to converge, for ttft and itl
+    check_interval: 5 # In seconds
+"""
+
+# Latency metrics whose percentile has to converge
+ADAPTIVE_METRICS = ("ttft", "itl")
+# Batches of the throughput series for the batch means interval
+THROUGHPUT_BATCHES = 10
+# Share of the elapsed time skipped as warmup for throughput
+WARMUP_FRACTION = 0.1
+
+
+def t_quantile(p: float, df: int) -> float:
+    """Approximate the Student t quantile, with the Cornish-Fisher expansion of the normal one."""
+    z = statistics.NormalDist().inv_cdf(p)
+    return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+
+
+class ConvergenceMonitor:
+    """Decide when a level has run long enough.
+
+    Output tokens are binned per second by the end time of their request
+    as users send their results, and the merged latency histograms of the
+    users give the percentiles. A level stops once the confidence interval
+    of the throughput (by batch means of the per-second series) and of the
+    quantile of each latency metric are narrower than target_width relative
+    to their estimate, or when max_duration is reached.
+    """
+
+    def __init__(self,
+                 target_width: float = 0.1,
+                 confidence: float = 0.95,
+                 max_duration: float = 600,
+                 quantile: float = 0.99,
+                 check_interval: float = 5,
+                 ):
+        """Initialize the stopping rule."""
+        if not 0 < target_width:
+            raise ValueError("adaptive.target_width must be positive")
+        if not 0 < confidence < 1:
+            raise ValueError("adaptive.confidence must be between 0 and 1")
+        if not 0 < quantile < 1:
+            raise ValueError("adaptive.quantile must be between 0 and 1")
+        self.target_width = target_width
+        self.confidence = confidence
+        self.max_duration = max_duration
+        self.quantile = quantile
+        self.check_interval = check_interval
+        # Seconds users may hold results before sending them, the last lag
+        # seconds of the throughput series are not complete yet
+        self.lag = 0
+        self.start()
+
+    def start(self, start_time: Optional[float] = None):
+        """Reset the monitor for a new level starting at start_time."""
+        self.start_time = time.time() if start_time is None else start_time
+        self.tokens = np.zeros(0, dtype=np.float64)
+        self.last_check = self.start_time
+        self.widths = {}
+        self.converged = False
+
+    def add_block(self, block: ResultBlock):
+        """Add the output tokens of a block of results to the per-second series."""
+        df = block.to_dataframe()
+        df = df[df["error_text"].isnull()]
+        seconds = np.floor(df["end_time"].to_numpy(dtype=np.float64) - self.start_time)
+        tokens = df["output_tokens"].to_numpy(dtype=np.float64)
+        keep = ~np.isnan(seconds) & ~np.isnan(tokens) & (seconds >= 0)
+        if not keep.any():
+            return
+        binned = np.bincount(seconds[keep].astype(np.int64), weights=tokens[keep])
+        if len(binned) > len(self.tokens):
+            self.tokens = np.pad(self.tokens, (0, len(binned) - len(self.tokens)))
+        self.tokens[:len(binned)] += binned
+
+    def throughput_width(self, complete_seconds: int):
+        """Return the relative width of the throughput confidence interval, None if too few samples."""
+        warmup = int(complete_seconds * WARMUP_FRACTION)
+        series = self.tokens[warmup:complete_seconds]
+        if len(series) < THROUGHPUT_BATCHES * 2:
+            return None
+        # Means of consecutive batches are close to independent even if seconds are not
+        size = len(series) // THROUGHPUT_BATCHES
+        batches = series[len(series) - size * THROUGHPUT_BATCHES:].reshape(THROUGHPUT_BATCHES, size).mean(axis=1)
+        mean = batches.mean()
+        if mean <= 0:
+            return None
+        half_width = t_quantile((1 + self.confidence) / 2, THROUGHPUT_BATCHES - 1) * \
+            batches.std(ddof=1) / math.sqrt(THROUGHPUT_BATCHES)
+        return float(2 * half_width / mean)
+
+    def latency_width(self, sketches: LatencySketches, metric: str):
+        """Return the relative width of the quantile confidence interval of a metric."""
+        histogram = sketches.histograms[metric]
+        interval = histogram.quantile_interval(self.quantile, self.confidence)
+        estimate = histogram.quantile(self.quantile)
+        if interval is None or not estimate:
+            return None
+        low, high = interval
+        return (high - low) / estimate
+
+    def should_stop(self, elapsed: float, min_duration: float, sketches: LatencySketches) -> bool:
+        """Return True once the level has converged or reached max_duration."""
+        if elapsed >= self.max_duration:
+            if not self.converged:
+                logging.warning("Metrics did not converge within %ss: %s", self.max_duration, self.widths)
+            return True
+        now = self.start_time + elapsed
+        if elapsed < min_duration or now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+
+        self.widths = {"throughput": self.throughput_width(int(elapsed - self.lag))}
+        for metric in ADAPTIVE_METRICS:
+            if sketches.histograms[metric].count:
+                self.widths[f"{metric}_p{round(self.quantile * 100)}"] = self.latency_width(sketches, metric)
+        logging.info("Relative confidence interval widths after %.0fs: %s", elapsed,
+                     {key: None if width is None else round(width, 3) for key, width in self.widths.items()})
+
+        self.converged = all(width is not None and width <= self.target_width for width in self.widths.values())
+        if self.converged:
+            logging.info("Metrics converged within %.0f%% after %.0fs", self.target_width * 100, elapsed)
+        return self.converged
+
+    def summary(self, elapsed: float) -> dict:
+        """Describe how the level ended, for the output file."""
+        return {
+            "converged": self.converged,
+            "duration": elapsed,
+            "target_width": self.target_width,
+            "confidence": self.confidence,
+            "widths": self.widths,
+        }
@@ -0,0 +1,220 @@
+"""Recompute summaries from saved raw results.
+
+Usage: load-test analyze output.json [more.json ...] [--filter NAME ...] [--group-by NAME ...]
+
+Results are read from the output files, or from the JSONL or Parquet
+results files they point to, so other filters, groupings and percentiles
+can be applied without rerunning the test.
+"""
+
+import argparse
+import json
+import logging
+import math
+import sys
+
+from llm_load_test import utils
+from llm_load_test.decomposition import decompose
+from llm_load_test.errors import classify_errors
+
+import numpy as np
+
+import pandas as pd
+
+DEFAULT_METRICS = ["ttft", "itl", "tpot", "tt_ack", "response_time", "output_tokens", "input_tokens"]
+DEFAULT_PERCENTILES = [50, 80, 90, 95, 99]
+
+
+def _success(df, args):
+    return df["error_text"].isnull()
+
+
+def _within_deadline(df, args):
+    # The filter write_output applies to tpot, ttft, itl and tt_ack
+    return df["output_tokens"] == df["output_tokens_before_timeout"]
+
+
+def _steady(df, args):
+    return phases(df, args) == "steady"
+
+
+def _query(df, args):
+    if not args.query:
+        raise ValueError("filter query requires --query")
+    return df.eval(args.query).astype(bool)
+
+
+# Filters by name, each returns a boolean mask of the rows to keep
+FILTERS = {
+    "success": _success,
+    "within_deadline": _within_deadline,
+    "steady": _steady,
+    "query": _query,
+}
+
+
+def phases(df, args) -> pd.Series:
+    """Label each request warmup, steady or cooldown by when it was sent and ended.
+
+    Warmup requests were sent in the first --warmup seconds of their run,
+    cooldown requests ended in the last --cooldown seconds.
+    """
+    run_start = df.groupby("file")["start_time"].transform("min")
+    run_end = df.groupby("file")["end_time"].transform("max")
+    labels = np.where(df["start_time"] < run_start + args.warmup, "warmup",
+                      np.where(df["end_time"] > run_end - args.cooldown, "cooldown", "steady"))
+    return pd.Series(labels, index=df.index)
+
+
+def _input_bucket(df, args):
+    edges = sorted(args.input_bins) + [math.inf]
+    labels = [f"{low}-{high}" for low, high in zip(edges[:-1], edges[1:-1])] + [f"{edges[-2]}+"]
+    return pd.cut(df["input_tokens"], edges, right=False, labels=labels)
+
+
+# Groupings by name, each returns the group key of every row
+GROUPINGS = {
+    "file": lambda df, args: df["file"],
+    "user": lambda df, args: df["user_id"],
+    "input_bucket": _input_bucket,
+    "model": lambda df, args: df["model"],
+    "concurrency": lambda df, args: df["concurrency"],
+    "phase": phases,
+    "batch_size": lambda df, args: df["batch_size"],
+    "error_class": lambda df, args: classify_errors(df).fillna("success"),
+}
+
+
+def load_frames(filenames: list) -> pd.DataFrame:
+    """Load the results of all files into one DataFrame, with the file, model and concurrency of each row."""
+    frames = []
+    for filename in filenames:
+        output_obj, df = utils.load_results(filename)
+        config = output_obj.get("config", {})
+        df["file"] = filename
+        df["model"] = (config.get("plugin_options") or {}).get("model_name")
+        df["concurrency"] = (config.get("load_options") or {}).get("concurrency")
+        frames.append(df)
+        logging.info("Loaded %d results from %s", len(df), filename)
+    return pd.concat(frames, ignore_index=True)
+
+
+def summarize(df: pd.DataFrame, metrics: list, percentiles: list, group_keys: list) -> pd.DataFrame:
+    """Return count, mean, min, max and percentiles of each metric per group.
+
+    Groups are computed with a single groupby per statistic, so the cost
+    stays linear in the number of rows.
+    """
+    metrics = [metric for metric in metrics if metric in df]
+    df = df.assign(**{metric: pd.to_numeric(df[metric], errors="coerce") for metric in metrics})
+    if group_keys:
+        grouped = df.groupby(group_keys, observed=True, dropna=False)
+    else:
+        grouped = df.assign(_all="all").groupby("_all")
+
+    parts = [
+        grouped.size().rename("requests"),
+        grouped["output_tokens"].sum().div(
+            grouped["end_time"].max() - grouped["start_time"].min()
+        ).rename("throughput"),
+    ]
+    stats = grouped[metrics].agg(["mean", "min", "max"])
+    stats.columns = [f"{metric}_{stat}" for metric, stat in stats.columns]
+    parts.append(stats)
+
+    quantiles = [p / 100 for p in percentiles]
+    # One sort per group and metric for all percentiles
+    values = grouped[metrics].quantile(quantiles).unstack(level=-1)
+    values.columns = [f"{metric}_p{round(q * 100)}" for metric, q in values.columns]
+    parts.append(values)
+    return pd.concat(parts, axis=1)
+
+
+def decomposition_columns(df: pd.DataFrame, mask: pd.Series, keys: list) -> pd.DataFrame:
+    """Return the prefill and decode fits of each group as columns."""
+    index, rows = [], []
+    groups = df.groupby(keys, observed=True, dropna=False) if keys else [(("all",), df)]
+    for key, group in groups:
+        fits = decompose(group[mask.loc[group.index]], group)
+        index.append(key)
+        rows.append({
+            f"{stage}_{name}": value
+            for stage, fit in fits.items()
+            for name, value in fit.items()
+        })
+    if len(keys) > 1:
+        index = pd.MultiIndex.from_tuples(index, names=keys)
+    else:
+        index = pd.Index([key[0] for key in index], name=keys[0] if keys else "_all")
+    return pd.DataFrame(rows, index=index)
+
+
+def analyze(df: pd.DataFrame, args) -> pd.DataFrame:
+    """Apply the filters and groupings of the arguments and summarize."""
+    mask = pd.Series(True, index=df.index)
+    for name in args.filter:
+        if name not in FILTERS:
+            raise ValueError(f"Unknown filter {name}, expected one of {list(FILTERS)}")
+        mask &= FILTERS[name](df, args)
+    logging.info("Kept %d of %d results after filters %s", int(mask.sum()), len(df), args.filter)
+
+    keys = []
+    for name in args.group_by:
+        if name not in GROUPINGS:
+            raise ValueError(f"Unknown grouping {name}, expected one of {list(GROUPINGS)}")
+        df[f"group_{name}"] = GROUPINGS[name](df, args)
+        keys.append(f"group_{name}")
+
+    summary = summarize(df[mask], args.metrics, args.percentiles, keys)
+    if args.decompose:
+        summary = summary.join(decomposition_columns(df, mask, keys))
+    summary.index.names = [key.removeprefix("group_") if key else key for key in summary.index.names]
+    return summary
+
+
+def parse_args(args):
+    """Parse the analyze CLI parameters."""
+    parser = argparse.ArgumentParser(prog="load-test analyze", description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="output files to analyze")
+    parser.add_argument(
+        "--filter",
+        nargs="*",
+        default=["success"],
+        help=f"filters to apply, of {list(FILTERS)}, default success",
+    )
+    parser.add_argument("--query", help="pandas expression for the query filter, e.g. 'input_tokens > 512'")
+    parser.add_argument("--group-by", nargs="*", default=[], help=f"groupings, of {list(GROUPINGS)}")
+    parser.add_argument("--metrics", nargs="+", default=DEFAULT_METRICS, help="result fields to summarize")
+    parser.add_argument("--percentiles", nargs="+", type=float, default=DEFAULT_PERCENTILES,
+                        help="percentiles to compute, default 50 80 90 95 99")
+    parser.add_argument("--input-bins", nargs="+", type=int, default=[0, 128, 512, 2048, 8192],
+                        help="input token bucket edges of the input_bucket grouping")
+    parser.add_argument("--warmup", type=float, default=0, help="seconds of warmup for the phase grouping")
+    parser.add_argument("--cooldown", type=float, default=0, help="seconds of cooldown for the phase grouping")
+    parser.add_argument(
+        "--decompose",
+        action="store_true",
+        help="fit TTFT against input tokens and ITL against in-flight requests per group",
+    )
+    parser.add_argument("--output", help="write the summary to this .json or .csv file")
+    return parser.parse_args(args)
+
+
+def main(argv=None):
+    """Recompute summaries from result files."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-8s %(message)s")
+
+    summary = analyze(load_frames(args.files), args)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        print(summary.T if len(summary) <= 4 else summary)
+
+    if args.output:
+        if args.output.endswith(".csv"):
+            summary.to_csv(args.output)
+        else:
+            rows = summary.reset_index().replace({np.nan: None}).to_dict(orient="records")
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(rows, f, cls=utils.customEncoder, indent=2)
+        logging.info("Wrote summary to %s", args.output)
+    return 0
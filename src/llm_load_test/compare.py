@@ -0,0 +1,185 @@
+"""Compare result files with bootstrap confidence intervals.
+
+Usage: load-test compare baseline.json candidate.json [candidate2.json ...]
+
+Each candidate is compared to the baseline. The exit code is 1 if any
+metric regressed significantly, so release pipelines can gate on it.
+"""
+
+import argparse
+import json
+import logging
+import sys
+
+from llm_load_test import utils
+
+import numpy as np
+
+# Percentiles compared for each latency metric
+LATENCY_METRICS = ("ttft", "itl")
+QUANTILES = (0.5, 0.9, 0.99)
+# Elements of each bootstrap chunk, bounds memory for large runs
+CHUNK_ELEMENTS = 10_000_000
+
+
+class RunSample:
+    """Per-request values of one run, as used in its summary."""
+
+    def __init__(self, filename: str):
+        """Load a result file."""
+        self.filename = filename
+        output_obj, df = utils.load_results(filename)
+        self.errors = (~df["error_text"].isnull()).to_numpy(dtype=np.float64)
+        ok = df[df["error_text"].isnull()]
+        # Latencies of requests that completed within their deadline, like the summary
+        within_deadline = ok[ok["output_tokens"] == ok["output_tokens_before_timeout"]]
+        self.latencies = {
+            metric: within_deadline[metric].dropna().to_numpy(dtype=np.float64)
+            for metric in LATENCY_METRICS
+        }
+        self.output_tokens = ok["output_tokens"].fillna(0).to_numpy(dtype=np.float64)
+        self.duration = ok["end_time"].max() - ok["start_time"].min()
+
+
+def bootstrap(values: np.ndarray, statistic, resamples: int, generator: np.random.Generator) -> np.ndarray:
+    """Return the statistic of resamples drawn with replacement from values.
+
+    :param statistic: function of a (resamples, n) array returning one or
+        more statistics per row, e.g. lambda x: np.quantile(x, q, axis=1)
+    :returns: array of shape (resamples,) or (statistics, resamples)
+    """
+    n = len(values)
+    chunk = max(1, CHUNK_ELEMENTS // max(n, 1))
+    parts = []
+    for start in range(0, resamples, chunk):
+        size = min(chunk, resamples - start)
+        parts.append(statistic(values[generator.integers(0, n, size=(size, n))]))
+    return np.concatenate(parts, axis=-1)
+
+
+def compare_statistic(name: str, baseline: np.ndarray, candidate: np.ndarray, point, higher_is_better: bool,
+                      confidence: float, threshold: float) -> dict:
+    """Summarize the bootstrap distribution of candidate - baseline.
+
+    The change is a significant regression if its confidence interval
+    lies entirely on the worse side of threshold (relative to the baseline).
+    """
+    diff = candidate - baseline
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(diff, [alpha, 1 - alpha]).tolist()
+    base_value, cand_value = point
+    margin = threshold * abs(base_value)
+    if higher_is_better:
+        regression = high < -margin
+        improvement = low > margin
+    else:
+        regression = low > margin
+        improvement = high < -margin
+    return {
+        "metric": name,
+        "baseline": base_value,
+        "candidate": cand_value,
+        "difference": cand_value - base_value,
+        "relative": (cand_value - base_value) / base_value * 100 if base_value else None,
+        "ci_low": low,
+        "ci_high": high,
+        "regression": bool(regression),
+        "improvement": bool(improvement),
+    }
+
+
+def compare_runs(baseline: RunSample, candidate: RunSample, resamples: int = 2000,
+                 confidence: float = 0.95, threshold: float = 0.0, seed: int = 0) -> list:
+    """Compare the latency percentiles, throughput and error rate of two runs."""
+    generator = np.random.default_rng(seed)
+    rows = []
+
+    def quantiles(x):
+        return np.quantile(x, QUANTILES, axis=1)
+
+    for metric in LATENCY_METRICS:
+        base, cand = baseline.latencies[metric], candidate.latencies[metric]
+        if not len(base) or not len(cand):
+            logging.warning("No %s values in %s, skipping it",
+                            metric, baseline.filename if not len(base) else candidate.filename)
+            continue
+        base_boot = bootstrap(base, quantiles, resamples, generator)
+        cand_boot = bootstrap(cand, quantiles, resamples, generator)
+        base_point = np.quantile(base, QUANTILES)
+        cand_point = np.quantile(cand, QUANTILES)
+        for i, q in enumerate(QUANTILES):
+            rows.append(compare_statistic(f"{metric}_p{round(q * 100)}", base_boot[i], cand_boot[i],
+                                          (base_point[i], cand_point[i]), False, confidence, threshold))
+
+    # Throughput over each run's duration, resampling the requests
+    rows.append(compare_statistic(
+        "throughput",
+        bootstrap(baseline.output_tokens, lambda x: x.sum(axis=1), resamples, generator) / baseline.duration,
+        bootstrap(candidate.output_tokens, lambda x: x.sum(axis=1), resamples, generator) / candidate.duration,
+        (baseline.output_tokens.sum() / baseline.duration, candidate.output_tokens.sum() / candidate.duration),
+        True, confidence, threshold,
+    ))
+
+    # Error rate in percent
+    rows.append(compare_statistic(
+        "error_rate",
+        bootstrap(baseline.errors, lambda x: x.mean(axis=1), resamples, generator) * 100,
+        bootstrap(candidate.errors, lambda x: x.mean(axis=1), resamples, generator) * 100,
+        (baseline.errors.mean() * 100, candidate.errors.mean() * 100),
+        False, confidence, threshold,
+    ))
+    return rows
+
+
+def print_comparison(baseline: str, candidate: str, rows: list, confidence: float):
+    """Print a comparison table."""
+    print(f"\n{candidate} vs {baseline} ({confidence * 100:g}% confidence intervals)")
+    print(f"{'metric':<16}{'baseline':>12}{'candidate':>12}{'change':>10}{'ci_low':>12}{'ci_high':>12}  verdict")
+    for row in rows:
+        verdict = "REGRESSION" if row["regression"] else "improved" if row["improvement"] else ""
+        relative = f"{row['relative']:+.1f}%" if row["relative"] is not None else "n/a"
+        print(f"{row['metric']:<16}{row['baseline']:>12.3f}{row['candidate']:>12.3f}{relative:>10}"
+              f"{row['ci_low']:>12.3f}{row['ci_high']:>12.3f}  {verdict}")
+
+
+def parse_args(args):
+    """Parse the compare CLI parameters."""
+    parser = argparse.ArgumentParser(prog="load-test compare", description=__doc__.splitlines()[0])
+    parser.add_argument("baseline", help="baseline output file")
+    parser.add_argument("candidates", nargs="+", help="output files to compare to the baseline")
+    parser.add_argument("--resamples", type=int, default=2000, help="bootstrap resamples, default 2000")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level, default 0.95")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.0,
+        help="relative change to tolerate before flagging a regression, e.g. 0.05 for 5%%",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the resampling")
+    parser.add_argument("--output", help="write the comparison to this JSON file")
+    return parser.parse_args(args)
+
+
+def main(argv=None):
+    """Compare result files, return 1 if any candidate regressed."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-8s %(message)s")
+
+    baseline = RunSample(args.baseline)
+    comparisons = []
+    regressed = False
+    for filename in args.candidates:
+        rows = compare_runs(baseline, RunSample(filename), args.resamples, args.confidence,
+                            args.threshold, args.seed)
+        print_comparison(args.baseline, filename, rows, args.confidence)
+        comparisons.append({"baseline": args.baseline, "candidate": filename, "metrics": rows})
+        regressed |= any(row["regression"] for row in rows)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(comparisons, f, cls=utils.customEncoder, indent=2)
+
+    if regressed:
+        print("\nSignificant regressions found")
+        return 1
+    return 0
@@ -1,49 +1,140 @@
 """Dataset class."""
 import json
 import logging
+import mmap
+import os
 import random
+import re
+from array import array
 from typing import Optional
 
+from llm_load_test import dataset_cache
+from llm_load_test.synthetic import SyntheticPrompts
+
+import numpy as np
+
 dataset_seed = 1337
 
+# Bytes scanned at a time when indexing the lines of a dataset file
+INDEX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Token length fields, found without decoding each line. A quote inside a
+# JSON string is always escaped, so these cannot match inside a prompt.
+INPUT_LENGTH_PATTERN = re.compile(rb'"tok_input_length"\s*:\s*"?(\d+)')
+OUTPUT_LENGTH_PATTERN = re.compile(rb'"tok_output_length"\s*:\s*"?(\d+)')
+
+SAMPLING_STRATEGIES = ["shuffle", "stratified", "weighted"]
+
+# Dataset file types, inferred from the file extension when not configured
+FILE_TYPES = {
+    ".jsonl": "jsonl",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
+
+# Columns read from Parquet and Arrow files
+LENGTH_COLUMNS = ["tok_input_length", "tok_output_length"]
+TEXT_COLUMNS = ["question", "system_prompt", "index"]
+
 
 class Dataset:
     """Dataset class."""
 
     def __init__(self,
-                 file,
+                 file: Optional[str] = None,
+                 type: Optional[str] = None,
                  max_queries: int = 3000,
                  min_input_tokens: Optional[int] = None,
                  max_input_tokens: Optional[int] = None,
                  min_output_tokens: Optional[int] = None,
                  max_output_tokens: Optional[int] = None,
                  max_sequence_tokens: Optional[int] = None,
-                 custom_prompt_format=None
+                 custom_prompt_format=None,
+                 sampling: Optional[dict] = None,
+                 seed: int = dataset_seed,
+                 cache_dir: Optional[str] = None,
+                 cache_max_entries: int = 16,
+                 synthetic: Optional[dict] = None,
                  ):
         """Init method."""
         logging.info("Initializing dataset with %s", locals())
-        self.dataset_list = [input for input in
-                             initialize_dataset(file,
-                                                max_queries=max_queries,
-                                                min_input_tokens=min_input_tokens,
-                                                max_input_tokens=max_input_tokens,
-                                                min_output_tokens=min_output_tokens,
-                                                max_output_tokens=max_output_tokens,
-                                                max_sequence_tokens=max_sequence_tokens,
-                                                custom_prompt_format=custom_prompt_format
-                                                )
-                             ]
+        params = dict(max_queries=max_queries,
+                      min_input_tokens=min_input_tokens,
+                      max_input_tokens=max_input_tokens,
+                      min_output_tokens=min_output_tokens,
+                      max_output_tokens=max_output_tokens,
+                      max_sequence_tokens=max_sequence_tokens,
+                      custom_prompt_format=custom_prompt_format,
+                      sampling=sampling,
+                      seed=seed,
+                      )
+        self.index = 0
+        self.synthetic = None
+        # Prompt text of each synthetic query sent, once prompts() was called
+        self.sent_prompts = None
+        if type == "synthetic":
+            # Prompts are generated as they are consumed, so the filters and
+            # max_queries do not apply and no prompt is sent twice.
+            if not synthetic:
+                raise ValueError("dataset type synthetic requires a synthetic config section")
+            self.synthetic = SyntheticPrompts(seed=seed,
+                                              prompt_format=custom_prompt_format,
+                                              cache_dir=cache_dir,
+                                              **synthetic)
+            self.dataset_list = []
+            return
+        if file is None:
+            raise ValueError("dataset requires a file unless its type is synthetic")
+
+        file_type = type or FILE_TYPES.get(os.path.splitext(file)[1].lower(), "jsonl")
+        if file_type == "jsonl":
+            def build():
+                return list(initialize_dataset(file, **params))
+        elif file_type in ("parquet", "arrow"):
+            def build():
+                return list(initialize_columnar_dataset(file, file_type, **params))
+        else:
+            raise ValueError(f"Unknown dataset type {file_type}")
+
+        if cache_dir is not None:
+            self.dataset_list = dataset_cache.cached_dataset(
+                file,
+                cache_dir,
+                cache_max_entries,
+                build,
+                **params,
+            )
+        else:
+            self.dataset_list = build()
         if len(self.dataset_list) < 4:
             logging.warning("Total dataset is %s elements, check filters!", len(self.dataset_list))
-        self.index = 0
 
     def get_next_n_queries(self, n):
         """Get the N next queries."""
+        if self.synthetic is not None:
+            queries = self.synthetic.generate(n)
+            if self.sent_prompts is not None:
+                self.sent_prompts.update((query["input_id"], query["text"]) for query in queries)
+            return queries
         max_index = len(self.dataset_list)
         next_n_indices = [i % max_index for i in range(self.index, self.index + n)]
         self.index = (self.index + n) % max_index
         return [self.dataset_list[i] for i in next_n_indices]
 
+    def prompts(self) -> dict:
+        """Return the prompt text of each input_id, for client-side token counting.
+
+        Synthetic prompts only exist once they are generated, so the
+        returned dict is filled as the queries are sent from then on.
+        """
+        if self.synthetic is None:
+            return {query["input_id"]: query["text"] for query in self.dataset_list}
+        self.sent_prompts = {}
+        return self.sent_prompts
+
 
 def initialize_dataset(
     filename,
@@ -54,59 +145,382 @@ def initialize_dataset(
     max_output_tokens: Optional[int],
     max_sequence_tokens: Optional[int],
     custom_prompt_format: Optional[str],
+    sampling: Optional[dict] = None,
+    seed: int = dataset_seed,
 ):
     """Initialize the dataset."""
     prompt_format = "{prompt}" if not custom_prompt_format else custom_prompt_format
     if '{system_prompt}' not in prompt_format and '{prompt}' not in prompt_format:
         logging.warning("Prompt template does not contain any of ['{system_prompt}', '{prompt}']")
 
-    with open(filename, "r", encoding="utf-8") as file:
+    if os.path.getsize(filename) == 0:
+        logging.error("Dataset file %s is empty", filename)
+        return
+
+    with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
         total_queries = 0
 
-        # [1:] to skip the first line, it contains metadata
-        lines = file.readlines()[1:]
-        random.Random(dataset_seed).shuffle(lines)
+        line_bounds = index_lines(mm)
+
+        # Rows exclude the first line, it contains metadata
+        input_lengths, output_lengths = read_token_lengths(mm, line_bounds)
+        input_lengths, output_lengths = input_lengths[1:], output_lengths[1:]
+        mask = (input_lengths >= 0) & (output_lengths >= 0)
+        mask &= filter_token_lengths(input_lengths,
+                                     output_lengths,
+                                     min_input_tokens,
+                                     max_input_tokens,
+                                     min_output_tokens,
+                                     max_output_tokens,
+                                     max_sequence_tokens)
 
-        for line in lines:
+        rows = sample_rows(input_lengths, output_lengths, mask, max_queries, sampling, seed)
+
+        for row in rows:
+            line = mm[line_bounds[row + 1]:line_bounds[row + 2]]
             # Load each line as a JSON object
             try:
-                json_object = json.loads(line.strip())
+                json_object = json.loads(line)
             except json.JSONDecodeError as e:
                 logging.error("Error decoding JSON in file %s %s", filename, e)
                 continue
-            try:
-                input_tokens = int(json_object["tok_input_length"])
-                output_tokens = int(json_object["tok_output_length"])
-                prompt = json_object["question"]
-                system_prompt = json_object["system_prompt"]
-                input_id = json_object["index"]
-            except KeyError as e:
-                logging.error(
-                    "Unexpected format in dataset file %s, KeyError: %s, \n %s", filename, e, json_object
-                )
-                continue
-                # TODO exit or just skip here?
-            token_lengths_ok = filter_token_lengths(input_tokens,
-                                                    output_tokens,
-                                                    min_input_tokens,
-                                                    max_input_tokens,
-                                                    min_output_tokens,
-                                                    max_output_tokens,
-                                                    max_sequence_tokens)
-            if (token_lengths_ok):
-                input_data = {
-                    "text": prompt_format.format(prompt=prompt,
-                                                 system_prompt=system_prompt),
-                    "input_id": input_id,
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                }
+            input_data = make_query(json_object, prompt_format, filename)
+            if input_data is not None:
                 total_queries = total_queries + 1
                 yield input_data
                 if total_queries >= max_queries:
                     break
 
 
+class ColumnarFile:
+    """Read a Parquet or Arrow IPC file one row group or record batch at a time."""
+
+    def __init__(self, filename, file_type):
+        """Open the file without reading any column data."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as err:
+            raise ImportError(
+                f"dataset type {file_type} requires the pyarrow package, "
+                "install it with: pip install llm-load-test[parquet]"
+            ) from err
+
+        self.file_type = file_type
+        if file_type == "parquet":
+            self._file = pq.ParquetFile(filename, memory_map=True)
+            self.names = self._file.schema_arrow.names
+            self.chunk_rows = [
+                self._file.metadata.row_group(i).num_rows
+                for i in range(self._file.metadata.num_row_groups)
+            ]
+        else:
+            # Batches of a memory-mapped IPC file are zero-copy, only the
+            # columns that are accessed get paged in.
+            self._file = pa.ipc.open_file(pa.memory_map(filename, "r"))
+            self.names = self._file.schema.names
+            self.chunk_rows = [
+                self._file.get_batch(i).num_rows for i in range(self._file.num_record_batches)
+            ]
+
+    def read(self, chunk, columns):
+        """Read the given columns of one chunk."""
+        if self.file_type == "parquet":
+            return self._file.read_row_group(chunk, columns=columns)
+        return self._file.get_batch(chunk).select(columns)
+
+    def column_range(self, chunk, column):
+        """Return the (min, max) statistics of a column in a chunk, if known."""
+        if self.file_type != "parquet":
+            return None
+        row_group = self._file.metadata.row_group(chunk)
+        stats = row_group.column(self.names.index(column)).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        # Lengths stored as strings are cast when read, their statistics
+        # cannot be compared with the token limits
+        if not isinstance(stats.min, (int, float)) or not isinstance(stats.max, (int, float)):
+            return None
+        return stats.min, stats.max
+
+
+def _range_may_pass(value_range, min_tokens, max_tokens):
+    """Check if any value in a (min, max) range can pass the length filters."""
+    if value_range is None:
+        return True
+    low, high = value_range
+    if min_tokens and high <= min_tokens:
+        return False
+    if max_tokens and low >= max_tokens:
+        return False
+    return True
+
+
+def initialize_columnar_dataset(
+    filename,
+    file_type: str,
+    max_queries: int,
+    min_input_tokens: Optional[int],
+    max_input_tokens: Optional[int],
+    min_output_tokens: Optional[int],
+    max_output_tokens: Optional[int],
+    max_sequence_tokens: Optional[int],
+    custom_prompt_format: Optional[str],
+    sampling: Optional[dict] = None,
+    seed: int = dataset_seed,
+):
+    """Initialize the dataset from a Parquet or Arrow IPC file.
+
+    Only the token length columns are read to select the rows, skipping
+    Parquet row groups whose statistics rule out every row. The text
+    columns are then read one chunk at a time for the selected rows only.
+    Files without an index column use the row number as input_id.
+    """
+    prompt_format = "{prompt}" if not custom_prompt_format else custom_prompt_format
+    if '{system_prompt}' not in prompt_format and '{prompt}' not in prompt_format:
+        logging.warning("Prompt template does not contain any of ['{system_prompt}', '{prompt}']")
+
+    source = ColumnarFile(filename, file_type)
+    missing = [column for column in LENGTH_COLUMNS + ["question"] if column not in source.names]
+    if missing:
+        raise ValueError(f"Dataset file {filename} is missing columns {missing}")
+    text_columns = [column for column in TEXT_COLUMNS if column in source.names]
+
+    input_parts, output_parts = [], []
+    skipped = 0
+    for chunk, num_rows in enumerate(source.chunk_rows):
+        if not (_range_may_pass(source.column_range(chunk, "tok_input_length"), min_input_tokens, max_input_tokens)
+                and _range_may_pass(source.column_range(chunk, "tok_output_length"), min_output_tokens, max_output_tokens)):
+            input_parts.append(np.full(num_rows, -1, dtype=np.int64))
+            output_parts.append(np.full(num_rows, -1, dtype=np.int64))
+            skipped += 1
+            continue
+        table = source.read(chunk, LENGTH_COLUMNS)
+        input_parts.append(_lengths_array(table.column("tok_input_length")))
+        output_parts.append(_lengths_array(table.column("tok_output_length")))
+    if skipped:
+        logging.info("Skipped %d of %d chunks of %s by their statistics", skipped, len(source.chunk_rows), filename)
+
+    input_lengths = np.concatenate(input_parts) if input_parts else np.zeros(0, dtype=np.int64)
+    output_lengths = np.concatenate(output_parts) if output_parts else np.zeros(0, dtype=np.int64)
+    mask = (input_lengths >= 0) & (output_lengths >= 0)
+    mask &= filter_token_lengths(input_lengths,
+                                 output_lengths,
+                                 min_input_tokens,
+                                 max_input_tokens,
+                                 min_output_tokens,
+                                 max_output_tokens,
+                                 max_sequence_tokens)
+
+    rows = sample_rows(input_lengths, output_lengths, mask, max_queries, sampling, seed)
+    chunk_starts = np.concatenate([[0], np.cumsum(source.chunk_rows)])
+
+    total_queries = 0
+    position = 0
+    while total_queries < max_queries and position < len(rows):
+        # Fetch only as many rows as are still needed, reading each chunk once
+        block = rows[position:position + max_queries - total_queries]
+        position += len(block)
+        block_chunks = np.searchsorted(chunk_starts, block, side="right") - 1
+        fetched = {}
+        for chunk in np.unique(block_chunks):
+            chunk_rows = block[block_chunks == chunk]
+            table = source.read(int(chunk), text_columns).take(chunk_rows - chunk_starts[chunk])
+            for row, values in zip(chunk_rows.tolist(), table.to_pylist()):
+                fetched[row] = values
+
+        for row in block.tolist():
+            values = fetched[row]
+            if values.get("question") is None:
+                logging.error("Unexpected format in dataset file %s, missing question in row %d", filename, row)
+                continue
+            total_queries = total_queries + 1
+            yield {
+                "text": prompt_format.format(prompt=values["question"],
+                                             system_prompt=values.get("system_prompt") or ""),
+                "input_id": values["index"] if values.get("index") is not None else row,
+                "input_tokens": int(input_lengths[row]),
+                "output_tokens": int(output_lengths[row]),
+            }
+
+
+def _lengths_array(column):
+    """Convert an Arrow length column to int64, with -1 for nulls."""
+    import pyarrow.compute as pc
+
+    return np.asarray(pc.fill_null(column.cast("int64"), -1).to_numpy(), dtype=np.int64)
+
+
+def make_query(json_object, prompt_format, filename):
+    """Build a query from a dataset row, or return None if the row is malformed."""
+    try:
+        input_tokens = int(json_object["tok_input_length"])
+        output_tokens = int(json_object["tok_output_length"])
+        prompt = json_object["question"]
+        system_prompt = json_object["system_prompt"]
+        input_id = json_object["index"]
+    except KeyError as e:
+        logging.error(
+            "Unexpected format in dataset file %s, KeyError: %s, \n %s", filename, e, json_object
+        )
+        return None
+        # TODO exit or just skip here?
+    return {
+        "text": prompt_format.format(prompt=prompt,
+                                     system_prompt=system_prompt),
+        "input_id": input_id,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+    }
+
+
+def read_token_lengths(mm, line_bounds):
+    """Read the token length fields of every line without decoding the JSON.
+
+    Returns input and output length arrays with one entry per line, -1 where
+    a line has no such field.
+    """
+    lengths = []
+    for pattern in (INPUT_LENGTH_PATTERN, OUTPUT_LENGTH_PATTERN):
+        positions, values = [], []
+        for match in pattern.finditer(mm):
+            positions.append(match.start())
+            values.append(int(match.group(1)))
+        line_numbers = np.searchsorted(line_bounds, np.array(positions, dtype=np.int64), side="right") - 1
+        line_lengths = np.full(len(line_bounds) - 1, -1, dtype=np.int64)
+        # Assign in reverse so the first match of a line wins
+        line_lengths[line_numbers[::-1]] = np.array(values, dtype=np.int64)[::-1]
+        lengths.append(line_lengths)
+    return lengths
+
+
+def sample_rows(input_lengths, output_lengths, mask, max_queries, sampling=None, seed=dataset_seed):
+    """Order the rows that pass the filters according to the sampling strategy.
+
+    shuffle: shuffle all rows and take the first rows that pass the filters.
+    stratified: spread max_queries evenly across the (input, output) length
+        bins, taking all rows of a bin that has fewer than its share.
+    weighted: spread max_queries across the length bins by the given weights,
+        one weight per input bin or a matrix of weights per (input, output) bin.
+
+    Returns row indices in the order they should be used. For shuffle every
+    row passing the filters is returned, so malformed rows can be skipped.
+    """
+    sampling = dict(sampling or {})
+    strategy = sampling.pop("strategy", "shuffle")
+    if strategy not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Unknown dataset sampling strategy {strategy}")
+
+    if strategy == "shuffle":
+        # Shuffle row numbers with the stdlib RNG, this gives the same order
+        # as shuffling the lines of the file themselves.
+        order = array("q", range(len(mask)))
+        random.Random(seed).shuffle(order)
+        order = np.frombuffer(order, dtype=np.int64)
+        return order[mask[order]]
+
+    rng = np.random.default_rng(seed)
+    rows = np.flatnonzero(mask)
+    input_bin, input_count = _bin_index(input_lengths[rows], sampling.get("input_bins"))
+    output_bin, output_count = _bin_index(output_lengths[rows], sampling.get("output_bins"))
+    in_bins = (input_bin >= 0) & (output_bin >= 0)
+    if not in_bins.all():
+        logging.warning("Excluding %d rows outside of the sampling bins", (~in_bins).sum())
+    rows, input_bin, output_bin = rows[in_bins], input_bin[in_bins], output_bin[in_bins]
+
+    weights = np.ones((input_count, output_count))
+    if strategy == "weighted":
+        target = np.asarray(sampling.get("weights"), dtype=float)
+        if target.ndim == 1 and len(target) == input_count:
+            weights = np.repeat(target[:, None], output_count, axis=1)
+        elif target.shape == (input_count, output_count):
+            weights = target
+        else:
+            raise ValueError(f"Sampling weights must have shape ({input_count},) or "
+                             f"({input_count}, {output_count}), got {target.shape}")
+        # A weight per input bin is shared by the output bins in proportion to their size
+        if target.ndim == 1:
+            sizes = np.bincount(input_bin * output_count + output_bin,
+                                minlength=input_count * output_count).reshape(input_count, output_count)
+            row_totals = sizes.sum(axis=1, keepdims=True)
+            weights = weights * np.divide(sizes, row_totals, out=np.zeros(sizes.shape), where=row_totals > 0)
+
+    cell = input_bin * output_count + output_bin
+    sizes = np.bincount(cell, minlength=input_count * output_count)
+    quota = _allocate(sizes, weights.ravel(), max_queries)
+    logging.info("Sampling %d rows across %d length bins", quota.sum(), (quota > 0).sum())
+
+    # Randomize, then group by bin keeping the random order within each bin
+    shuffled = rng.permutation(len(rows))
+    by_cell = shuffled[np.argsort(cell[shuffled], kind="stable")]
+    sorted_cells = cell[by_cell]
+    first_in_cell = np.searchsorted(sorted_cells, sorted_cells, side="left")
+    rank = np.arange(len(by_cell)) - first_in_cell
+    selected = rows[by_cell[rank < quota[sorted_cells]]]
+
+    # Mix the bins so the request order does not follow the lengths
+    return rng.permutation(selected)
+
+
+def _bin_index(values, edges=None, default_bins=4):
+    """Bin values by edges, with -1 for values outside them.
+
+    Without edges, the range of the values is split into default_bins
+    equal-width bins.
+    """
+    if edges is None:
+        if len(values) == 0:
+            return np.zeros(0, dtype=np.int64), 1
+        edges = np.linspace(values.min(), values.max() + 1, default_bins + 1)
+    edges = np.asarray(edges)
+    bins = np.searchsorted(edges, values, side="right") - 1
+    bins[(bins < 0) | (bins >= len(edges) - 1)] = -1
+    return bins, len(edges) - 1
+
+
+def _allocate(sizes, weights, total):
+    """Split total across bins in proportion to weights, capped by the bin sizes.
+
+    The quota a full bin cannot take is shared again by the remaining bins.
+    """
+    quota = np.zeros(len(sizes), dtype=np.int64)
+    active = (sizes > 0) & (weights > 0)
+    remaining = min(total, sizes[active].sum())
+    while remaining > 0 and active.any():
+        active_weights = np.where(active, weights, 0.0)
+        share = active_weights / active_weights.sum() * remaining
+        add = np.floor(share).astype(np.int64)
+        # Hand out the rounding remainder by the largest fractional shares
+        leftover = remaining - add.sum()
+        if leftover > 0:
+            add[np.argsort(add - share, kind="stable")[:leftover]] += 1
+        add = np.minimum(add, sizes - quota)
+        quota += add
+        remaining -= add.sum()
+        active &= quota < sizes
+    return quota
+
+
+def index_lines(mm) -> np.ndarray:
+    """Index the lines of a memory-mapped file.
+
+    Returns the byte offset where each line starts followed by the size of
+    the file, so line i spans offsets [i, i + 1). Like readlines(), a final
+    line without a trailing newline is included.
+    """
+    size = len(mm)
+    newlines = [
+        np.flatnonzero(
+            np.frombuffer(mm, dtype=np.uint8, count=min(INDEX_CHUNK_SIZE, size - start), offset=start) == ord("\n")
+        ) + (start + 1)
+        for start in range(0, size, INDEX_CHUNK_SIZE)
+    ]
+    line_bounds = np.concatenate([np.zeros(1, dtype=np.int64), *newlines])
+    if line_bounds[-1] != size:
+        line_bounds = np.append(line_bounds, size)
+    return line_bounds
+
+
 def filter_token_lengths(input_tokens,
                          output_tokens,
                          min_input_tokens,
@@ -114,15 +528,18 @@ def filter_token_lengths(input_tokens,
                          min_output_tokens,
                          max_output_tokens,
                          max_sequence_tokens):
-    """Filter the tokens by length."""
+    """Filter the tokens by length.
+
+    Works on single values or on NumPy arrays of lengths, returning a mask.
+    """
     sequence_tokens = input_tokens + output_tokens
     output_min = output_tokens > min_output_tokens if min_output_tokens else True
     output_max = output_tokens < max_output_tokens if max_output_tokens else True
     input_max = input_tokens < max_input_tokens if max_input_tokens else True
     input_min = input_tokens > min_input_tokens if min_input_tokens else True
     seq_max = sequence_tokens < max_sequence_tokens if max_sequence_tokens else True
-    return (output_min
-            and output_max
-            and input_max
-            and input_min
-            and seq_max)
+    return (np.asarray(output_min)
+            & output_max
+            & input_max
+            & input_min
+            & seq_max)
@@ -0,0 +1,177 @@
+"""On-disk cache of filtered and formatted datasets."""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Bump when the cache file layout or the dataset selection logic changes
+CACHE_VERSION = 1
+
+# Bytes read at a time when hashing a dataset file
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+HASHES_FILE = "file_hashes.json"
+
+
+def _file_hash(filename: str, cache_dir: Path) -> str:
+    """Hash a dataset file, reusing the hash while its size and mtime are unchanged."""
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    stamp = f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    hashes_file = cache_dir / HASHES_FILE
+    try:
+        with hashes_file.open("r", encoding="utf-8") as f:
+            hashes = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        hashes = {}
+
+    entry = hashes.get(path)
+    if entry is not None and entry.get("stamp") == stamp:
+        return entry["hash"]
+
+    logging.info("Hashing dataset file %s", path)
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    hashes[path] = {"stamp": stamp, "hash": digest.hexdigest()}
+    tmp_file = hashes_file.with_suffix(f".{os.getpid()}.tmp")
+    with tmp_file.open("w", encoding="utf-8") as f:
+        json.dump(hashes, f)
+    os.replace(tmp_file, hashes_file)
+
+    return hashes[path]["hash"]
+
+
+def _encode_strings(values: list):
+    """Pack strings into one utf-8 buffer and an array of offsets."""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(data: np.ndarray, offsets: np.ndarray) -> list:
+    buffer = data.tobytes()
+    bounds = offsets.tolist()
+    return [buffer[start:end].decode("utf-8") for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _read_meta(path: Path) -> dict:
+    with np.load(path) as data:
+        return json.loads(data["meta"].tobytes())
+
+
+def save(path: Path, dataset_list: list, meta: dict):
+    """Write a dataset to a columnar .npz file."""
+    arrays = {
+        "meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+        "input_tokens": np.array([query["input_tokens"] for query in dataset_list], dtype=np.int64),
+        "output_tokens": np.array([query["output_tokens"] for query in dataset_list], dtype=np.int64),
+    }
+    arrays["text_data"], arrays["text_offsets"] = _encode_strings([query["text"] for query in dataset_list])
+
+    input_ids = [query["input_id"] for query in dataset_list]
+    if all(isinstance(input_id, int) for input_id in input_ids):
+        arrays["input_id"] = np.array(input_ids, dtype=np.int64)
+    else:
+        arrays["input_id_data"], arrays["input_id_offsets"] = _encode_strings([str(i) for i in input_ids])
+
+    # Write to a temporary file first so readers never see a partial entry
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with tmp_path.open("wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load(path: Path) -> list:
+    """Read a dataset written by save()."""
+    with np.load(path) as data:
+        texts = _decode_strings(data["text_data"], data["text_offsets"])
+        if "input_id" in data:
+            input_ids = data["input_id"].tolist()
+        else:
+            input_ids = _decode_strings(data["input_id_data"], data["input_id_offsets"])
+        input_tokens = data["input_tokens"].tolist()
+        output_tokens = data["output_tokens"].tolist()
+
+    return [
+        {
+            "text": text,
+            "input_id": input_id,
+            "input_tokens": in_tokens,
+            "output_tokens": out_tokens,
+        }
+        for text, input_id, in_tokens, out_tokens in zip(texts, input_ids, input_tokens, output_tokens)
+    ]
+
+
+def evict(cache_dir: Path, source: str, file_hash: str, keep: Path, max_entries: int):
+    """Remove stale entries of a source file and the least recently used entries."""
+    entries = []
+    for path in cache_dir.glob("*.npz"):
+        if path == keep:
+            continue
+        try:
+            meta = _read_meta(path)
+        except Exception:
+            logging.warning("Removing unreadable dataset cache entry %s", path)
+            path.unlink(missing_ok=True)
+            continue
+
+        # Entries for an older version of the same file can never be hit again
+        if meta.get("source") == source and meta.get("file_hash") != file_hash:
+            logging.info("Removing stale dataset cache entry %s", path)
+            path.unlink(missing_ok=True)
+        else:
+            entries.append(path)
+
+    entries.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in entries[max(0, max_entries - 1):]:
+        logging.info("Evicting dataset cache entry %s", path)
+        path.unlink(missing_ok=True)
+
+
+def cached_dataset(filename: str, cache_dir: str, max_entries: int, build, **params) -> list:
+    """Load a dataset from the cache, building and caching it on a miss.
+
+    :param filename: source dataset file
+    :param cache_dir: directory of the cache entries
+    :param max_entries: maximum number of entries kept in cache_dir
+    :param build: callable returning the dataset list on a cache miss
+    :param params: every parameter that affects the dataset contents
+    """
+    cache_path = Path(cache_dir).expanduser()
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    source = os.path.realpath(filename)
+    meta = {
+        "version": CACHE_VERSION,
+        "source": source,
+        "file_hash": _file_hash(filename, cache_path),
+        "params": params,
+    }
+    key = hashlib.blake2b(json.dumps(meta, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+    entry = cache_path / f"{key}.npz"
+
+    if entry.exists():
+        try:
+            dataset_list = load(entry)
+            # Mark the entry as recently used
+            os.utime(entry)
+            logging.info("Loaded %d dataset entries from cache %s", len(dataset_list), entry)
+            return dataset_list
+        except Exception:
+            logging.exception("Failed to load dataset cache entry %s, rebuilding it", entry)
+
+    dataset_list = build()
+    save(entry, dataset_list, meta)
+    logging.info("Saved %d dataset entries to cache %s", len(dataset_list), entry)
+    evict(cache_path, source, meta["file_hash"], entry, max_entries)
+    return dataset_list
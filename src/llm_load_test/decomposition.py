@@ -0,0 +1,93 @@
+"""Split latency into prefill and decode with linear fits."""
+
+import logging
+from typing import Optional
+
+import numpy as np
+
+import pandas as pd
+
+# Fewer samples than this give no fit
+MIN_SAMPLES = 10
+
+
+def linear_fit(x: np.ndarray, y: np.ndarray) -> dict:
+    """Fit y = intercept + slope * x by least squares.
+
+    :returns: dict with intercept, slope, r_squared and samples, or None
+        if there are too few distinct points
+    """
+    keep = ~np.isnan(x) & ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    if len(x) < MIN_SAMPLES or np.ptp(x) == 0:
+        return None
+    design = np.column_stack([np.ones_like(x), x])
+    (intercept, slope), _, _, _ = np.linalg.lstsq(design, y, rcond=None)
+    residuals = y - (intercept + slope * x)
+    total = ((y - y.mean()) ** 2).sum()
+    return {
+        "intercept": float(intercept),
+        "slope": float(slope),
+        "r_squared": float(1 - (residuals ** 2).sum() / total) if total > 0 else None,
+        "samples": int(len(x)),
+    }
+
+
+def in_flight_during_decode(df: pd.DataFrame, all_requests: pd.DataFrame) -> np.ndarray:
+    """Return the requests in flight halfway through each request's decode phase."""
+    starts = np.sort(all_requests["start_time"].dropna().to_numpy(dtype=np.float64))
+    ends = np.sort(all_requests["end_time"].dropna().to_numpy(dtype=np.float64))
+    midpoint = ((df["first_token_time"] + df["end_time"]) / 2).to_numpy(dtype=np.float64)
+    counts = (np.searchsorted(starts, midpoint, side="right")
+              - np.searchsorted(ends, midpoint, side="right")).astype(np.float64)
+    counts[np.isnan(midpoint)] = np.nan
+    return counts
+
+
+def decompose(df: pd.DataFrame, all_requests: Optional[pd.DataFrame] = None) -> dict:
+    """Estimate prefill and decode performance from per-request timings.
+
+    TTFT is fit against input tokens: the slope is the prefill time per
+    input token, so its inverse is the prefill throughput, and the
+    intercept is the delay a request waits regardless of its length,
+    mostly queueing and scheduling. ITL is fit against the requests in
+    flight during decode: the slope is how much each additional request
+    slows down every other one.
+
+    :param df: successful results to fit, with ttft and itl
+    :param all_requests: every request sent, for the in-flight counts,
+        defaults to df
+    """
+    if all_requests is None:
+        all_requests = df
+    decomposition = {}
+
+    prefill = None
+    if {"input_tokens", "ttft"} <= set(df.columns):
+        prefill = linear_fit(df["input_tokens"].to_numpy(dtype=np.float64), df["ttft"].to_numpy(dtype=np.float64))
+    if prefill is not None:
+        prefill["ms_per_input_token"] = prefill.pop("slope")
+        prefill["queueing_delay_ms"] = prefill.pop("intercept")
+        prefill["throughput_tokens_per_sec"] = (
+            1000 / prefill["ms_per_input_token"] if prefill["ms_per_input_token"] > 0 else None
+        )
+        decomposition["prefill"] = prefill
+
+    decode = None
+    if {"itl", "first_token_time", "end_time"} <= set(df.columns):
+        in_flight = in_flight_during_decode(df, all_requests)
+        itl = df["itl"].to_numpy(dtype=np.float64)
+        decode = linear_fit(in_flight, itl)
+    if decode is not None:
+        decode["ms_per_concurrent_request"] = decode.pop("slope")
+        decode["itl_single_request_ms"] = decode.pop("intercept") + decode["ms_per_concurrent_request"]
+        mean_in_flight = float(np.nanmean(in_flight))
+        mean_itl = float(np.nanmean(itl))
+        decode["mean_in_flight"] = mean_in_flight
+        # Tokens per second across all requests decoding at once
+        decode["throughput_tokens_per_sec"] = mean_in_flight * 1000 / mean_itl if mean_itl > 0 else None
+        decomposition["decode"] = decode
+
+    if not decomposition:
+        logging.info("Not enough streaming results with varied lengths or load to decompose latency")
+    return decomposition
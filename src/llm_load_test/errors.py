@@ -0,0 +1,105 @@
+"""Classify failed requests and summarize errors per class."""
+
+import re
+
+import numpy as np
+
+import pandas as pd
+
+# Error classes in order of precedence, the first pattern found in the
+# error text wins. The text is the repr of the exception raised by the
+# client, or the error message the server sent in its response.
+ERROR_PATTERNS = (
+    ("chunked_encoding", re.compile(r"ChunkedEncodingError|IncompleteRead|InvalidChunkLength")),
+    ("timeout", re.compile(r"Timeout|timed out|deadline exceeded", re.IGNORECASE)),
+    ("connection_refused", re.compile(r"Connection refused|NewConnectionError|Errno 111")),
+    ("connection_error", re.compile(r"ConnectionError|Connection reset|Connection aborted|RemoteDisconnected|failed to connect")),
+    ("http_5xx", re.compile(r"\b5\d\d Server Error")),
+    ("http_4xx", re.compile(r"\b4\d\d Client Error")),
+    ("bad_response", re.compile(r"^bad_response$|could not be json decoded")),
+)
+# Repr of an exception raised by the client, e.g. "ValueError('...')"
+EXCEPTION_REPR = re.compile(r"^\w+(Error|Exception)\(")
+# Characters of the error text kept as the example of each group
+EXAMPLE_LENGTH = 200
+
+
+def classify_error(error_text: str, error_code=None) -> str:
+    """Return the class of an error from its text and code.
+
+    Errors that match no pattern are classed by their HTTP status code.
+    Any other error message that is not a client exception was sent by
+    the server in the response, such as the error event of a stream.
+    """
+    for error_class, pattern in ERROR_PATTERNS:
+        if pattern.search(error_text):
+            return error_class
+    if not pd.isna(error_code):
+        if 500 <= error_code < 600:
+            return "http_5xx"
+        if 400 <= error_code < 500:
+            return "http_4xx"
+    if EXCEPTION_REPR.match(error_text):
+        return "client_exception"
+    return "stream_error"
+
+
+def classify_errors(df: pd.DataFrame) -> pd.Series:
+    """Return the error class of each result, None for requests that succeeded.
+
+    Failed requests have an error_text, as in the summary. Each distinct
+    error text and code is classified once.
+    """
+    failed = df["error_text"].notnull()
+    errors = pd.DataFrame({
+        "text": df.loc[failed, "error_text"].astype(str),
+        "code": df.loc[failed, "error_code"],
+    })
+    distinct = errors.drop_duplicates()
+    distinct["error_class"] = [classify_error(text, code) for text, code in zip(distinct["text"], distinct["code"])]
+    classes = errors.merge(distinct, on=["text", "code"], how="left")["error_class"].to_numpy()
+    return pd.Series(classes, index=errors.index).reindex(df.index)
+
+
+def error_breakdown(df: pd.DataFrame) -> list:
+    """Return the failures of each error class and code, most frequent first.
+
+    The latency to failure of a request is the time from sending it to
+    the error, in ms. A class that fails fast under overload has a low
+    latency to failure, one where the server hangs has a latency close
+    to the client timeout.
+
+    :param df: DataFrame of all results, including failed requests
+    """
+    classes = classify_errors(df)
+    if not classes.notnull().any():
+        return []
+    failed = df[classes.notnull()].assign(error_class=classes)
+    run_start = df["start_time"].min()
+    failed = failed.assign(latency_to_failure=1000 * (failed["end_time"] - failed["start_time"]))
+
+    breakdown = []
+    for (error_class, error_code), group in failed.groupby(["error_class", "error_code"], dropna=False):
+        latency = group["latency_to_failure"]
+        quantiles = latency.quantile([0.5, 0.9, 0.99])
+        breakdown.append({
+            "error_class": error_class,
+            "error_code": None if pd.isna(error_code) else int(error_code),
+            "count": len(group),
+            "percent_of_requests": len(group) / len(df) * 100,
+            "first_seen": group["end_time"].min() - run_start,
+            "last_seen": group["end_time"].max() - run_start,
+            "latency_to_failure": {
+                key: None if np.isnan(value) else float(value)
+                for key, value in {
+                    "min": latency.min(),
+                    "max": latency.max(),
+                    "median": quantiles[0.5],
+                    "mean": latency.mean(),
+                    "percentile_90": quantiles[0.9],
+                    "percentile_99": quantiles[0.99],
+                }.items()
+            },
+            "example": str(group["error_text"].iloc[0])[:EXAMPLE_LENGTH],
+        })
+    return sorted(breakdown, key=lambda row: row["count"], reverse=True)
@@ -8,32 +8,61 @@ import multiprocessing as mp
 import sys
 import time
 
-from llm_load_test import logging_utils, utils
+from llm_load_test import analyze, compare, logging_utils, report, utils
 from llm_load_test.dataset import Dataset
+from llm_load_test.result_writer import ResultCollector, create_result_writer, parse_flush_interval
+from llm_load_test.sketch import DEFAULT_RELATIVE_ACCURACY
 from llm_load_test.user import User
 
 
-def run_main_process(concurrency, duration, dataset, dataset_q, stop_q):
-    """Run the main process."""
+# Subcommands that work on result files, e.g. load-test compare a.json b.json
+SUBCOMMANDS = {
+    "analyze": analyze.main,
+    "compare": compare.main,
+    "report": report.main,
+}
+
+
+def run_main_process(concurrency, duration, dataset, dataset_q, stop_q, batch_size=1, collector=None,
+                     monitor=None):
+    """Run the main process.
+
+    With an adaptive run length monitor, duration is the minimum and the
+    test runs until the monitor stops it.
+
+    :returns: seconds the test ran for
+    """
     logging.info("Test from main process")
 
-    # Initialize the dataset_queue with 4*concurrency requests
-    for query in dataset.get_next_n_queries(2 * concurrency):
+    # Each user takes batch_size entries per request
+    queue_depth = concurrency * batch_size
+
+    # Initialize the dataset_queue with 2*queue_depth requests
+    for query in dataset.get_next_n_queries(2 * queue_depth):
         dataset_q.put(query)
 
     start_time = time.time()
     current_time = start_time
-    while (current_time - start_time) < duration:
+    if monitor is not None:
+        monitor.start(start_time)
+    while not test_done(current_time - start_time, duration, collector, monitor):
         # Keep the dataset queue full for duration
-        if dataset_q.qsize() < int(0.5*concurrency + 1):
-            logging.info("Adding %d entries to dataset queue", concurrency)
-            for query in dataset.get_next_n_queries(concurrency):
+        if dataset_q.qsize() < int(0.5*queue_depth + 1):
+            logging.info("Adding %d entries to dataset queue", queue_depth)
+            for query in dataset.get_next_n_queries(queue_depth):
                 dataset_q.put(query)
+        # Write the results users sent so far
+        if collector is not None:
+            collector.poll()
         time.sleep(0.1)
         current_time = time.time()
 
     logging.info("Timer ended, stopping processes")
 
+    # Users only know max_duration, tell the collector where the test ended
+    if monitor is not None and collector is not None:
+        collector.stop(current_time)
+
     # Signal users to stop sending requests
     stop_q.put(None)
 
@@ -42,18 +71,14 @@ def run_main_process(concurrency, duration, dataset, dataset_q, stop_q):
         logging.debug("Removing element from dataset_q")
         dataset_q.get()
 
-    return
+    return current_time - start_time
 
 
-def gather_results(results_pipes):
-    """Get the results."""
-    # Receive all results from each processes results_pipe
-    logging.debug("Receiving results from user processes")
-    results_list = []
-    for results_pipe in results_pipes:
-        user_results = results_pipe.recv()
-        results_list.extend(user_results)
-    return results_list
+def test_done(elapsed, duration, collector=None, monitor=None):
+    """Return True once the test has run long enough."""
+    if monitor is None:
+        return elapsed >= duration
+    return monitor.should_stop(elapsed, duration, collector.sketches)
 
 
 def stop_procs(procs, dataset_q, stop_q):
@@ -84,7 +109,9 @@ def stop_test(logger_q, log_reader_thread, code):
     sys.exit(code)
 
 
-def create_procs(mp_ctx, dataset_q, stop_q, plugin, logger_q, log_level, duration, concurrency):
+def create_procs(mp_ctx, dataset_q, stop_q, plugin, logger_q, log_level, duration, concurrency,
+                 retry_policy=None, flush_interval=None,
+                 relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
     """Create the user process objects."""
     procs = []
     results_pipes = []
@@ -100,6 +127,9 @@ def create_procs(mp_ctx, dataset_q, stop_q, plugin, logger_q, log_level, duratio
             logger_q=logger_q,
             log_level=log_level,
             run_duration=duration,
+            retry_policy=retry_policy,
+            flush_interval=flush_interval,
+            relative_accuracy=relative_accuracy,
         )
 
         proc = mp_ctx.Process(target=user.run_user_process)
@@ -113,6 +143,9 @@ def create_procs(mp_ctx, dataset_q, stop_q, plugin, logger_q, log_level, duratio
 
 def main():
     """Load test CLI entrypoint."""
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        sys.exit(SUBCOMMANDS[sys.argv[1]](sys.argv[2:]))
+
     args = utils.parse_args(sys.argv[1:])
 
     mp_ctx = mp.get_context("spawn")
@@ -133,6 +166,17 @@ def main():
     try:
         config = utils.yaml_load(args.config)
         concurrency, duration, plugin = utils.parse_config(config)
+        metrics_sampler = utils.parse_server_metrics(config)
+        token_counter = utils.parse_token_counter(config, plugin)
+        retry_policy = utils.parse_retry_policy(config)
+        flush_interval = parse_flush_interval(config["output"])
+        _, relative_accuracy = utils.parse_percentiles(config)
+        slo = utils.parse_slo(config)
+        monitor = utils.parse_adaptive(config)
+        if monitor is not None:
+            # Users send their results while the test runs so the monitor sees them
+            flush_interval = flush_interval or monitor.check_interval
+            monitor.lag = flush_interval
     except Exception as e:
         logging.error("Exiting due to invalid input: %s", repr(e))
 
@@ -148,13 +192,41 @@ def main():
             logging.debug("Creating dataset with configuration %s", config["dataset"])
             dataset = Dataset(**config["dataset"])
 
-            procs, results_pipes = create_procs(mp_ctx, dataset_q, stop_q, plugin, logger_q, args.log_level, duration, n_users)
+            # Encode request bodies once, before the plugin is copied to the users
+            plugin.cache_request_bodies(dataset.dataset_list, n_users)
+
+            # Adaptive levels end with a stop signal, at max_duration at the latest
+            user_duration = monitor.max_duration if monitor is not None else duration
+            procs, results_pipes = create_procs(mp_ctx, dataset_q, stop_q, plugin, logger_q, args.log_level, user_duration,
+                                                n_users, retry_policy, flush_interval, relative_accuracy)
+
+            # Stream results to the results file as users send them
+            outfile = utils.output_file(config, concurrency=n_users, duration=duration)
+            writer = create_result_writer(config["output"], outfile)
+            prompts = None
+            if token_counter is not None:
+                prompts = dataset.prompts()
+            collector = ResultCollector(results_pipes, writer, token_counter, prompts, relative_accuracy, monitor)
 
             logging.debug("Running main process")
 
-            run_main_process(n_users, duration, dataset, dataset_q, stop_q)
-            results_list = gather_results(results_pipes)
-            utils.write_output(config, results_list, concurrency=n_users, duration=duration)
+            if metrics_sampler is not None:
+                metrics_sampler.start()
+
+            elapsed = run_main_process(n_users, duration, dataset, dataset_q, stop_q, plugin.batch_size, collector,
+                                       monitor)
+            # Tokens are counted after the run so it never adds to measured latency
+            results = collector.finish()
+
+            server_metrics = None
+            if metrics_sampler is not None:
+                server_metrics = metrics_sampler.stop()
+
+            utils.write_output(config, results, concurrency=n_users, duration=duration,
+                               server_metrics=server_metrics,
+                               results_file=writer.path if writer is not None else None,
+                               sketches=collector.sketches, slo=slo,
+                               adaptive=monitor.summary(elapsed) if monitor is not None else None)
 
             stop_procs(procs, dataset_q, stop_q)
 
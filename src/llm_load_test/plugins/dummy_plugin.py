@@ -4,6 +4,7 @@ config.yaml:
   plugin: "dummy"
   plugin_options:
     streaming: True
+    batch_size: 1
 """
 
 import time
@@ -20,8 +21,12 @@ class DummyPlugin(plugin.Plugin):
         self._parse_args(args)
 
     def _parse_args(self, args):
+        self.batch_size = int(args.get("batch_size", 1))
+
         if args["streaming"]:
             self.request_func = self.streaming_request_http
+        elif self.batch_size > 1:
+            self.request_func = self.request_http_batch
         else:
             self.request_func = self.request_http
 
@@ -43,6 +48,28 @@ class DummyPlugin(plugin.Plugin):
 
         return result
 
+    def request_http_batch(self, queries, user_id, test_end_time: float = 0):
+        """Make a syncronous HTTP request with a batch of prompts."""
+        results = [RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+                   for query in queries]
+        start_time = time.time()
+
+        time.sleep(1)
+
+        end_time = time.time()
+
+        for query, result in zip(queries, results):
+            result.batch_size = len(results)
+            result.start_time = start_time
+            result.end_time = end_time
+            # Fake response is just the input backwards
+            result.output_text = query.get("text")[::-1]
+            result.output_tokens = query["output_tokens"]
+            result.output_tokens_before_timeout = result.output_tokens
+            result.calculate_results()
+
+        return results
+
     def streaming_request_http(self, query, user_id, test_end_time: float = 0):
         """Make a streaming HTTP request."""
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
@@ -6,6 +6,7 @@ import time
 
 from llm_load_test.plugins import plugin
 from llm_load_test.result import RequestResult
+from llm_load_test.retry import parse_retry_after
 
 import requests
 
@@ -21,7 +22,16 @@ logger = logging.getLogger("user")
 # TODO:
 # - Add configurable timeout for requests
 class HFTGIPlugin(plugin.Plugin):
-    """Plugin for the Hugging Face TGI model server."""
+    """Plugin for the Hugging Face TGI model server.
+
+    Example plugin config.yaml:
+
+    plugin: "hf_tgi_plugin"
+    plugin_options:
+      streaming: True
+      host: "http://127.0.0.1:8080"
+      body_cache_bytes: 268435456 # Total size of the pre-encoded request bodies, split between the users
+    """
 
     def __init__(self, args):
         """Initialize the plugin."""
@@ -40,11 +50,11 @@ class HFTGIPlugin(plugin.Plugin):
             logger.error("option streaming: %s not yet implemented", args["streaming"])
 
         self.host = args["host"] + endpoint
+        self.headers = {"Content-Type": "application/json"}
+        self.body_cache_bytes = int(args.get("body_cache_bytes", self.body_cache_bytes))
 
-    def streaming_request_http(self, query, user_id, test_end_time: float = 0):
-        """Make a streaming HTTP request."""
-        headers = {"Content-Type": "application/json"}
-
+    def encode_request(self, query):
+        """Encode the JSON request body for a query."""
         data = {
             "inputs": query["text"],
             "parameters": {
@@ -53,6 +63,11 @@ class HFTGIPlugin(plugin.Plugin):
                 "details": False,
             },
         }
+        return json.dumps(data).encode("utf-8")
+
+    def streaming_request_http(self, query, user_id, test_end_time: float = 0):
+        """Make a streaming HTTP request."""
+        body = self.get_request_body(query)
 
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
@@ -61,7 +76,7 @@ class HFTGIPlugin(plugin.Plugin):
         result.start_time = time.time()
         try:
             response = requests.post(
-                self.host, headers=headers, json=data, verify=False, stream=True
+                self.host, headers=self.headers, data=body, verify=False, stream=True
             )
             response.raise_for_status()
         except requests.exceptions.ConnectionError as err:
@@ -75,6 +90,7 @@ class HFTGIPlugin(plugin.Plugin):
             result.error_text = repr(err)
             if response is not None:
                 result.error_code = response.status_code
+                result.retry_after = parse_retry_after(response.headers.get("Retry-After"))
             return result
 
         logger.debug("response: %s", response)
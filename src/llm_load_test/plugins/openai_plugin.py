@@ -6,6 +6,7 @@ from typing import Any, Optional, Union
 
 from llm_load_test.plugins import plugin
 from llm_load_test.result import RequestResult
+from llm_load_test.retry import parse_retry_after
 
 import requests
 
@@ -21,6 +22,8 @@ plugin_options:
   host: "http://127.0.0.1:5000/v1/completions"
   model_name: "/mnt/model/"
   endpoint: "/v1/completions" # "/v1/chat/completions"
+  batch_size: 1 # Prompts per request, legacy non-streaming API only
+  body_cache_bytes: 268435456 # Total size of the pre-encoded request bodies, split between the users
 """
 
 required_args = ["host", "streaming", "endpoint"]
@@ -65,8 +68,12 @@ class OpenAIPlugin(plugin.Plugin):
             if arg not in args:
                 logger.error("Missing plugin arg: %s", arg)
 
+        self.batch_size = int(args.get("batch_size", 1))
+
         if args["streaming"]:
             self.request_func = self.streaming_request_http
+        elif self.batch_size > 1:
+            self.request_func = self.request_http_batch
         else:
             self.request_func = self.request_http
 
@@ -86,6 +93,10 @@ class OpenAIPlugin(plugin.Plugin):
         if self.api not in APIS:
             logger.error("Invalid api type: %s", self.api)
 
+        if self.batch_size > 1 and (args["streaming"] or self.api != 'legacy'):
+            logger.error("batch_size %d requires the legacy API with streaming disabled", self.batch_size)
+            raise ValueError("batch_size > 1 is only supported for non-streaming legacy completions")
+
         # TODO Make this configurable
         self.request_defaults = dict(
             temperature=0.0,
@@ -94,35 +105,27 @@ class OpenAIPlugin(plugin.Plugin):
 
         self.authorization = args.get("authorization")
 
-    def _process_resp(self, resp: bytes) -> Optional[dict]:
-        try:
-            _, found, data = resp.partition(b"data: ")
-            if not found:
-                return None
-            message = json.loads(data)
-            logger.debug("Message: %s", message)
-        except json.JSONDecodeError:
-            logger.exception("Response line could not be json decoded: %s", resp)
-            return None
-
-        return message
-
-    def request_http(self, query: dict, user_id: int, test_end_time: float = 0):
-        """Make a syncronous HTTP request."""
-        result = RequestResult(user_id, query.get("text"), query.get("input_tokens"))
-
-        result.start_time = time.time()
-
-        headers = {"Content-Type": "application/json"}
-
+        self.headers = {"Content-Type": "application/json"}
         if self.authorization:
-            headers["Authorization"] = f"Bearer {self.authorization}"
+            self.headers["Authorization"] = f"Bearer {self.authorization}"
 
+        self.streaming = args["streaming"]
+        self.body_cache_bytes = int(args.get("body_cache_bytes", self.body_cache_bytes))
+
+    def encode_request(self, query: dict) -> bytes:
+        """Encode the JSON request body for a query."""
         request = {
             "max_tokens": query["output_tokens"],
             "min_tokens": query["output_tokens"],
         }
 
+        if self.streaming:
+            request["stream"] = True
+            request["stream_options"] = {
+                "include_usage": True,
+                "continuous_usage_stats": True,
+            }
+
         if self.api == 'chat':
             request["messages"] = [
                 {"role": "user", "content": query["text"]}
@@ -130,15 +133,39 @@ class OpenAIPlugin(plugin.Plugin):
         else:  # self.api == 'legacy'
             request["prompt"] = query["text"],
 
+        # some runtimes only serve one model, won't check this.
         if self.model_name is not None:
             request["model"] = self.model_name
 
         # Merge request and defaults
         data = self.request_defaults | request
 
+        return json.dumps(data).encode("utf-8")
+
+    def _process_resp(self, resp: bytes) -> Optional[dict]:
+        try:
+            _, found, data = resp.partition(b"data: ")
+            if not found:
+                return None
+            message = json.loads(data)
+            logger.debug("Message: %s", message)
+        except json.JSONDecodeError:
+            logger.exception("Response line could not be json decoded: %s", resp)
+            return None
+
+        return message
+
+    def request_http(self, query: dict, user_id: int, test_end_time: float = 0):
+        """Make a syncronous HTTP request."""
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+
+        body = self.get_request_body(query)
+
+        result.start_time = time.time()
+
         response = None
         try:
-            response = requests.post(self.host, headers=headers, json=data, verify=False)
+            response = requests.post(self.host, headers=self.headers, data=body, verify=False)
             response.raise_for_status()
         except requests.exceptions.ConnectionError as err:
             result.end_time = time.time()
@@ -152,6 +179,7 @@ class OpenAIPlugin(plugin.Plugin):
             result.error_text = repr(err)
             if response is not None:
                 result.error_code = response.status_code
+                result.retry_after = parse_retry_after(response.headers.get("Retry-After"))
             logger.exception("HTTP error")
             return result
 
@@ -174,6 +202,7 @@ class OpenAIPlugin(plugin.Plugin):
 
                 result.output_tokens = deepget(message, "usage", "completion_tokens")
                 result.input_tokens = deepget(message, "usage", "prompt_tokens")
+                result.server_usage = int(result.output_tokens is not None)
                 result.stop_reason = deepget(message, "choices", 0, "finish_reason")
             else:
                 result.error_code = response.status_code
@@ -189,44 +218,105 @@ class OpenAIPlugin(plugin.Plugin):
 
         return result
 
-    def streaming_request_http(self, query: dict, user_id: int, test_end_time: float):
-        """Make a streaming HTTP request."""
-        headers = {"Content-Type": "application/json"}
+    def request_http_batch(self, queries: list, user_id: int, test_end_time: float = 0):
+        """Make a syncronous HTTP request with a batch of prompts.
 
-        if self.authorization:
-            headers["Authorization"] = f"Bearer {self.authorization}"
+        All prompts in a batch share the same generation limits, so each
+        prompt is asked for the largest output_tokens in the batch.
+        """
+        results = [RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+                   for query in queries]
+        output_tokens = max(query["output_tokens"] for query in queries)
 
         request = {
-            "max_tokens": query["output_tokens"],
-            "min_tokens": query["output_tokens"],
-            "stream": True,
-            "stream_options": {
-                "include_usage": True,
-                "continuous_usage_stats": True,
-            }
+            "max_tokens": output_tokens,
+            "min_tokens": output_tokens,
+            "prompt": [query["text"] for query in queries],
         }
 
-        if self.api == 'chat':
-            request["messages"] = [
-                {"role": "user", "content": query["text"]}
-            ]
-        else:  # self.api == 'legacy'
-            request["prompt"] = query["text"],
-
-        # some runtimes only serve one model, won't check this.
         if self.model_name is not None:
             request["model"] = self.model_name
 
         # Merge request and defaults
         data = self.request_defaults | request
 
+        response = None
+        error_code, error_text, retry_after = None, None, None
+        start_time = time.time()
+        try:
+            response = requests.post(self.host, headers=self.headers, json=data, verify=False)
+            response.raise_for_status()
+        except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.HTTPError
+        ) as err:
+            error_text = repr(err)
+            if response is not None:
+                error_code = response.status_code
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            logger.exception("Error in batched request")
+
+        end_time = time.time()
+
+        ###########################################
+        # DO NOT CALL time.time BEYOND THIS POINT #
+        ###########################################
+
+        if error_text is None:
+            logger.debug("Response: %s", json.dumps(response.text))
+            try:
+                message = json.loads(response.text)
+                error = message.get("error")
+                if error is None:
+                    # Choices are matched to prompts by their index
+                    for choice in message.get("choices", []):
+                        index = choice.get("index")
+                        if isinstance(index, int) and 0 <= index < len(results):
+                            results[index].output_text = choice.get("text")
+                            results[index].stop_reason = choice.get("finish_reason")
+
+                    expected_output_tokens = deepget(message, "usage", "completion_tokens")
+                    if expected_output_tokens is not None and expected_output_tokens != output_tokens * len(results):
+                        logger.warning(f"Received {expected_output_tokens} tokens but expected "
+                                       f"{output_tokens * len(results)} tokens for the batch")
+                else:
+                    error_code = response.status_code
+                    error_text = error
+                    logger.error("Error received in response message: %s", error)
+            except json.JSONDecodeError:
+                logger.exception("Response could not be json decoded: %s", response.text)
+                error_text = f"Response could not be json decoded {response.text}"
+
+        for result in results:
+            result.batch_size = len(results)
+            result.start_time = start_time
+            result.end_time = end_time
+            if error_text is not None:
+                result.error_code = error_code
+                result.error_text = error_text
+                result.retry_after = retry_after
+            elif result.output_text is None:
+                result.error_text = "No choice returned for prompt in batched response"
+            else:
+                # Usage is only reported for the whole batch, so each prompt
+                # is counted with the tokens it was forced to generate.
+                result.output_tokens = output_tokens
+                result.output_tokens_before_timeout = result.output_tokens
+            result.calculate_results()
+
+        return results
+
+    def streaming_request_http(self, query: dict, user_id: int, test_end_time: float):
+        """Make a streaming HTTP request."""
+        body = self.get_request_body(query)
+
         result = RequestResult(user_id, query.get("input_id"))
 
         response = None
         result.start_time = time.time()
         try:
             response = requests.post(
-                self.host, headers=headers, json=data, verify=False, stream=True
+                self.host, headers=self.headers, data=body, verify=False, stream=True
             )
             response.raise_for_status()
         except (
@@ -237,6 +327,7 @@ class OpenAIPlugin(plugin.Plugin):
             result.error_text = repr(err)
             if response is not None:
                 result.error_code = response.status_code
+                result.retry_after = parse_retry_after(response.headers.get("Retry-After"))
             logger.exception("Connection error")
             return result
 
@@ -288,6 +379,7 @@ class OpenAIPlugin(plugin.Plugin):
             # We want to count output tokens ourselves, but we can check our work with usage data.
             expected_output_tokens = deepget(message, "usage", "completion_tokens")
             result.input_tokens = deepget(message, "usage", "prompt_tokens")
+            result.server_usage = int(expected_output_tokens is not None)
             # We don't want to record this message
             resps.pop()
         else:
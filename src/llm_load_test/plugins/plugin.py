@@ -1,13 +1,67 @@
 """Abstract class for plugin."""
 
+import logging
+
 
 class Plugin:
     """Abstract class for plugin."""
 
+    # Number of dataset entries sent in each request. Plugins that set this
+    # above 1 take a list of queries and return a list of results.
+    batch_size = 1
+
+    # Maximum total size in bytes of the pre-encoded request bodies over
+    # all users. Each user process holds its own copy of the cache, so the
+    # cache is limited to this bound divided by the concurrency.
+    body_cache_bytes = 256 * 2 ** 20
+    _body_cache = None
+
     def __init__(self, args):
         """Initialize the plugin."""
         self.args = args
 
+    def encode_request(self, query):
+        """Encode the request body for a query, or None if not supported."""
+        return None
+
+    def cache_request_bodies(self, queries, users=1):
+        """Pre-encode the request bodies of the given dataset entries.
+
+        The whole dataset is encoded up to body_cache_bytes divided by the
+        number of users. Must be called before the user processes are
+        started so the cache is copied to each of them.
+        """
+        self._body_cache = {}
+        max_bytes = self.body_cache_bytes // max(users, 1)
+        # Batched request bodies depend on the whole batch
+        if self.batch_size > 1:
+            return
+        total_bytes = 0
+        for query in queries:
+            if query.get("input_id") is None:
+                continue
+            body = self.encode_request(query)
+            if body is None:
+                return
+            total_bytes += len(body)
+            if total_bytes > max_bytes:
+                logging.warning("Pre-encoded %d of %d request bodies, the rest exceed body_cache_bytes %d "
+                                "over %d users and are encoded when sent", len(self._body_cache), len(queries),
+                                self.body_cache_bytes, users)
+                return
+            self._body_cache[query.get("input_id")] = body
+        if self._body_cache:
+            logging.info("Pre-encoded %d request bodies, %d bytes", len(self._body_cache), total_bytes)
+
+    def get_request_body(self, query):
+        """Get the encoded request body for a query, encoding it if it was not pre-encoded."""
+        body = None
+        if self._body_cache and query.get("input_id") is not None:
+            body = self._body_cache.get(query["input_id"])
+        if body is None:
+            body = self.encode_request(query)
+        return body
+
     def request_http(self, query, user_id):
         """Make a syncronous HTTP request."""
         pass
@@ -16,6 +70,10 @@ class Plugin:
         """Make a streaming HTTP request."""
         pass
 
+    def request_http_batch(self, queries, user_id):
+        """Make a syncronous HTTP request with a batch of prompts."""
+        pass
+
     def request_grpc(self, query, user_id):
         """Make a syncronous gRPC request."""
         pass
@@ -23,3 +81,7 @@ class Plugin:
     def streaming_request_grpc(self, query, user_id):
         """Make a streaming gRPC request."""
         pass
+
+    def request_grpc_batch(self, queries, user_id):
+        """Make a syncronous gRPC request with a batch of prompts."""
+        pass
@@ -16,6 +16,9 @@ logger = logging.getLogger("user")
 
 required_args = ["model_name", "host", "port", "streaming", "use_tls"]
 
+GENERATE_METHOD = "/fmaas.GenerationService/Generate"
+GENERATE_STREAM_METHOD = "/fmaas.GenerationService/GenerateStream"
+
 
 class TGISGRPCPlugin(plugin.Plugin):
     """Plugin for interacting with TGI Server using gRPC.
@@ -31,6 +34,8 @@ class TGISGRPCPlugin(plugin.Plugin):
     model_name: "Llama-2-7b-hf"
     host: "localhost"
     port: 8033
+    batch_size: 1 # Prompts per Generate request, non-streaming only
+    body_cache_bytes: 268435456 # Total size of the pre-serialized requests, split between the users
     """
 
     def __init__(self, args):
@@ -47,9 +52,17 @@ class TGISGRPCPlugin(plugin.Plugin):
         self.host = args["host"]
         self.port = args["port"]
         self.use_tls = bool(args["use_tls"])
+        self.batch_size = int(args.get("batch_size", 1))
+        self.streaming = args["streaming"]
+        self.body_cache_bytes = int(args.get("body_cache_bytes", self.body_cache_bytes))
 
         if args["streaming"]:
+            if self.batch_size > 1:
+                logger.error("batch_size %d requires streaming disabled", self.batch_size)
+                raise ValueError("batch_size > 1 is only supported for non-streaming requests")
             self.request_func = self.make_request_stream
+        elif self.batch_size > 1:
+            self.request_func = self.make_request_batch
         else:
             self.request_func = self.make_request
 
@@ -74,6 +87,43 @@ class TGISGRPCPlugin(plugin.Plugin):
         credentials_kwargs.update(root_certificates=cert)
         return grpc.ssl_channel_credentials(**credentials_kwargs)
 
+    def encode_request(self, query: dict) -> bytes:
+        """Serialize the protobuf request message for a query."""
+        if self.streaming:
+            request = generation_pb2_grpc.generation__pb2.SingleGenerationRequest(
+                model_id=self.model_name,
+                request=generation_pb2_grpc.generation__pb2.GenerationRequest(
+                    text=query.get("text")
+                ),
+                params=generation_pb2_grpc.generation__pb2.Parameters(
+                    method=generation_pb2_grpc.generation__pb2.GREEDY,
+                    stopping=generation_pb2_grpc.generation__pb2.StoppingCriteria(
+                        max_new_tokens=query["output_tokens"],
+                        min_new_tokens=query["output_tokens"],
+                    ),
+                    response=generation_pb2_grpc.generation__pb2.ResponseOptions(
+                        generated_tokens=True
+                    ),
+                ),
+            )
+        else:
+            request = generation_pb2_grpc.generation__pb2.BatchedGenerationRequest(
+                model_id=self.model_name,
+                requests=[
+                    generation_pb2_grpc.generation__pb2.GenerationRequest(
+                        text=query.get("text")
+                    )
+                ],
+                params=generation_pb2_grpc.generation__pb2.Parameters(
+                    method=generation_pb2_grpc.generation__pb2.GREEDY,
+                    stopping=generation_pb2_grpc.generation__pb2.StoppingCriteria(
+                        max_new_tokens=query["output_tokens"],
+                        min_new_tokens=query["output_tokens"],
+                    ),
+                ),
+            )
+        return request.SerializeToString()
+
     def make_request(self, query: dict, user_id: int, test_end_time: float = 0):
         """Make a syncronous gRPC request."""
         if self.use_tls:
@@ -81,31 +131,20 @@ class TGISGRPCPlugin(plugin.Plugin):
         else:
             grpc_channel = grpc.insecure_channel(self.connection)
 
-        generation_service_stub = generation_pb2_grpc.GenerationServiceStub(
-            grpc_channel
+        # The request is already serialized, so send the bytes as they are
+        generate = grpc_channel.unary_unary(
+            GENERATE_METHOD,
+            request_serializer=None,
+            response_deserializer=generation_pb2_grpc.generation__pb2.BatchedGenerationResponse.FromString,
         )
 
         result = RequestResult(
             user_id, query.get("input_id"), query.get("input_tokens")
         )
-        request = generation_pb2_grpc.generation__pb2.BatchedGenerationRequest(
-            model_id=self.model_name,
-            requests=[
-                generation_pb2_grpc.generation__pb2.GenerationRequest(
-                    text=query.get("text")
-                )
-            ],
-            params=generation_pb2_grpc.generation__pb2.Parameters(
-                method=generation_pb2_grpc.generation__pb2.GREEDY,
-                stopping=generation_pb2_grpc.generation__pb2.StoppingCriteria(
-                    max_new_tokens=query["output_tokens"],
-                    min_new_tokens=query["output_tokens"],
-                ),
-            ),
-        )
+        request = self.get_request_body(query)
         result.start_time = time.time()
         try:
-            response = generation_service_stub.Generate(request=request)
+            response = generate(request)
         except grpc.RpcError as err:
             result.end_time = time.time()
             result.error_text = err.details()
@@ -125,14 +164,19 @@ class TGISGRPCPlugin(plugin.Plugin):
             result.output_tokens_before_timeout = (
                 result.output_tokens
             ) = response.generated_token_count
+            result.server_usage = 1
         else:
             result.output_tokens = query["output_tokens"]
 
         result.calculate_results()
         return result
 
-    def make_request_stream(self, query: dict, user_id: int, test_end_time: float):
-        """Make a streaming gRPC request."""
+    def make_request_batch(self, queries: list, user_id: int, test_end_time: float = 0):
+        """Make a syncronous gRPC request with a batch of prompts.
+
+        All prompts in a batch share the same generation parameters, so each
+        prompt is asked for the largest output_tokens in the batch.
+        """
         if self.use_tls:
             grpc_channel = grpc.secure_channel(self.connection, self.channel_credentials())
         else:
@@ -141,30 +185,96 @@ class TGISGRPCPlugin(plugin.Plugin):
         generation_service_stub = generation_pb2_grpc.GenerationServiceStub(
             grpc_channel
         )
-        result = RequestResult(
-            user_id, query.get("input_id"), query.get("input_tokens")
-        )
-        tokens = []
-        request = generation_pb2_grpc.generation__pb2.SingleGenerationRequest(
+
+        results = [
+            RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+            for query in queries
+        ]
+        output_tokens = max(query["output_tokens"] for query in queries)
+        request = generation_pb2_grpc.generation__pb2.BatchedGenerationRequest(
             model_id=self.model_name,
-            request=generation_pb2_grpc.generation__pb2.GenerationRequest(
-                text=query.get("text")
-            ),
+            requests=[
+                generation_pb2_grpc.generation__pb2.GenerationRequest(
+                    text=query.get("text")
+                )
+                for query in queries
+            ],
             params=generation_pb2_grpc.generation__pb2.Parameters(
                 method=generation_pb2_grpc.generation__pb2.GREEDY,
                 stopping=generation_pb2_grpc.generation__pb2.StoppingCriteria(
-                    max_new_tokens=query["output_tokens"],
-                    min_new_tokens=query["output_tokens"],
-                ),
-                response=generation_pb2_grpc.generation__pb2.ResponseOptions(
-                    generated_tokens=True
+                    max_new_tokens=output_tokens,
+                    min_new_tokens=output_tokens,
                 ),
             ),
         )
+        start_time = time.time()
+        try:
+            response = generation_service_stub.Generate(request=request)
+        except grpc.RpcError as err:
+            end_time = time.time()
+            for result in results:
+                result.batch_size = len(results)
+                result.start_time = start_time
+                result.end_time = end_time
+                result.error_text = err.details()
+                result.error_code = err.code().value[0]
+            return results
+
+        end_time = time.time()
+
+        # Responses are returned in the same order as the requests
+        for result, resp in zip(results, response.responses):
+            result.batch_size = len(results)
+            result.start_time = start_time
+            result.end_time = end_time
+            result.input_tokens = resp.input_token_count
+            result.stop_reason = resp.stop_reason
+            result.output_text = resp.text
+
+            if resp.generated_token_count:
+                # For non-streaming requests we are keeping output_tokens_before_timeout and output_tokens same.
+                result.output_tokens_before_timeout = (
+                    result.output_tokens
+                ) = resp.generated_token_count
+                result.server_usage = 1
+            else:
+                result.output_tokens = output_tokens
+
+            result.calculate_results()
+
+        if len(response.responses) < len(results):
+            logger.error("Received %d responses for a batch of %d prompts",
+                         len(response.responses), len(results))
+            for result in results[len(response.responses):]:
+                result.batch_size = len(results)
+                result.start_time = start_time
+                result.end_time = end_time
+                result.error_text = "No response returned for prompt in batched response"
+
+        return results
+
+    def make_request_stream(self, query: dict, user_id: int, test_end_time: float):
+        """Make a streaming gRPC request."""
+        if self.use_tls:
+            grpc_channel = grpc.secure_channel(self.connection, self.channel_credentials())
+        else:
+            grpc_channel = grpc.insecure_channel(self.connection)
+
+        # The request is already serialized, so send the bytes as they are
+        generate_stream = grpc_channel.unary_stream(
+            GENERATE_STREAM_METHOD,
+            request_serializer=None,
+            response_deserializer=generation_pb2_grpc.generation__pb2.GenerationResponse.FromString,
+        )
+        result = RequestResult(
+            user_id, query.get("input_id"), query.get("input_tokens")
+        )
+        tokens = []
+        request = self.get_request_body(query)
         result.start_time = time.time()
 
         try:
-            resp_stream = generation_service_stub.GenerateStream(request=request)
+            resp_stream = generate_stream(request)
             for resp in resp_stream:
                 # the first response is not a token, just an acknowledgement
                 if not result.ack_time and not resp.tokens:
@@ -186,6 +296,7 @@ class TGISGRPCPlugin(plugin.Plugin):
                     # Last resp
                     result.stop_reason = resp.stop_reason
                     result.output_tokens = resp.generated_token_count
+                    result.server_usage = int(bool(resp.generated_token_count))
                     # If test duration timeout didn't happen before the last token is received, total tokens before the
                     # timeout will be equal to the total tokens in the response.
                     if not result.output_tokens_before_timeout:
@@ -0,0 +1,305 @@
+"""Throughput-latency report of a concurrency sweep.
+
+Usage: load-test report output/output-*.json [--html report.html] [--png DIR]
+
+Reads the output file of each concurrency level, finds the knee where
+latency starts growing faster than throughput and checks each level
+against Little's law.
+"""
+
+import argparse
+import html
+import json
+import logging
+import math
+import sys
+from pathlib import Path
+
+from llm_load_test import utils
+
+# Tolerated relative gap between the configured concurrency and the one
+# Little's law gives for the measured throughput and latency
+LITTLES_LAW_TOLERANCE = 0.2
+# Latency summary keys the knee can be found on
+LATENCY_KEYS = ("response_time", "ttft", "itl", "tpot")
+
+
+def _stat(summary: dict, metric: str, stat: str):
+    value = summary.get(metric, {}).get(stat)
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+def load_level(filename: str) -> dict:
+    """Return the summary row of one concurrency level."""
+    with open(filename, "r", encoding="utf-8") as f:
+        output_obj = json.load(f)
+    summary = output_obj["summary"]
+    concurrency = output_obj["config"]["load_options"]["concurrency"]
+    duration = summary["full_duration"]
+    requests = summary["total_requests"] - summary["total_failures"]
+
+    level = {
+        "file": filename,
+        "concurrency": concurrency,
+        "requests": summary["total_requests"],
+        "failure_rate": summary["failure_rate"],
+        "throughput": summary["throughput_full_duration"],
+        "requests_per_sec": requests / duration if duration else None,
+    }
+    for metric in LATENCY_KEYS:
+        level[f"{metric}_mean"] = _stat(summary, metric, "mean")
+        level[f"{metric}_p50"] = _stat(summary, metric, "median")
+        level[f"{metric}_p99"] = _stat(summary, metric, "percentile_99")
+
+    # Little's law, L = lambda * W: the requests in flight implied by the
+    # completion rate and mean response time should match the concurrency
+    response_time = level["response_time_mean"]
+    if level["requests_per_sec"] and response_time is not None:
+        level["littles_law_concurrency"] = level["requests_per_sec"] * response_time / 1000
+        level["littles_law_ratio"] = level["littles_law_concurrency"] / concurrency
+        level["littles_law_consistent"] = abs(level["littles_law_ratio"] - 1) <= LITTLES_LAW_TOLERANCE
+    else:
+        level["littles_law_concurrency"] = None
+        level["littles_law_ratio"] = None
+        level["littles_law_consistent"] = None
+    return level
+
+
+def find_knee(levels: list, latency: str = "response_time_p50"):
+    """Return the index of the knee level, None if latency never outgrows throughput.
+
+    Between consecutive levels, the elasticity d ln(latency) / d ln(throughput)
+    is above 1 once latency grows faster than throughput. The knee is the
+    last level before the first such step: beyond it, more concurrency mostly
+    buys queueing delay. A step that loses throughput also passes the knee.
+    """
+    for i in range(1, len(levels)):
+        prev, cur = levels[i - 1], levels[i]
+        if None in (prev[latency], cur[latency]) or not prev["throughput"] or not prev[latency]:
+            continue
+        throughput_growth = cur["throughput"] / prev["throughput"]
+        latency_growth = cur[latency] / prev[latency]
+        if throughput_growth <= 1 or math.log(latency_growth) > math.log(throughput_growth):
+            return i - 1
+    return None
+
+
+def build_report(filenames: list, latency: str = "response_time_p50") -> dict:
+    """Aggregate the output files of a sweep into a report."""
+    levels = sorted((load_level(filename) for filename in filenames), key=lambda level: level["concurrency"])
+    if not levels:
+        raise ValueError("No output files to report on")
+    if latency not in levels[0]:
+        raise ValueError(f"Unknown latency metric {latency}")
+
+    knee = find_knee(levels, latency)
+    # Up to the knee, throughput still scales with concurrency
+    sustainable = levels[:knee + 1] if knee is not None else levels
+    best = max(sustainable, key=lambda level: level["throughput"] or 0)
+    peak = max(levels, key=lambda level: level["throughput"] or 0)
+
+    inconsistent = [level["concurrency"] for level in levels if level["littles_law_consistent"] is False]
+    if inconsistent:
+        logging.warning(
+            "Concurrency levels %s do not satisfy Little's law within %d%%, the client may have "
+            "been the bottleneck (users waiting on inputs, retries or a short test)",
+            inconsistent, LITTLES_LAW_TOLERANCE * 100,
+        )
+
+    return {
+        "latency_metric": latency,
+        "levels": levels,
+        "knee_concurrency": levels[knee]["concurrency"] if knee is not None else None,
+        "max_sustainable_throughput": best["throughput"],
+        "max_sustainable_requests_per_sec": best["requests_per_sec"],
+        "max_sustainable_concurrency": best["concurrency"],
+        "peak_throughput": peak["throughput"],
+        "peak_concurrency": peak["concurrency"],
+        "littles_law_inconsistent": inconsistent,
+    }
+
+
+def _fmt(value, spec=".2f"):
+    return "-" if value is None else format(value, spec)
+
+
+def print_report(report: dict):
+    """Print the sweep table and the knee."""
+    latency = report["latency_metric"]
+    print(f"{'concurrency':>11}{'tokens/s':>12}{'requests/s':>12}{latency:>20}{'ttft_p99':>12}"
+          f"{'failures %':>12}{'little L/N':>12}")
+    for level in report["levels"]:
+        marker = "  <- knee" if level["concurrency"] == report["knee_concurrency"] else ""
+        print(f"{level['concurrency']:>11}{_fmt(level['throughput']):>12}{_fmt(level['requests_per_sec']):>12}"
+              f"{_fmt(level[latency]):>20}{_fmt(level['ttft_p99']):>12}{_fmt(level['failure_rate']):>12}"
+              f"{_fmt(level['littles_law_ratio']):>12}{marker}")
+    if report["knee_concurrency"] is None:
+        print("\nNo knee found, latency never grew faster than throughput")
+    else:
+        print(f"\nKnee at concurrency {report['knee_concurrency']}")
+    print(f"Max sustainable throughput: {_fmt(report['max_sustainable_throughput'])} tokens / sec, "
+          f"{_fmt(report['max_sustainable_requests_per_sec'])} requests / sec "
+          f"at concurrency {report['max_sustainable_concurrency']}")
+
+
+def _svg_chart(title: str, xs: list, series: dict, xlabel: str, ylabel: str, mark=None,
+               width: int = 560, height: int = 340) -> str:
+    """Return an SVG line chart, marking the point at x == mark."""
+    left, right, top, bottom = 70, 20, 30, 50
+    points = [(x, y) for ys in series.values() for x, y in zip(xs, ys) if x is not None and y is not None]
+    if not points:
+        return ""
+    x_max = max(x for x, _ in points) or 1
+    y_max = max(y for _, y in points) or 1
+
+    def sx(x):
+        return left + x / x_max * (width - left - right)
+
+    def sy(y):
+        return height - bottom - y / y_max * (height - top - bottom)
+
+    colors = ["#1f77b4", "#d62728", "#2ca02c", "#9467bd"]
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">',
+        f'<text x="{width / 2}" y="18" text-anchor="middle" font-weight="bold">{html.escape(title)}</text>',
+        f'<line x1="{left}" y1="{height - bottom}" x2="{width - right}" y2="{height - bottom}" stroke="black"/>',
+        f'<line x1="{left}" y1="{top}" x2="{left}" y2="{height - bottom}" stroke="black"/>',
+        f'<text x="{width / 2}" y="{height - 10}" text-anchor="middle">{html.escape(xlabel)}</text>',
+        f'<text x="15" y="{height / 2}" text-anchor="middle" transform="rotate(-90 15 {height / 2})">'
+        f'{html.escape(ylabel)}</text>',
+    ]
+    for i in range(5):
+        x, y = x_max * i / 4, y_max * i / 4
+        parts.append(f'<text x="{sx(x)}" y="{height - bottom + 16}" text-anchor="middle" font-size="11">{x:.4g}</text>')
+        parts.append(f'<text x="{left - 6}" y="{sy(y) + 4}" text-anchor="end" font-size="11">{y:.4g}</text>')
+    for ys, color in zip(series.values(), colors):
+        line = [(sx(x), sy(y)) for x, y in zip(xs, ys) if x is not None and y is not None]
+        path = " ".join(f"{x:.1f},{y:.1f}" for x, y in line)
+        parts.append(f'<polyline points="{path}" fill="none" stroke="{color}" stroke-width="2"/>')
+        parts.extend(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="3" fill="{color}"/>' for x, y in line)
+        if mark is not None:
+            for x, y in zip(xs, ys):
+                if x == mark and y is not None:
+                    parts.append(f'<circle cx="{sx(x):.1f}" cy="{sy(y):.1f}" r="8" fill="none" stroke="black"/>')
+    for i, (name, color) in enumerate(zip(series, colors)):
+        parts.append(f'<text x="{left + 10}" y="{top + 14 + 16 * i}" fill="{color}" font-size="12">'
+                     f'{html.escape(name)}</text>')
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def _chart_data(report: dict):
+    levels = report["levels"]
+    latency = report["latency_metric"]
+    knee = report["knee_concurrency"]
+    knee_throughput = next((level["throughput"] for level in levels if level["concurrency"] == knee), None)
+    return levels, latency, knee, knee_throughput
+
+
+def write_html(report: dict, filename: str):
+    """Write a static HTML report with the sweep table and SVG charts."""
+    levels, latency, knee, knee_throughput = _chart_data(report)
+    concurrency = [level["concurrency"] for level in levels]
+    charts = [
+        _svg_chart("Throughput vs concurrency", concurrency,
+                   {"tokens/s": [level["throughput"] for level in levels]},
+                   "concurrency", "tokens/s", knee),
+        _svg_chart("Latency vs throughput", [level["throughput"] for level in levels],
+                   {latency: [level[latency] for level in levels],
+                    "ttft_p99": [level["ttft_p99"] for level in levels]},
+                   "tokens/s", "ms", knee_throughput),
+    ]
+    columns = ["concurrency", "throughput", "requests_per_sec", latency, "ttft_p50", "ttft_p99", "itl_p50",
+               "failure_rate", "littles_law_concurrency", "littles_law_ratio"]
+    rows = "\n".join(
+        "<tr>" + "".join(f"<td>{_fmt(level[column], '.4g')}</td>" for column in columns) + "</tr>"
+        for level in levels
+    )
+    knee_text = f"Knee at concurrency {knee}" if knee is not None else "No knee found"
+    document = f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>llm-load-test sweep report</title>
+<style>body {{font-family: sans-serif}} td, th {{padding: 2px 8px; text-align: right}}</style></head>
+<body>
+<h1>Sweep report</h1>
+<p>{knee_text}. Max sustainable throughput {_fmt(report['max_sustainable_throughput'])} tokens/s,
+{_fmt(report['max_sustainable_requests_per_sec'])} requests/s at concurrency {report['max_sustainable_concurrency']}.
+Peak throughput {_fmt(report['peak_throughput'])} tokens/s at concurrency {report['peak_concurrency']}.</p>
+<table><tr>{''.join(f'<th>{column}</th>' for column in columns)}</tr>
+{rows}
+</table>
+{''.join(charts)}
+</body></html>
+"""
+    Path(filename).write_text(document, encoding="utf-8")
+
+
+def write_png(report: dict, directory: str):
+    """Write the charts as PNG files, requires matplotlib."""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError as err:
+        raise ImportError(
+            "PNG charts require the matplotlib package, "
+            "install it with: pip install llm-load-test[report]"
+        ) from err
+
+    levels, latency, knee, knee_throughput = _chart_data(report)
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+
+    fig, ax = plt.subplots()
+    ax.plot([level["concurrency"] for level in levels], [level["throughput"] for level in levels], marker="o")
+    if knee is not None:
+        ax.axvline(knee, linestyle="--", color="gray", label=f"knee ({knee})")
+        ax.legend()
+    ax.set(title="Throughput vs concurrency", xlabel="concurrency", ylabel="tokens/s")
+    fig.savefig(path / "throughput.png")
+    plt.close(fig)
+
+    fig, ax = plt.subplots()
+    ax.plot([level["throughput"] for level in levels], [level[latency] for level in levels], marker="o",
+            label=latency)
+    ax.plot([level["throughput"] for level in levels], [level["ttft_p99"] for level in levels], marker="o",
+            label="ttft_p99")
+    if knee_throughput is not None:
+        ax.axvline(knee_throughput, linestyle="--", color="gray", label="knee")
+    ax.legend()
+    ax.set(title="Latency vs throughput", xlabel="tokens/s", ylabel="ms")
+    fig.savefig(path / "latency.png")
+    plt.close(fig)
+
+
+def parse_args(args):
+    """Parse the report CLI parameters."""
+    parser = argparse.ArgumentParser(prog="load-test report", description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="output files of the concurrency levels")
+    parser.add_argument(
+        "--latency",
+        default="response_time_p50",
+        help="latency the knee is found on, e.g. ttft_p99, default response_time_p50",
+    )
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--html", help="write a static HTML report to this file")
+    parser.add_argument("--png", metavar="DIR", help="write PNG charts to this directory")
+    return parser.parse_args(args)
+
+
+def main(argv=None):
+    """Report on a concurrency sweep."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-8s %(message)s")
+
+    report = build_report(args.files, args.latency)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, cls=utils.customEncoder, indent=2)
+    if args.html:
+        write_html(report, args.html)
+        logging.info("Wrote HTML report to %s", args.html)
+    if args.png:
+        write_png(report, args.png)
+        logging.info("Wrote PNG charts to %s", args.png)
+    return 0
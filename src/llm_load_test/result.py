@@ -1,11 +1,44 @@
 """Main result class."""
 
+import math
+from array import array
 from typing import Optional
 
+import numpy as np
+
+import pandas as pd
+
 
 class RequestResult:
     """Request result class."""
 
+    __slots__ = (
+        "user_id",
+        "input_id",
+        "input_tokens",
+        "output_text",
+        "output_tokens",
+        "output_tokens_before_timeout",
+        "start_time",
+        "ack_time",
+        "first_token_time",
+        "end_time",
+        "response_time",
+        "tt_ack",
+        "ttft",
+        "itl",
+        "tpot",
+        "stop_reason",
+        "error_code",
+        "error_text",
+        "batch_size",
+        "retry_after",
+        "retries",
+        "rejections",
+        "server_usage",
+        "client_counted",
+    )
+
     def __init__(self, user_id, input_id, input_tokens=None):
         """Init method."""
         self.user_id: int = user_id
@@ -26,12 +59,20 @@ class RequestResult:
         self.stop_reason: Optional[str] = None
         self.error_code: Optional[int] = None
         self.error_text: Optional[str] = None
+        self.batch_size: int = 1
+        self.retry_after: Optional[float] = None
+        self.retries: int = 0
+        self.rejections: int = 0
+        # 1 if the server reported the exact token counts of this request
+        self.server_usage: int = 0
+        # 1 if the token counts were counted client-side after the run
+        self.client_counted: int = 0
 
     def asdict(self):
         """Return a dictionary."""
         # Maybe later we will want to only include some fields in the results,
         # but for now, this just puts all object fields in a dict.
-        return vars(self)
+        return {field: getattr(self, field) for field in self.__slots__}
 
     # Fill in calculated fields like response_time, tt_ack, ttft, tpot.
     def calculate_results(self):
@@ -61,3 +102,144 @@ class RequestResult:
                 self.tpot = (
                     self.response_time / self.output_tokens
                 )  # Time per output token in ms
+
+
+class ResultBlock:
+    """Columnar buffer of request results.
+
+    Users append each result as it completes and send the whole block to
+    the main process, which pickles a few typed arrays instead of one object
+    per request. Numeric fields are stored in arrays, with NaN for None;
+    strings and input ids are stored in lists.
+    """
+
+    # Fields that are never None
+    INT_FIELDS = ("user_id", "batch_size", "retries", "rejections", "server_usage", "client_counted")
+    # Integer fields that may be None, stored as floats so None can be NaN
+    NULLABLE_INT_FIELDS = ("input_tokens", "output_tokens", "output_tokens_before_timeout", "error_code")
+    FLOAT_FIELDS = (
+        "start_time",
+        "ack_time",
+        "first_token_time",
+        "end_time",
+        "response_time",
+        "tt_ack",
+        "ttft",
+        "itl",
+        "tpot",
+        "retry_after",
+    )
+    OBJECT_FIELDS = ("input_id", "output_text", "stop_reason", "error_text")
+
+    def __init__(self):
+        """Create an empty block."""
+        self.columns = {field: array("q") for field in self.INT_FIELDS}
+        self.columns.update({field: array("d") for field in self.NULLABLE_INT_FIELDS + self.FLOAT_FIELDS})
+        self.columns.update({field: [] for field in self.OBJECT_FIELDS})
+
+    def __len__(self):
+        """Return the number of results."""
+        return len(self.columns["user_id"])
+
+    def append(self, result: RequestResult):
+        """Add a result to the block."""
+        for field in self.INT_FIELDS:
+            self.columns[field].append(getattr(result, field))
+        for field in self.NULLABLE_INT_FIELDS + self.FLOAT_FIELDS:
+            value = getattr(result, field)
+            self.columns[field].append(math.nan if value is None else value)
+        for field in self.OBJECT_FIELDS:
+            self.columns[field].append(getattr(result, field))
+
+    def extend(self, other: "ResultBlock"):
+        """Add all results of another block."""
+        for field, column in self.columns.items():
+            column.extend(other.columns[field])
+
+    @classmethod
+    def from_results(cls, results: list) -> "ResultBlock":
+        """Build a block from RequestResult objects."""
+        block = cls()
+        for result in results:
+            block.append(result)
+        return block
+
+    @classmethod
+    def concat(cls, blocks: list) -> "ResultBlock":
+        """Concatenate blocks into one."""
+        block = cls()
+        for other in blocks:
+            block.extend(other)
+        return block
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Return the results as a DataFrame, with one column per field."""
+        data = {}
+        for field in RequestResult.__slots__:
+            column = self.columns[field]
+            if not isinstance(column, array):
+                data[field] = pd.Series(column)
+            elif column.typecode == "q":
+                data[field] = np.frombuffer(column, dtype=np.int64)
+            else:
+                values = np.frombuffer(column, dtype=np.float64)
+                # Keep integer columns without missing values as integers
+                if field in self.NULLABLE_INT_FIELDS and len(values) and not np.isnan(values).any():
+                    values = values.astype(np.int64)
+                data[field] = values
+        return pd.DataFrame(data, copy=True)
+
+    def rows(self):
+        """Yield each result as a dict, as RequestResult.asdict() would return it."""
+        nullable = set(self.NULLABLE_INT_FIELDS)
+        columns = [(field, self.columns[field]) for field in RequestResult.__slots__]
+        for i in range(len(self)):
+            row = {}
+            for field, column in columns:
+                value = column[i]
+                if isinstance(value, float):
+                    if math.isnan(value):
+                        value = None
+                    elif field in nullable:
+                        value = int(value)
+                row[field] = value
+            yield row
+
+    def cut_at(self, stop_time: float) -> bool:
+        """Count only the tokens received before stop_time for results that ended after it.
+
+        Users stop sending requests at stop_time but finish the ones in
+        flight, whose tokens before the deadline are then estimated as
+        spread evenly between the first token and the end, as in the
+        timeseries. Results that already counted tokens before their own
+        deadline are kept.
+
+        :returns: True if any result was changed
+        """
+        columns = self.columns
+        end_time = np.frombuffer(columns["end_time"], dtype=np.float64)
+        changed = False
+        for i in np.flatnonzero(end_time > stop_time):
+            output_tokens = columns["output_tokens"][i]
+            if (columns["error_text"][i] is not None or not output_tokens >= 1
+                    or columns["output_tokens_before_timeout"][i] != output_tokens):
+                continue
+            first_token_time = columns["first_token_time"][i]
+            if math.isnan(first_token_time) or first_token_time > stop_time:
+                tokens = 0
+            else:
+                tokens = 1 + int((output_tokens - 1) * (stop_time - first_token_time)
+                                 / (end_time[i] - first_token_time))
+            columns["output_tokens_before_timeout"][i] = min(tokens, output_tokens - 1)
+            changed = True
+        return changed
+
+    def to_results(self) -> list:
+        """Rebuild RequestResult objects, e.g. to update them in place."""
+        results = []
+        for row in self.rows():
+            result = RequestResult.__new__(RequestResult)
+            for field, value in row.items():
+                setattr(result, field, value)
+            results.append(result)
+        return results
@@ -0,0 +1,280 @@
+"""Stream request results to JSONL or Parquet files as they arrive."""
+
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Optional
+
+from llm_load_test.result import RequestResult, ResultBlock
+from llm_load_test.sketch import DEFAULT_RELATIVE_ACCURACY, LatencySketches
+
+import numpy as np
+
+"""
+Example config.yaml:
+
+output:
+  format: "jsonl" # json, jsonl or parquet
+  dir: "./output/"
+  file: "output-{concurrency:03d}.json" # Summary, results go to output-001.results.jsonl
+  compression: "zstd" # parquet only
+  flush_interval: 10 # In seconds, how often users send their results
+  console_rows: 20 # Rows of the results table printed to stdout, null for all
+"""
+
+OUTPUT_FORMATS = ["json", "jsonl", "parquet"]
+# Default seconds between result blocks sent by each user when streaming
+DEFAULT_FLUSH_INTERVAL = 10
+# Seconds between logs of the live percentiles
+LIVE_LOG_INTERVAL = 10
+
+
+def parse_flush_interval(output_options: dict) -> Optional[float]:
+    """Validate the output format and return how often users send their results.
+
+    The json format keeps all results in memory anyway, so users send
+    them once at the end unless flush_interval is set.
+    """
+    output_format = output_options.get("format", "json")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}")
+    default = None if output_format == "json" else DEFAULT_FLUSH_INTERVAL
+    return output_options.get("flush_interval") or default
+
+
+class ResultWriter:
+    """Write result blocks to a results file, one block at a time."""
+
+    suffix = ""
+
+    def __init__(self, path: Path):
+        """Open the results file."""
+        self.path = path
+        self.count = 0
+
+    def write(self, block: ResultBlock):
+        """Write the results of a block."""
+        raise NotImplementedError
+
+    def close(self):
+        """Close the results file."""
+
+    def reopen(self):
+        """Truncate the closed results file to write all results again."""
+        raise NotImplementedError
+
+
+class JSONLResultWriter(ResultWriter):
+    """Write one JSON object per result and line."""
+
+    suffix = ".jsonl"
+
+    def __init__(self, path: Path):
+        """Open the results file."""
+        super().__init__(path)
+        self._file = path.open("w", encoding="utf-8")
+
+    def write(self, block: ResultBlock):
+        """Write the results of a block."""
+        self._file.writelines(json.dumps(row) + "\n" for row in block.rows())
+        self._file.flush()
+        self.count += len(block)
+
+    def close(self):
+        """Close the results file."""
+        self._file.close()
+
+    def reopen(self):
+        """Truncate the closed results file to write all results again."""
+        self._file = self.path.open("w", encoding="utf-8")
+        self.count = 0
+
+
+class ParquetResultWriter(ResultWriter):
+    """Write each result block as a row group of a compressed Parquet file.
+
+    Input ids are stored as strings, since datasets may use either
+    integer or string ids.
+    """
+
+    suffix = ".parquet"
+
+    def __init__(self, path: Path, compression: str = "zstd"):
+        """Open the results file."""
+        super().__init__(path)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as err:
+            raise ImportError(
+                "output format parquet requires the pyarrow package, "
+                "install it with: pip install llm-load-test[parquet]"
+            ) from err
+
+        self._pa = pa
+        self._pq = pq
+        self.compression = compression
+        fields = []
+        for field in RequestResult.__slots__:
+            if field in ResultBlock.INT_FIELDS or field in ResultBlock.NULLABLE_INT_FIELDS:
+                fields.append(pa.field(field, pa.int64()))
+            elif field in ResultBlock.FLOAT_FIELDS:
+                fields.append(pa.field(field, pa.float64()))
+            else:
+                fields.append(pa.field(field, pa.string()))
+        self.schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(path, self.schema, compression=compression)
+
+    def _table(self, block: ResultBlock):
+        pa = self._pa
+        arrays = []
+        for field in RequestResult.__slots__:
+            column = block.columns[field]
+            if field in ResultBlock.INT_FIELDS:
+                arrays.append(pa.array(np.frombuffer(column, dtype=np.int64)))
+            elif field in ResultBlock.NULLABLE_INT_FIELDS or field in ResultBlock.FLOAT_FIELDS:
+                values = np.frombuffer(column, dtype=np.float64)
+                mask = np.isnan(values)
+                if field in ResultBlock.NULLABLE_INT_FIELDS:
+                    values = np.where(mask, 0, values).astype(np.int64)
+                arrays.append(pa.array(values, mask=mask))
+            else:
+                arrays.append(pa.array([None if value is None else str(value) for value in column], pa.string()))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write(self, block: ResultBlock):
+        """Write the results of a block as one row group."""
+        if len(block):
+            self._writer.write_table(self._table(block))
+        self.count += len(block)
+
+    def close(self):
+        """Close the results file."""
+        self._writer.close()
+
+    def reopen(self):
+        """Truncate the closed results file to write all results again."""
+        self._writer = self._pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        self.count = 0
+
+
+def create_result_writer(output_options: dict, summary_file: Path) -> Optional[ResultWriter]:
+    """Create the results writer for the output format, None for json.
+
+    The results file is named after the summary file, e.g. output.json
+    writes its results to output.results.jsonl.
+    """
+    output_format = output_options.get("format", "json")
+    if output_format == "json":
+        return None
+
+    if output_format == "jsonl":
+        path = summary_file.with_suffix(".results" + JSONLResultWriter.suffix)
+        return JSONLResultWriter(path)
+    path = summary_file.with_suffix(".results" + ParquetResultWriter.suffix)
+    return ParquetResultWriter(path, output_options.get("compression", "zstd"))
+
+
+class ResultCollector:
+    """Receive result blocks from the user processes.
+
+    Users send (block, sketches) while the test runs and None once they
+    are done. The latency sketches are merged as they arrive, for live
+    percentiles. With a writer, each block is written as it arrives and
+    only the fields needed for the summary are kept in memory. With a token
+    counter, blocks are also held until the end so that counting never runs
+    during the test. The sketches are then rebuilt from the counted results,
+    which replace the raw ones in the results file.
+    Once stop() is called, the results in flight at the stop only count
+    the tokens received before it.
+    """
+
+    def __init__(self, results_pipes: list, writer: Optional[ResultWriter] = None,
+                 token_counter=None, prompts: Optional[dict] = None,
+                 relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY, monitor=None):
+        """Initialize the collector, feeding blocks to the adaptive run length monitor if any."""
+        self.results_pipes = list(results_pipes)
+        self.writer = writer
+        self.token_counter = token_counter
+        self.prompts = prompts if prompts is not None else {}
+        self.monitor = monitor
+        self.results = ResultBlock()
+        self.sketches = LatencySketches(relative_accuracy)
+        self.stop_time = None
+        self._pending = []
+        self._open = set(range(len(self.results_pipes)))
+        self._last_live_log = time.time()
+
+    def _receive(self, index: int):
+        message = self.results_pipes[index].recv()
+        if message is None:
+            self._open.discard(index)
+            return
+        block, sketches = message
+        if self.stop_time is not None and block.cut_at(self.stop_time):
+            # The user's sketches still hold the latencies cut off at the stop
+            sketches = LatencySketches.from_block(block, sketches.relative_accuracy)
+        self.sketches.merge(sketches)
+        if self.monitor is not None:
+            self.monitor.add_block(block)
+        if self.token_counter is not None:
+            # Keep the raw results on disk while the test runs
+            if self.writer is not None:
+                self.writer.write(block)
+            self._pending.append(block)
+        else:
+            self._store(block)
+
+    def stop(self, stop_time: float):
+        """Record when the users were told to stop.
+
+        With an adaptive run length, users only know max_duration as their
+        deadline, so the requests they still have in flight at stop_time
+        would otherwise count as completed within the test duration.
+        """
+        self.stop_time = stop_time
+
+    def _store(self, block: ResultBlock):
+        if self.writer is not None:
+            self.writer.write(block)
+            # The text is in the results file, the summary does not need it
+            block.columns["output_text"] = [None] * len(block)
+        self.results.extend(block)
+
+    def poll(self):
+        """Receive the blocks that are ready, without blocking."""
+        for index in list(self._open):
+            while index in self._open and self.results_pipes[index].poll():
+                self._receive(index)
+
+        if time.time() - self._last_live_log >= LIVE_LOG_INTERVAL:
+            self.sketches.log_live()
+            self._last_live_log = time.time()
+
+    def finish(self) -> ResultBlock:
+        """Receive the remaining blocks and return all results."""
+        logging.debug("Receiving results from user processes")
+        while self._open:
+            for index in list(self._open):
+                self._receive(index)
+
+        if self._pending:
+            start = time.time()
+            pending = ResultBlock.concat(self._pending)
+            self._pending = []
+            results_list = pending.to_results()
+            self.token_counter.count_results(results_list, self.prompts)
+            counted = ResultBlock.from_results(results_list)
+            # Recounted tokens change itl and tpot
+            self.sketches = LatencySketches.from_block(counted, self.sketches.relative_accuracy)
+            if self.writer is not None:
+                self.writer.close()
+                self.writer.reopen()
+            self._store(counted)
+            logging.info("Counted tokens in %.1fs", time.time() - start)
+
+        if self.writer is not None:
+            self.writer.close()
+            logging.info("Wrote %d results to %s", self.writer.count, self.writer.path)
+        return self.results
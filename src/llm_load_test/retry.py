@@ -0,0 +1,140 @@
+"""Retry policy and circuit breaker for rejected requests."""
+
+import email.utils
+import logging
+import random
+import time
+from typing import Optional
+
+"""
+Example config.yaml:
+
+retry:
+  max_retries: 3
+  retry_on: [429, 503] # HTTP status codes, or gRPC status codes such as 8 and 14
+  backoff_base: 0.5 # In seconds, doubled on every retry
+  backoff_max: 30
+  jitter: True
+  honor_retry_after: True
+  circuit_breaker:
+    failure_threshold: 5 # Consecutive failures of one error class
+    cooldown: 10 # In seconds
+"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header into seconds from now.
+
+    The header is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logging.debug("Could not parse Retry-After header: %s", value)
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+def error_class(result) -> Optional[str]:
+    """Return the error class of a result, or None if it succeeded."""
+    if result.error_code is not None:
+        return str(result.error_code)
+    if result.error_text is not None:
+        return "no_code"
+    return None
+
+
+class CircuitBreaker:
+    """Stop sending requests after repeated failures of the same error class.
+
+    The breaker opens for an error class after failure_threshold consecutive
+    failures of that class and stays open for cooldown seconds. After that a
+    single request is let through; another failure reopens the breaker and
+    any success closes it for all classes.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 10.0):
+        """Initialize the breaker."""
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.open_until = {}
+        self.trips = 0
+
+    def record(self, result):
+        """Update the breaker with the outcome of a request."""
+        cls = error_class(result)
+        if cls is None:
+            self.failures.clear()
+            self.open_until.clear()
+            return
+
+        self.failures[cls] = self.failures.get(cls, 0) + 1
+        if self.failures[cls] >= self.failure_threshold:
+            if cls not in self.open_until or self.open_until[cls] <= time.time():
+                self.trips += 1
+                logging.warning("Circuit breaker open for error class %s for %ss", cls, self.cooldown)
+            self.open_until[cls] = time.time() + self.cooldown
+
+    def wait_time(self) -> float:
+        """Return how long to wait before the next request may be sent."""
+        if not self.open_until:
+            return 0.0
+        return max(0.0, max(self.open_until.values()) - time.time())
+
+
+class RetryPolicy:
+    """Retry rejected requests with exponential backoff and jitter."""
+
+    def __init__(self,
+                 max_retries: int = 3,
+                 retry_on: Optional[list] = None,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 30.0,
+                 jitter: bool = True,
+                 honor_retry_after: bool = True,
+                 circuit_breaker: Optional[dict] = None,
+                 ):
+        """Initialize the policy."""
+        self.max_retries = max_retries
+        self.retry_on = set(retry_on if retry_on is not None else [429, 503])
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.honor_retry_after = honor_retry_after
+        self.circuit_breaker = CircuitBreaker(**circuit_breaker) if circuit_breaker else None
+
+    def is_rejection(self, result) -> bool:
+        """Return True if the server rejected the request for admission control."""
+        return result.error_code in self.retry_on
+
+    def should_retry(self, result, attempt: int) -> bool:
+        """Return True if the request should be sent again."""
+        return attempt < self.max_retries and self.is_rejection(result)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Return the delay in seconds before retry number attempt + 1."""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        if self.jitter:
+            # Full jitter spreads the retries of all users apart
+            delay = random.uniform(0, delay)
+        if self.honor_retry_after and retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def record(self, result):
+        """Update the circuit breaker with the outcome of a request."""
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(result)
+
+    def wait_time(self) -> float:
+        """Return how long the circuit breaker holds back the next request."""
+        if self.circuit_breaker is None:
+            return 0.0
+        return self.circuit_breaker.wait_time()
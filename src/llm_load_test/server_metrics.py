@@ -0,0 +1,169 @@
+"""Sample server-side Prometheus metrics during a test run."""
+
+import logging
+import threading
+import time
+from typing import Optional
+
+import requests
+
+import urllib3
+
+urllib3.disable_warnings()
+
+"""
+Example config.yaml:
+
+server_metrics:
+  url: "http://route.to.host/metrics"
+  interval: 1 # In seconds
+  metrics: null # Optional list of metric names, defaults to DEFAULT_METRICS
+"""
+
+# Metrics scraped when no explicit list is configured. Names that the
+# server does not expose are simply absent from the samples.
+DEFAULT_METRICS = [
+    # vLLM
+    "vllm:num_requests_running",
+    "vllm:num_requests_waiting",
+    "vllm:gpu_cache_usage_perc",
+    "vllm:kv_cache_usage_perc",
+    "vllm:num_preemptions_total",
+    # HF TGI
+    "tgi_queue_size",
+    "tgi_batch_current_size",
+    "tgi_batch_current_max_tokens",
+]
+
+
+def parse_prometheus_text(text: str, metrics: Optional[list] = None) -> dict:
+    """Parse the Prometheus text exposition format.
+
+    :param text: body of a /metrics response
+    :param metrics: metric names to keep, all metrics are kept if None
+    :returns: dict mapping each series, e.g. 'name{label="x"}', to its value
+    """
+    wanted = set(metrics) if metrics is not None else None
+    samples = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        # Label values may contain spaces, so split after the label set
+        brace = line.find("{")
+        if brace != -1 and brace < line.find(" "):
+            end = line.rfind("}")
+            name = line[:brace]
+            series = line[:end + 1]
+            rest = line[end + 1:].split()
+        else:
+            series, *rest = line.split()
+            name = series
+
+        if wanted is not None and name not in wanted:
+            continue
+        if not rest:
+            logging.debug("Skipping metrics line without a value: %s", line)
+            continue
+        try:
+            samples[series] = float(rest[0])
+        except ValueError:
+            logging.debug("Skipping metrics line with invalid value: %s", line)
+    return samples
+
+
+class ServerMetricsSampler:
+    """Scrape a Prometheus /metrics endpoint at a fixed interval.
+
+    Samples are taken in a background thread of the main process, so the
+    scraping never competes with the user processes that send requests.
+    Each sample records the same wall clock used for the request results
+    (time.time()) and the elapsed time since the sampler was started.
+    """
+
+    def __init__(self,
+                 url: str,
+                 interval: float = 1.0,
+                 metrics: Optional[list] = None,
+                 timeout: Optional[float] = None,
+                 authorization: Optional[str] = None,
+                 ):
+        """Initialize the sampler."""
+        self.url = url
+        self.interval = float(interval)
+        if self.interval <= 0:
+            raise ValueError(f"server_metrics interval must be positive, got {interval}")
+        self.metrics = DEFAULT_METRICS if metrics is None else metrics
+        # Never let one slow scrape delay the next sample
+        self.timeout = timeout if timeout is not None else self.interval
+        self.headers = {}
+        if authorization:
+            self.headers["Authorization"] = f"Bearer {authorization}"
+
+        self.samples = []
+        self.failures = 0
+        self.start_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def scrape(self) -> dict:
+        """Scrape the endpoint once and return the parsed metrics."""
+        response = requests.get(self.url, headers=self.headers, timeout=self.timeout, verify=False)
+        response.raise_for_status()
+        return parse_prometheus_text(response.text, self.metrics)
+
+    def _sample(self):
+        scrape_time = time.time()
+        try:
+            values = self.scrape()
+        except requests.exceptions.RequestException as err:
+            self.failures += 1
+            logging.warning("Failed to scrape server metrics from %s: %s", self.url, repr(err))
+            return
+        self.samples.append({
+            "time": scrape_time,
+            "elapsed": scrape_time - self.start_time,
+            "metrics": values,
+        })
+
+    def _run(self):
+        next_time = self.start_time
+        while True:
+            self._sample()
+            next_time += self.interval
+            # Keep a fixed cadence, skipping ticks if a scrape overran
+            while next_time < time.time():
+                next_time += self.interval
+            if self._stop_event.wait(next_time - time.time()):
+                break
+
+    def start(self):
+        """Start sampling in a background thread, clearing earlier samples."""
+        self.samples = []
+        self.failures = 0
+        self._stop_event.clear()
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._run, name="server-metrics", daemon=True)
+        self._thread.start()
+        logging.info("Sampling server metrics from %s every %ss", self.url, self.interval)
+
+    def stop(self) -> dict:
+        """Stop sampling and return the collected time series."""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        # One last sample so the tail of the test is always covered
+        if self.start_time is not None:
+            self._sample()
+
+        if self.failures:
+            logging.warning("%d of %d server metrics scrapes failed",
+                            self.failures, self.failures + len(self.samples))
+        return {
+            "url": self.url,
+            "interval": self.interval,
+            "start_time": self.start_time,
+            "samples": self.samples,
+        }
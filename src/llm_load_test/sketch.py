@@ -0,0 +1,215 @@
+"""Mergeable latency histograms for live and bounded-memory percentiles."""
+
+import logging
+import math
+import statistics
+from typing import Optional
+
+from llm_load_test.result import RequestResult, ResultBlock
+
+import numpy as np
+
+"""
+Example config.yaml:
+
+output:
+  percentiles: "sketch" # exact (from all results, default) or sketch (from the histograms)
+  relative_accuracy: 0.01 # Relative error of the sketch percentiles
+"""
+
+# Metrics users keep histograms of, in ms
+SKETCH_METRICS = ("tpot", "ttft", "itl", "tt_ack", "response_time")
+# Like the summary, only count requests that completed within their deadline
+# for these metrics, response_time counts every successful request
+DEADLINE_METRICS = ("tpot", "ttft", "itl", "tt_ack")
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+
+class LogHistogram:
+    """Histogram with logarithmic buckets, as in HDR histograms and DDSketch.
+
+    Every value v > min_value falls in bucket ceil(log(v) / log(gamma)),
+    where gamma = (1 + a) / (1 - a) for the relative accuracy a, so each
+    percentile is within a of the exact value. Smaller values share the
+    first bucket. Histograms with the same accuracy merge by adding their
+    bucket counts, so users keep their own and the main process adds them.
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+                 min_value: float = 1e-3, max_value: float = 1e8):
+        """Create an empty histogram for values in [min_value, max_value]."""
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.offset = self._index(min_value)
+        self.counts = np.zeros(self._index(max_value) - self.offset + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _indices(self, values: np.ndarray) -> np.ndarray:
+        indices = np.ceil(np.log(np.maximum(values, self.min_value)) / self._log_gamma).astype(np.int64)
+        return np.clip(indices - self.offset, 0, len(self.counts) - 1)
+
+    def add(self, value: float):
+        """Add one value."""
+        index = self._index(max(value, self.min_value)) - self.offset
+        self.counts[min(max(index, 0), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def add_array(self, values: np.ndarray):
+        """Add an array of values, ignoring NaN."""
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.counts += np.bincount(self._indices(values), minlength=len(self.counts))
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: "LogHistogram"):
+        """Add the values of another histogram with the same accuracy."""
+        if other.relative_accuracy != self.relative_accuracy or len(other.counts) != len(self.counts):
+            raise ValueError("Only histograms with the same accuracy and range can be merged")
+        self.counts += other.counts
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _value_at_rank(self, rank: int) -> float:
+        index = int(np.searchsorted(np.cumsum(self.counts), rank, side="right"))
+        # Geometric midpoint of the bucket (gamma^(i-1), gamma^i]
+        value = 2 * self.gamma ** (index + self.offset) / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the approximate q quantile, None if the histogram is empty."""
+        if not self.count:
+            return None
+        # Same rank as pandas' linear interpolation, rounded to the nearest value
+        return self._value_at_rank(round(q * (self.count - 1)))
+
+    def quantile_interval(self, q: float, confidence: float = 0.95):
+        """Return a distribution-free confidence interval of the q quantile.
+
+        The rank of the q quantile among count samples is binomial, so the
+        interval lies between the values at ranks count * q -/+ z * sqrt(count * q * (1 - q)).
+
+        :returns: (low, high), or None if there are too few values to bound
+            the quantile on both sides
+        """
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        spread = z * math.sqrt(self.count * q * (1 - q))
+        low = math.floor(self.count * q - spread) - 1
+        high = math.ceil(self.count * q + spread)
+        if low < 0 or high > self.count - 1:
+            return None
+        return self._value_at_rank(low), self._value_at_rank(high)
+
+    def mean(self) -> Optional[float]:
+        """Return the exact mean, None if the histogram is empty."""
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self) -> dict:
+        """Return a compact JSON-serializable form, only the occupied bucket range."""
+        nonzero = np.flatnonzero(self.counts)
+        first, last = (int(nonzero[0]), int(nonzero[-1])) if len(nonzero) else (0, -1)
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "first_bucket": first + self.offset,
+            "counts": self.counts[first:last + 1].tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LogHistogram":
+        """Rebuild a histogram from to_dict()."""
+        histogram = cls(data["relative_accuracy"])
+        start = data["first_bucket"] - histogram.offset
+        histogram.counts[start:start + len(data["counts"])] = data["counts"]
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        if data["count"]:
+            histogram.min = data["min"]
+            histogram.max = data["max"]
+        return histogram
+
+
+class LatencySketches:
+    """One LogHistogram per latency metric in SKETCH_METRICS."""
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        """Create empty histograms."""
+        self.relative_accuracy = relative_accuracy
+        self.histograms = {metric: LogHistogram(relative_accuracy) for metric in SKETCH_METRICS}
+
+    def add(self, result: RequestResult):
+        """Add the latencies of a successful result."""
+        # Failed requests have an error_text, as in the summary
+        if result.error_text is not None:
+            return
+        # Like the pandas comparison of the summary, where missing counts never match
+        within_deadline = (result.output_tokens is not None
+                           and result.output_tokens == result.output_tokens_before_timeout)
+        for metric, histogram in self.histograms.items():
+            value = getattr(result, metric)
+            if value is not None and (within_deadline or metric not in DEADLINE_METRICS):
+                histogram.add(value)
+
+    def add_block(self, block: ResultBlock):
+        """Add the latencies of the successful results of a block."""
+        df = block.to_dataframe()
+        df = df[df["error_text"].isnull()]
+        within_deadline = df[df["output_tokens"] == df["output_tokens_before_timeout"]]
+        for metric, histogram in self.histograms.items():
+            source = within_deadline if metric in DEADLINE_METRICS else df
+            histogram.add_array(source[metric].to_numpy(dtype=np.float64))
+
+    @classmethod
+    def from_block(cls, block: ResultBlock, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        """Build the histograms of a block of results."""
+        sketches = cls(relative_accuracy)
+        sketches.add_block(block)
+        return sketches
+
+    def merge(self, other: "LatencySketches"):
+        """Add the histograms of another set, e.g. from another user."""
+        for metric, histogram in self.histograms.items():
+            histogram.merge(other.histograms[metric])
+
+    def log_live(self):
+        """Log the percentiles of the results received so far."""
+        parts = []
+        for metric, histogram in self.histograms.items():
+            if histogram.count:
+                parts.append(f"{metric} p50 {histogram.quantile(0.5):.1f} p99 {histogram.quantile(0.99):.1f}")
+        if parts:
+            logging.info("Live percentiles (ms): %s", ", ".join(parts))
+
+    def to_dict(self) -> dict:
+        """Return the histograms in a JSON-serializable form."""
+        return {metric: histogram.to_dict() for metric, histogram in self.histograms.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencySketches":
+        """Rebuild the histograms from to_dict()."""
+        histograms = {metric: LogHistogram.from_dict(value) for metric, value in data.items()}
+        sketches = cls(next(iter(histograms.values())).relative_accuracy if histograms else DEFAULT_RELATIVE_ACCURACY)
+        sketches.histograms.update(histograms)
+        return sketches
@@ -0,0 +1,102 @@
+"""Per-request service level objectives, attainment and goodput."""
+
+import logging
+import math
+from typing import Optional
+
+import pandas as pd
+
+"""
+Example config.yaml:
+
+slo:
+  ttft: 500 # In ms, time to first token
+  itl: 50 # In ms, mean inter-token latency of each request
+  tpot: null # In ms, time per output token
+  response_time: 20000 # In ms, end-to-end
+  input_bins: [0, 256, 1024, 4096] # Input token bucket edges for the breakdown
+"""
+
+# SLO keys and the result field each one limits
+SLO_METRICS = ("ttft", "itl", "tpot", "response_time")
+DEFAULT_INPUT_BINS = [0, 128, 512, 2048, 8192]
+
+
+class SLO:
+    """Latency limits every request must meet to count towards goodput.
+
+    A request meets the SLO if it succeeded and each configured metric is
+    within its limit. Metrics a request does not have, such as the ITL of
+    a single-token response, do not count against it.
+    """
+
+    def __init__(self,
+                 ttft: Optional[float] = None,
+                 itl: Optional[float] = None,
+                 tpot: Optional[float] = None,
+                 response_time: Optional[float] = None,
+                 input_bins: Optional[list] = None,
+                 ):
+        """Initialize the SLO, limits are in ms."""
+        self.limits = {
+            metric: limit
+            for metric, limit in zip(SLO_METRICS, (ttft, itl, tpot, response_time))
+            if limit is not None
+        }
+        if not self.limits:
+            raise ValueError(f"slo requires a limit for at least one of {list(SLO_METRICS)}")
+        for metric, limit in self.limits.items():
+            if limit <= 0:
+                raise ValueError(f"slo.{metric} must be positive")
+
+        self.input_bins = sorted(input_bins if input_bins is not None else DEFAULT_INPUT_BINS)
+
+    def attained(self, df: pd.DataFrame) -> pd.Series:
+        """Return whether each result meets the SLO."""
+        ok = df["error_text"].isnull()
+        succeeded = df[ok]
+        for metric, limit in self.limits.items():
+            if succeeded[metric].isnull().all() and len(succeeded):
+                logging.warning("No results have %s, its SLO is not checked", metric)
+            ok &= ~(df[metric] > limit)
+        return ok
+
+    def summary(self, df: pd.DataFrame) -> dict:
+        """Return the SLO attainment and goodput of all results.
+
+        Goodput counts only the requests that met the SLO, over the time
+        from the first request sent to the last response received.
+        """
+        attained = self.attained(df)
+        duration = df["end_time"].max() - df["start_time"].min()
+        good = df[attained]
+        succeeded = df[df["error_text"].isnull()]
+        total = len(df)
+
+        summary = {
+            "limits": self.limits,
+            "requests": total,
+            "requests_attained": int(attained.sum()),
+            "attainment_rate": attained.mean() * 100 if total else None,
+            "goodput_requests_per_sec": len(good) / duration if duration > 0 else None,
+            "goodput_tokens_per_sec": good["output_tokens"].sum() / duration if duration > 0 else None,
+            # Share of the successful requests that missed each limit
+            "violation_rate": {
+                metric: (succeeded[metric] > limit).mean() * 100 if len(succeeded) else None
+                for metric, limit in self.limits.items()
+            },
+        }
+
+        # Attainment by input length, longer prompts usually miss TTFT first
+        buckets = pd.cut(df["input_tokens"], self.input_bins + [math.inf], right=False)
+        by_input = []
+        groups = attained.groupby(buckets, observed=False)
+        for low, high, (_, bucket_attained) in zip(self.input_bins, self.input_bins[1:] + [None], groups):
+            by_input.append({
+                "input_tokens_min": low,
+                "input_tokens_max": high,
+                "requests": len(bucket_attained),
+                "attainment_rate": bucket_attained.mean() * 100 if len(bucket_attained) else None,
+            })
+        summary["attainment_by_input_tokens"] = by_input
+        return summary
@@ -0,0 +1,314 @@
+"""Synthetic prompts sampled from a tokenized text corpus."""
+
+import glob
+import hashlib
+import logging
+import os
+from abc import ABC
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+"""
+Example config.yaml:
+
+dataset:
+  type: synthetic
+  synthetic:
+    tokenizer: "ibm-granite/granite-3.1-8b-instruct" # HF model name or path
+    corpus: ["contrib/synthetic_datagen/corpus/*.txt"] # Files or glob patterns
+    input: {distribution: normal, mean: 1000, stdev: 30}
+    output: {distribution: uniform, minimum: 200, maximum: 320}
+    system_prompt: "" # Optional
+"""
+
+
+class Distribution(ABC):
+    """Token lengths drawn from a distribution.
+
+    The first samples are drawn when the distribution is created, draw()
+    returns further samples from the same generator.
+    """
+
+    _samples: list
+
+    def __init__(self, samples: int, generator: np.random.Generator, *args) -> None:
+        """Draw the first samples."""
+        self.n = samples
+        self.argv = args
+        self.generator = generator
+        self._samples = self.draw(samples).tolist()
+
+    def draw(self, n: int) -> np.ndarray:
+        """Return n new samples, implemented by subclasses."""
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the first samples."""
+        return iter(self._samples)
+
+    def __getitem__(self, key) -> int:
+        """Return one of the first samples."""
+        return self._samples[key]
+
+    def __len__(self) -> int:
+        """Return the number of first samples."""
+        return len(self._samples)
+
+    @property
+    def description(self) -> dict:
+        """Describe the distribution for the dataset metadata."""
+        return dict(
+            distribution=type(self).__name__,
+            args=self.argv,
+            n=self.n,
+        )
+
+
+class NormalDist(Distribution):
+    """Normal distribution, redrawing samples outside [range_min, range_max]."""
+
+    def __init__(
+            self,
+            samples: int,
+            generator: np.random.Generator,
+            mean: int,
+            stdev: int,
+            range_min: Optional[int] = None,
+            range_max: Optional[int] = None
+    ) -> None:
+        """Initialize the distribution, the range defaults to 3 stdev around the mean."""
+        if range_min is None:
+            range_min = mean - 3*stdev
+        range_min = max(1, range_min)
+
+        if range_max is None:
+            range_max = mean + 3*stdev
+
+        if range_min > range_max:
+            raise ValueError("Minimum value must be less than maximum value")
+
+        self.mean = mean
+        self.stdev = stdev
+        self.range_min = range_min
+        self.range_max = range_max
+        super().__init__(samples, generator, mean, stdev)
+
+    def draw(self, n: int) -> np.ndarray:
+        """Return n new samples."""
+        parts = []
+        accepted = 0
+        discarded = 0
+        while accepted < n:
+            # Draw a batch with headroom for the expected rejections
+            size = max(64, int((n - accepted) * 1.1) + 16)
+            batch = self.generator.normal(loc=self.mean, scale=self.stdev, size=size).astype(np.int64)
+            keep = (batch >= self.range_min) & (batch <= self.range_max)
+            batch = batch[keep][:n - accepted]
+            discarded += int(size - keep.sum())
+            parts.append(batch)
+            accepted += len(batch)
+
+        if discarded > 0:
+            logging.warning("Replaced %d of %d samples which were outside range [%d, %d]",
+                            discarded, n, self.range_min, self.range_max)
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+class UniformDist(Distribution):
+    """Uniform distribution in [minimum, maximum)."""
+
+    def __init__(self, samples: int, generator: np.random.Generator, minimum: int, maximum: int) -> None:
+        """Initialize the distribution."""
+        self.minimum = minimum
+        self.maximum = maximum
+        super().__init__(samples, generator, minimum, maximum)
+
+    def draw(self, n: int) -> np.ndarray:
+        """Return n new samples."""
+        return self.generator.uniform(low=self.minimum, high=self.maximum, size=n).astype(dtype=int)
+
+
+class EqualDist(Distribution):
+    """Every sample has the same length."""
+
+    def __init__(self, samples: int, generator: np.random.Generator, length: int) -> None:
+        """Initialize the distribution."""
+        self.length = length
+        super().__init__(samples, generator, length)
+
+    def draw(self, n: int) -> np.ndarray:
+        """Return n new samples."""
+        return self.generator.normal(loc=self.length, scale=0, size=n).astype(dtype=int)
+
+
+DISTRIBUTIONS = {
+    "normal": NormalDist,
+    "uniform": UniformDist,
+    "equal": EqualDist,
+}
+
+
+def create_distribution(spec: dict, generator: np.random.Generator, samples: int = 0) -> Distribution:
+    """Create a distribution from a config spec such as {distribution: normal, mean: 100, stdev: 10}."""
+    spec = dict(spec)
+    name = spec.pop("distribution", None)
+    if name not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown distribution {name}, expected one of {list(DISTRIBUTIONS)}")
+    return DISTRIBUTIONS[name](samples, generator, **spec)
+
+
+def load_tokenizer(model: str):
+    """Load a Hugging Face tokenizer from a model path or the hub."""
+    try:
+        from tokenizers import Tokenizer
+    except ImportError as err:
+        raise ImportError(
+            "synthetic datasets require the tokenizers package, "
+            "install it with: pip install llm-load-test[tokenizer]"
+        ) from err
+
+    if os.path.isfile(f"{model}/tokenizer.json"):
+        return Tokenizer.from_file(f"{model}/tokenizer.json")
+    return Tokenizer.from_pretrained(model)
+
+
+def read_corpus(patterns: list) -> str:
+    """Concatenate the corpus files matching the given paths or glob patterns."""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if not matches:
+            raise ValueError(f"No corpus files match {pattern}")
+        files.extend(matches)
+
+    parts = []
+    for filename in files:
+        with open(filename, "r", encoding="utf-8") as f:
+            parts.append(f.read())
+    return "".join(parts)
+
+
+def calculate_offsets(model: str, corpus: str) -> np.ndarray:
+    """Return the character offset where each token of the corpus starts."""
+    tokenizer = load_tokenizer(model)
+    encoding = tokenizer.encode(corpus)
+    return np.array([start for start, _ in encoding.offsets], dtype=np.int64)
+
+
+# Corpus offsets of this process, keyed by tokenizer and corpus hash, so
+# the corpus is tokenized once for all levels of a concurrency sweep.
+_offsets_cache = {}
+
+
+def offsets_key(model: str, corpus: str) -> str:
+    """Return the cache key of the offsets of a corpus for a tokenizer."""
+    digest = hashlib.blake2b(corpus.encode("utf-8"), digest_size=16)
+    # Local tokenizers are identified by their path
+    digest.update(os.path.realpath(model).encode("utf-8") if os.path.isdir(model) else model.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cached_offsets(model: str, corpus: str, cache_dir: Optional[str] = None) -> np.ndarray:
+    """Return calculate_offsets(model, corpus), computed once per process.
+
+    With cache_dir, the offsets are also saved to a .npy file keyed by the
+    tokenizer and corpus hash and memory-mapped on later runs, so the
+    corpus is only tokenized again when it or the tokenizer changes.
+    """
+    key = offsets_key(model, corpus)
+    if key in _offsets_cache:
+        return _offsets_cache[key]
+
+    path = None
+    if cache_dir is not None:
+        path = Path(cache_dir).expanduser() / f"offsets-{key}.npy"
+        if path.exists():
+            try:
+                _offsets_cache[key] = np.load(path, mmap_mode="r")
+                logging.info("Loaded %d corpus token offsets from %s", len(_offsets_cache[key]), path)
+                return _offsets_cache[key]
+            except (OSError, ValueError):
+                logging.exception("Failed to load corpus offsets %s, recalculating them", path)
+
+    logging.info("Tokenizing synthetic dataset corpus with %s", model)
+    offsets = calculate_offsets(model, corpus)
+    logging.info("Found %d tokens in corpus", len(offsets))
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial file
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_path.open("wb") as f:
+            np.save(f, offsets)
+        os.replace(tmp_path, path)
+    _offsets_cache[key] = offsets
+    return offsets
+
+
+def sample_text(corpus: str, offsets: np.ndarray, start: int, length: int) -> str:
+    """Return the corpus text of length tokens starting at token start."""
+    return corpus[offsets[start]:offsets[start + length]]
+
+
+def sample_spans(generator: np.random.Generator, offsets: np.ndarray, lengths: np.ndarray):
+    """Pick a random corpus span for each token length.
+
+    :returns: arrays of the character start and end of each span
+    """
+    if lengths.size and lengths.max() >= len(offsets):
+        raise ValueError(f"Input length {lengths.max()} is longer than the corpus ({len(offsets)} tokens)")
+    starts = generator.integers(0, len(offsets) - lengths)
+    return offsets[starts], offsets[starts + lengths]
+
+
+class SyntheticPrompts:
+    """Generate an endless stream of queries with synthetic prompts.
+
+    Each prompt is a random span of the corpus with a token length drawn
+    from the input distribution, so prompts never repeat in practice and
+    do not hit the server's prefix cache the way a looped dataset does.
+    """
+
+    def __init__(self,
+                 tokenizer: str,
+                 corpus: list,
+                 input: dict,
+                 output: dict,
+                 seed: int = 42,
+                 system_prompt: str = "",
+                 prompt_format: Optional[str] = None,
+                 cache_dir: Optional[str] = None,
+                 ):
+        """Tokenize the corpus and initialize the distributions."""
+        self.corpus = read_corpus(corpus)
+        self.offsets = cached_offsets(tokenizer, self.corpus, cache_dir)
+        # Independent streams keep the queries the same however they are batched
+        input_rng, output_rng, self.generator = [
+            np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(3)
+        ]
+        self.input_dist = create_distribution(input, input_rng)
+        self.output_dist = create_distribution(output, output_rng)
+        self.system_prompt = system_prompt
+        self.prompt_format = prompt_format or "{prompt}"
+        self.index = 0
+
+    def generate(self, n: int) -> list:
+        """Return the next n queries."""
+        input_lengths = self.input_dist.draw(n)
+        output_lengths = self.output_dist.draw(n)
+        char_starts, char_ends = sample_spans(self.generator, self.offsets, input_lengths)
+
+        queries = []
+        for start, end, input_len, output_len in zip(char_starts.tolist(),
+                                                     char_ends.tolist(),
+                                                     input_lengths.tolist(),
+                                                     output_lengths.tolist()):
+            queries.append({
+                "text": self.prompt_format.format(prompt=self.corpus[start:end], system_prompt=self.system_prompt),
+                "input_id": self.index,
+                "input_tokens": input_len,
+                "output_tokens": output_len,
+            })
+            self.index += 1
+        return queries
@@ -0,0 +1,138 @@
+"""Per-window throughput and latency series of a test run."""
+
+from llm_load_test.errors import classify_errors
+
+import numpy as np
+
+import pandas as pd
+
+"""
+Example config.yaml:
+
+output:
+  timeseries_interval: 1 # Window length in seconds, null to disable
+  timeseries_rolling: 5 # Windows the latency percentiles are computed over
+"""
+
+DEFAULT_INTERVAL = 1
+DEFAULT_ROLLING = 5
+# Latency metrics with rolling percentiles, and the time that places a
+# request in a window: when its first token arrived, or when it ended
+ROLLING_METRICS = {"ttft": "first_token_time", "itl": "end_time"}
+ROLLING_QUANTILES = (0.5, 0.99)
+
+
+def token_times(df: pd.DataFrame) -> np.ndarray:
+    """Return the estimated arrival time of every output token.
+
+    Results only record the first token and end times, so the remaining
+    tokens of a streamed response are spread evenly between them. All
+    tokens of a non-streamed response arrive at its end time.
+    """
+    counts = df["output_tokens"].fillna(0).to_numpy(dtype=np.int64)
+    end = df["end_time"].to_numpy(dtype=np.float64)
+    first = df["first_token_time"].to_numpy(dtype=np.float64)
+    streamed = ~np.isnan(first)
+    valid = (counts > 0) & ~np.isnan(end)
+    counts, end, first, streamed = counts[valid], end[valid], first[valid], streamed[valid]
+
+    start = np.where(streamed, first, end)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        step = np.where(streamed & (counts > 1), (end - first) / (counts - 1), 0.0)
+
+    # Index of each token within its response, without a Python loop
+    total = int(counts.sum())
+    token_index = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(start, counts) + token_index * np.repeat(step, counts)
+
+
+def _bins(times: np.ndarray, start: float, interval: float, windows: int) -> np.ndarray:
+    times = times[~np.isnan(times)]
+    index = np.floor((times - start) / interval).astype(np.int64)
+    return index[(index >= 0) & (index < windows)]
+
+
+def rolling_percentiles(times: np.ndarray, values: np.ndarray, start: float, interval: float,
+                        windows: int, rolling: int, quantiles=ROLLING_QUANTILES) -> dict:
+    """Return percentiles of values over the last rolling windows at each window.
+
+    :returns: dict of quantile to a list with one value per window, None
+        for windows without values
+    """
+    keep = ~np.isnan(times) & ~np.isnan(values)
+    index = np.floor((times[keep] - start) / interval).astype(np.int64)
+    values = values[keep]
+    order = np.argsort(index, kind="stable")
+    index, values = index[order], values[order]
+
+    # Each window's values are a contiguous slice of the sorted arrays
+    upper = np.searchsorted(index, np.arange(windows), side="right")
+    lower = np.searchsorted(index, np.arange(windows) - rolling + 1, side="left")
+    series = {q: [None] * windows for q in quantiles}
+    for window in range(windows):
+        if upper[window] > lower[window]:
+            result = np.quantile(values[lower[window]:upper[window]], quantiles)
+            for q, value in zip(quantiles, result.tolist()):
+                series[q][window] = value
+    return series
+
+
+def compute_timeseries(df: pd.DataFrame, interval: float = DEFAULT_INTERVAL,
+                       rolling: int = DEFAULT_ROLLING) -> dict:
+    """Return per-window series of the results.
+
+    Window i covers [start_time + i * interval, start_time + (i + 1) * interval),
+    from the first request sent to the last response received.
+
+    :param df: DataFrame of all results, including failed requests
+    """
+    if interval <= 0:
+        raise ValueError("timeseries_interval must be positive")
+    if rolling < 1:
+        raise ValueError("timeseries_rolling must be at least 1")
+
+    start = df["start_time"].min()
+    end = df["end_time"].max()
+    if df.empty or np.isnan(start) or np.isnan(end):
+        return {}
+    windows = int(np.floor((end - start) / interval)) + 1
+
+    classes = classify_errors(df)
+    failed = classes.notnull()
+    ok = df[~failed]
+
+    completed = np.bincount(_bins(ok["end_time"].to_numpy(dtype=np.float64), start, interval, windows),
+                            minlength=windows)
+    errors = np.bincount(_bins(df.loc[failed, "end_time"].to_numpy(dtype=np.float64), start, interval, windows),
+                         minlength=windows)
+    tokens = np.bincount(_bins(token_times(ok), start, interval, windows), minlength=windows)
+
+    # Requests sent but not yet answered at the start of each window
+    window_starts = start + interval * np.arange(windows)
+    starts = np.sort(df["start_time"].dropna().to_numpy(dtype=np.float64))
+    ends = np.sort(df["end_time"].dropna().to_numpy(dtype=np.float64))
+    in_flight = (np.searchsorted(starts, window_starts, side="right")
+                 - np.searchsorted(ends, window_starts, side="right"))
+
+    series = {
+        "interval": interval,
+        "start_time": start,
+        "time": (interval * np.arange(windows)).tolist(),
+        "completed_requests": completed.tolist(),
+        "failed_requests": errors.tolist(),
+        "failed_requests_by_class": {
+            error_class: np.bincount(_bins(group["end_time"].to_numpy(dtype=np.float64), start, interval, windows),
+                                     minlength=windows).tolist()
+            for error_class, group in df[failed].groupby(classes[failed])
+        },
+        "output_tokens_per_sec": (tokens / interval).tolist(),
+        "in_flight": in_flight.tolist(),
+        "rolling_windows": rolling,
+    }
+    for metric, time_column in ROLLING_METRICS.items():
+        percentiles = rolling_percentiles(ok[time_column].to_numpy(dtype=np.float64),
+                                          ok[metric].to_numpy(dtype=np.float64),
+                                          start, interval, windows, rolling)
+        for q, values in percentiles.items():
+            series[f"{metric}_p{round(q * 100)}"] = values
+    return series
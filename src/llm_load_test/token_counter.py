@@ -0,0 +1,185 @@
+"""Client-side token counting for request results."""
+
+import hashlib
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+import grpc
+
+from llm_load_test import generation_pb2_grpc
+
+"""
+Example config.yaml:
+
+token_counting:
+  type: hf # or tgis, which calls the Tokenize RPC of the tgis_grpc_plugin server
+  tokenizer: "ibm-granite/granite-3.1-8b-instruct" # HF model name or path, hf only
+  cache_size: 65536
+  batch_size: 256
+  overwrite: false # Also recount results the server reported token counts for
+"""
+
+COUNTER_TYPES = ["hf", "tgis"]
+
+
+class TokenCounter(ABC):
+    """Count tokens in batches, memoizing counts by the hash of the text.
+
+    Counting happens after all results are gathered, so it never adds to
+    the latency measured by the users.
+    """
+
+    def __init__(self, cache_size: int = 65536, batch_size: int = 256, overwrite: bool = False):
+        """Initialize the counter."""
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.overwrite = overwrite
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _key(text: str, add_special_tokens: bool) -> bytes:
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16)
+        digest.update(b"\x01" if add_special_tokens else b"\x00")
+        return digest.digest()
+
+    @abstractmethod
+    def _count_batch(self, texts: list, add_special_tokens: bool) -> list:
+        """Return the token count of each text, implemented by subclasses."""
+
+    def count(self, texts: list, add_special_tokens: bool = False) -> list:
+        """Count the tokens of each text, only tokenizing uncached texts."""
+        keys = [self._key(text, add_special_tokens) for text in texts]
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            else:
+                missing[key] = text
+
+        counts = dict.fromkeys(missing)
+        missing_keys = list(missing)
+        for i in range(0, len(missing_keys), self.batch_size):
+            batch_keys = missing_keys[i:i + self.batch_size]
+            batch_counts = self._count_batch([missing[key] for key in batch_keys], add_special_tokens)
+            counts.update(zip(batch_keys, batch_counts))
+
+        result = [counts[key] if key in counts else self._cache[key] for key in keys]
+
+        for key, value in counts.items():
+            self._cache[key] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return result
+
+    def count_results(self, results_list: list, prompts: dict):
+        """Fill in client-side token counts for successful results.
+
+        Results the server reported their token counts for keep them,
+        unless overwrite is set. Counted results get client_counted set.
+
+        :param results_list: RequestResult objects to update in place
+        :param prompts: mapping of input_id to the prompt text that was sent
+        """
+        results = [
+            result for result in results_list
+            if result.error_code is None and result.error_text is None
+            and (self.overwrite or not result.server_usage)
+        ]
+        if not results:
+            return
+
+        logging.info("Counting tokens for %d results", len(results))
+
+        with_prompt = [result for result in results if result.input_id in prompts]
+        if len(with_prompt) < len(results):
+            logging.warning("Prompt text not found for %d results, keeping their input token counts",
+                            len(results) - len(with_prompt))
+        input_counts = self.count([prompts[result.input_id] for result in with_prompt],
+                                  add_special_tokens=True)
+        for result, input_tokens in zip(with_prompt, input_counts):
+            result.input_tokens = input_tokens
+
+        output_counts = self.count([result.output_text or "" for result in results])
+        for result, output_tokens in zip(results, output_counts):
+            # Scale the tokens received before the test deadline by the
+            # same ratio, the counts were only wrong in chunk granularity.
+            if result.output_tokens_before_timeout is not None:
+                if result.output_tokens and result.output_tokens_before_timeout != result.output_tokens:
+                    result.output_tokens_before_timeout = round(
+                        result.output_tokens_before_timeout * output_tokens / result.output_tokens
+                    )
+                else:
+                    result.output_tokens_before_timeout = output_tokens
+            result.output_tokens = output_tokens
+            result.client_counted = 1
+            result.calculate_results()
+
+
+class HFTokenCounter(TokenCounter):
+    """Count tokens with a local Hugging Face tokenizer."""
+
+    def __init__(self, tokenizer: str, **kwargs):
+        """Load the tokenizer from a model path or the Hugging Face hub."""
+        super().__init__(**kwargs)
+        try:
+            from tokenizers import Tokenizer
+        except ImportError as err:
+            raise ImportError(
+                "token_counting type hf requires the tokenizers package, "
+                "install it with: pip install llm-load-test[tokenizer]"
+            ) from err
+
+        if os.path.isfile(f"{tokenizer}/tokenizer.json"):
+            self.tokenizer = Tokenizer.from_file(f"{tokenizer}/tokenizer.json")
+        else:
+            self.tokenizer = Tokenizer.from_pretrained(tokenizer)
+
+    def _count_batch(self, texts: list, add_special_tokens: bool) -> list:
+        encodings = self.tokenizer.encode_batch(texts, add_special_tokens=add_special_tokens)
+        return [len(encoding.ids) for encoding in encodings]
+
+
+class TGISTokenCounter(TokenCounter):
+    """Count tokens with the Tokenize RPC of a TGIS server."""
+
+    def __init__(self, plugin, **kwargs):
+        """Reuse the connection settings of the tgis_grpc_plugin."""
+        super().__init__(**kwargs)
+        self.pb2 = generation_pb2_grpc.generation__pb2
+        self.model_name = plugin.model_name
+        if plugin.use_tls:
+            channel = grpc.secure_channel(plugin.connection, plugin.channel_credentials())
+        else:
+            channel = grpc.insecure_channel(plugin.connection)
+        self.stub = generation_pb2_grpc.GenerationServiceStub(channel)
+
+    def _count_batch(self, texts: list, add_special_tokens: bool) -> list:
+        # The server always tokenizes the way it does for generation
+        request = self.pb2.BatchedTokenizeRequest(
+            model_id=self.model_name,
+            requests=[self.pb2.TokenizeRequest(text=text) for text in texts],
+        )
+        response = self.stub.Tokenize(request=request)
+        return [resp.token_count for resp in response.responses]
+
+
+def create_token_counter(options: dict, plugin) -> Optional[TokenCounter]:
+    """Create the token counter described by the token_counting config."""
+    options = dict(options)
+    counter_type = options.pop("type", "hf")
+    if counter_type not in COUNTER_TYPES:
+        raise ValueError(f"Unknown token_counting type {counter_type}")
+
+    if counter_type == "hf":
+        if not options.get("tokenizer"):
+            raise ValueError("token_counting type hf requires a tokenizer")
+        return HFTokenCounter(**options)
+
+    if not hasattr(plugin, "channel_credentials"):
+        raise ValueError("token_counting type tgis requires the tgis_grpc_plugin")
+    return TGISTokenCounter(plugin, **options)
@@ -4,6 +4,9 @@ import logging
 import queue
 import time
 
+from llm_load_test.result import ResultBlock
+from llm_load_test.sketch import DEFAULT_RELATIVE_ACCURACY, LatencySketches
+
 
 class User:
     """Define a user."""
@@ -18,22 +21,41 @@ class User:
         logger_q,
         log_level,
         run_duration,
+        retry_policy=None,
+        flush_interval=None,
+        relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
     ):
         """Initialize object."""
         self.user_id = user_id
         self.plugin = plugin
         self.dataset_q = dataset_q
         self.stop_q = stop_q
-        self.results_list = []
+        # Columnar buffer, so results are sent as a few arrays, not one object each
+        self.results = ResultBlock()
         self.results_pipe = results_pipe
         self.logger_q = logger_q
         self.log_level = log_level
         # Must get reset in user process to use the logger created in _init_user_process_logging
         self.logger = logging.getLogger("user")
         self.run_duration = run_duration
+        self.retry_policy = retry_policy
+        # Send the results gathered so far every flush_interval seconds,
+        # so they can be written while the test runs
+        self.flush_interval = flush_interval
+        # Latency histograms of the results since the last flush, merged
+        # by the main process for live and final percentiles
+        self.relative_accuracy = relative_accuracy
+        self.sketches = LatencySketches(relative_accuracy)
 
     def make_request(self, test_end_time=0):
         """Make a request."""
+        # Hold back while the circuit breaker is open, polling for the stop signal
+        if self.retry_policy is not None:
+            wait = self.retry_policy.wait_time()
+            if wait > 0:
+                time.sleep(min(wait, 1))
+                return None
+
         try:
             query = self.dataset_q.get(timeout=2)
         except queue.Empty:
@@ -44,8 +66,50 @@ class User:
             self.logger.warn("dataset q does not exist!")
             return None
 
+        if self.plugin.batch_size > 1:
+            queries = [query]
+            while len(queries) < self.plugin.batch_size:
+                try:
+                    queries.append(self.dataset_q.get(timeout=2))
+                except (queue.Empty, ValueError):
+                    # Send a partial batch rather than waiting for more inputs
+                    break
+            self.logger.info("User %s making batched request of %d prompts", self.user_id, len(queries))
+            return self.send_request(queries, test_end_time)
+
         self.logger.info("User %s making request", self.user_id)
-        result = self.plugin.request_func(query, self.user_id, test_end_time)
+        result = self.send_request(query, test_end_time)
+        return result
+
+    def send_request(self, query, test_end_time=0):
+        """Send a request, retrying rejections according to the retry policy."""
+        if self.retry_policy is None:
+            return self.plugin.request_func(query, self.user_id, test_end_time)
+
+        attempt = 0
+        rejections = 0
+        while True:
+            result = self.plugin.request_func(query, self.user_id, test_end_time)
+            # A batch is accepted or rejected as a whole
+            first = result[0] if isinstance(result, list) else result
+            self.retry_policy.record(first)
+            if self.retry_policy.is_rejection(first):
+                rejections += 1
+
+            if not self.retry_policy.should_retry(first, attempt) or not self.stop_q.empty():
+                break
+            delay = self.retry_policy.backoff(attempt, first.retry_after)
+            if time.time() + delay >= test_end_time:
+                # The retry would only be sent after the test ended
+                break
+
+            self.logger.info("User %s retrying rejected request in %.3fs", self.user_id, delay)
+            time.sleep(delay)
+            attempt += 1
+
+        for res in (result if isinstance(result, list) else [result]):
+            res.retries = attempt
+            res.rejections = rejections
         return result
 
     def _init_user_process_logging(self):
@@ -59,19 +123,39 @@ class User:
         self.logger = logging.getLogger("user")
         return logging.getLogger("user")
 
+    def flush_results(self):
+        """Send the results gathered since the last flush to the main process."""
+        if len(self.results):
+            self.results_pipe.send((self.results, self.sketches))
+            self.results = ResultBlock()
+            self.sketches = LatencySketches(self.relative_accuracy)
+
     def run_user_process(self):
         """Run a process."""
         self._init_user_process_logging()
 
         test_end_time = time.time() + self.run_duration
+        next_flush = time.time() + self.flush_interval if self.flush_interval else None
         while self.stop_q.empty():
             result = self.make_request(test_end_time)
             # make_request will return None after 2 seconds if dataset_q is empty
             # to ensure that users don't get stuck waiting for requests indefinitely
-            if result is not None:
-                self.results_list.append(result)
+            if isinstance(result, list):
+                # Batched requests return one result per prompt
+                for res in result:
+                    self.results.append(res)
+                    self.sketches.add(res)
+            elif result is not None:
+                self.results.append(result)
+                self.sketches.add(result)
+
+            if next_flush is not None and time.time() >= next_flush:
+                self.flush_results()
+                next_flush = time.time() + self.flush_interval
 
-        self.results_pipe.send(self.results_list)
+        self.flush_results()
+        # No more results from this user
+        self.results_pipe.send(None)
 
         time.sleep(4)
         self.logger.info("User %s done", self.user_id)
@@ -6,12 +6,21 @@ import logging
 import os
 from pathlib import Path
 
+from llm_load_test.adaptive import ConvergenceMonitor
+from llm_load_test.decomposition import decompose
+from llm_load_test.errors import error_breakdown
 from llm_load_test.plugins import (
     dummy_plugin,
     hf_tgi_plugin,
     openai_plugin,
     tgis_grpc_plugin,
 )
+from llm_load_test.retry import RetryPolicy
+from llm_load_test.server_metrics import ServerMetricsSampler
+from llm_load_test.sketch import DEFAULT_RELATIVE_ACCURACY, LogHistogram, SKETCH_METRICS
+from llm_load_test.slo import SLO
+from llm_load_test.timeseries import DEFAULT_INTERVAL, DEFAULT_ROLLING, compute_timeseries
+from llm_load_test.token_counter import create_token_counter
 
 import numpy as np
 
@@ -21,6 +30,9 @@ import yaml
 
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 
+# Median and percentiles reported for each metric
+SUMMARY_QUANTILES = [0.5, 0.8, 0.9, 0.95, 0.99]
+
 
 class customEncoder(json.JSONEncoder):
     """Return an encoder."""
@@ -95,6 +107,72 @@ def parse_config(config):
     return concurrency, duration, plugin
 
 
+def parse_server_metrics(config):
+    """Create the server metrics sampler if one is configured."""
+    options = config.get("server_metrics")
+    if not options:
+        return None
+
+    logging.info("server_metrics config: %s", options)
+    if not options.get("url"):
+        raise ValueError("server_metrics requires a url")
+
+    return ServerMetricsSampler(**options)
+
+
+def parse_retry_policy(config):
+    """Create the retry policy if one is configured."""
+    options = config.get("retry")
+    if not options:
+        return None
+
+    logging.info("retry config: %s", options)
+    return RetryPolicy(**options)
+
+
+def parse_token_counter(config, plugin):
+    """Create the client-side token counter if one is configured."""
+    options = config.get("token_counting")
+    if not options:
+        return None
+
+    logging.info("token_counting config: %s", options)
+    return create_token_counter(options, plugin)
+
+
+def parse_slo(config):
+    """Create the per-request SLO if one is configured."""
+    options = config.get("slo")
+    if not options:
+        return None
+
+    logging.info("slo config: %s", options)
+    return SLO(**options)
+
+
+def parse_adaptive(config):
+    """Create the adaptive run length monitor if one is configured."""
+    options = config.get("load_options").get("adaptive")
+    if not options:
+        return None
+
+    logging.info("adaptive config: %s", options)
+    return ConvergenceMonitor(**options)
+
+
+def parse_percentiles(config):
+    """Return how summary percentiles are computed and the sketch accuracy."""
+    output_options = config.get("output")
+    method = output_options.get("percentiles", "exact")
+    if method not in ("exact", "sketch"):
+        raise ValueError(f"Unknown percentiles method {method}, expected exact or sketch")
+
+    relative_accuracy = output_options.get("relative_accuracy", DEFAULT_RELATIVE_ACCURACY)
+    if not 0 < relative_accuracy < 1:
+        raise ValueError("output.relative_accuracy must be between 0 and 1")
+    return method, relative_accuracy
+
+
 def yaml_load(file):
     """Load a yaml file."""
     if not Path(file).is_file():
@@ -106,12 +184,11 @@ def yaml_load(file):
             raise RuntimeError(f"Could not parse {file}") from exc
 
 
-def write_output(config, results_list, concurrency, duration):
-    """Write the results."""
+def output_file(config, concurrency, duration):
+    """Return the path of the output file, creating its directory."""
     output_options = config.get("output")
     output_path = output_options.get("dir")
 
-    logging.info("Writing output to %s", output_path)
     path = Path(output_path)
     if not (path.exists() and path.is_dir()):
         logging.warning("Output path %s does not exist, creating it!", path)
@@ -120,29 +197,57 @@ def write_output(config, results_list, concurrency, duration):
     outfile_name = output_options.get("file").format(
         concurrency=concurrency, duration=duration
     )
-    outfile = path / Path(outfile_name)
-    results_list = [result.asdict() for result in results_list]
+    return path / Path(outfile_name)
+
+
+def write_output(config, results, concurrency, duration, server_metrics=None, results_file=None,
+                 sketches=None, slo=None, adaptive=None):
+    """Write the results.
+
+    :param results: ResultBlock with the results of all users
+    :param results_file: file the results were streamed to, if any. The
+        output file then holds the summary and a reference to it.
+    :param sketches: LatencySketches merged from all users, written to the
+        output file and used for the latency percentiles with
+        output.percentiles sketch
+    :param slo: SLO to report attainment and goodput for
+    :param adaptive: how an adaptive level ended, its duration replaces the
+        configured duration for the throughput
+    """
+    output_options = config.get("output")
+    outfile = output_file(config, concurrency, duration)
+    logging.info("Writing output to %s", outfile)
+
     output_obj = {
-        "results": results_list,
         "config": config,
         "summary": {},
     }
+    if results_file is None:
+        output_obj = {"results": list(results.rows()), **output_obj}
+    else:
+        output_obj["results_file"] = str(results_file)
+    if server_metrics is not None:
+        output_obj["server_metrics"] = server_metrics
+    if sketches is not None:
+        output_obj["sketches"] = sketches.to_dict()
 
-    logging.info("Length of results: %d", len(results_list))
+    logging.info("Length of results: %d", len(results))
 
     # TODO, should this be output using logging?
-    df = pd.DataFrame(results_list)
-    df.head()
+    df = results.to_dataframe()
 
-    with pd.option_context("display.max_rows", None, "display.max_columns", None):
-        print(df)
-    print(f"\n---\nFull results in {outfile}. Results summary:")
+    # Large runs have too many results to print them all
+    console_rows = output_options.get("console_rows", 20)
+    with pd.option_context("display.max_rows", console_rows, "display.max_columns", None):
+        print(df.drop(columns="output_text") if results_file is not None else df)
+    print(f"\n---\nFull results in {results_file or outfile}. Results summary:")
 
     error_count = len(df[~df["error_text"].isnull()])
     req_count = len(df)
     print(f"Error count: {error_count} of {req_count} total requests")
 
     # Ignore errors for summary results
+    df_all = df
     df = df[df["error_text"].isnull()]
 
     if "ttft" in df:
@@ -182,21 +287,18 @@ def write_output(config, results_list, concurrency, duration):
     if req_completed_within_test_duration == 0:
         logging.error("No requests completed within the their deadline, cannot calculate summary statistics")
 
-    # Time per output token summary
-    output_obj = get_summary(df_test_duration, output_obj, "tpot")
-
-    if "ttft" in df:
-        # Time to first token summary
-        output_obj = get_summary(df_test_duration, output_obj, "ttft")
-
-        # Inter-token latency summary
-        output_obj = get_summary(df_test_duration, output_obj, "itl")
-
-        # Time to ack summary
-        output_obj = get_summary(df_test_duration, output_obj, "tt_ack")
-
-    # response time summary
-    output_obj = get_summary(df, output_obj, "response_time")
+    # Latency summaries, from the merged user histograms if configured
+    use_sketches = sketches is not None and output_options.get("percentiles", "exact") == "sketch"
+    for summary_key in SKETCH_METRICS:
+        if summary_key not in ("tpot", "response_time") and "ttft" not in df:
+            # Non-streaming, no TTFT, ITL or time to ack
+            continue
+        if use_sketches:
+            output_obj = get_sketch_summary(sketches.histograms[summary_key], output_obj, summary_key)
+        elif summary_key == "response_time":
+            output_obj = get_summary(df, output_obj, summary_key)
+        else:
+            output_obj = get_summary(df_test_duration, output_obj, summary_key)
 
     # output tokens summary
     output_obj = get_summary(df, output_obj, "output_tokens")
@@ -216,11 +318,30 @@ def write_output(config, results_list, concurrency, duration):
         f"Total true throughput across all users: {throughput_full_duration} tokens / sec, for duration {full_duration}"
     )
 
+    if adaptive is not None:
+        output_obj["summary"]["adaptive"] = adaptive
+        duration = adaptive["duration"]
     throughput = df["output_tokens_before_timeout"].sum() / duration
     print(
         f"Total throughput across all users bounded by the test duration: {throughput} tokens / sec, for duration {duration}"
     )
 
+    # Prompt and token throughput for each batch size, batched requests
+    # return one result per prompt.
+    batch_throughput = {}
+    for batch_size, batch_df in df.groupby("batch_size"):
+        batch_duration = batch_df["end_time"].max() - batch_df["start_time"].min()
+        prompts_per_sec = len(batch_df) / batch_duration
+        tokens_per_sec = batch_df["output_tokens"].sum() / batch_duration
+        print(
+            f"Batch size {batch_size}: {prompts_per_sec} prompts / sec, {tokens_per_sec} tokens / sec"
+        )
+        batch_throughput[int(batch_size)] = {
+            "prompts_per_sec": prompts_per_sec,
+            "tokens_per_sec": tokens_per_sec,
+        }
+
+    output_obj["summary"]["batch_throughput"] = batch_throughput
     output_obj["summary"]["throughput_full_duration"] = throughput_full_duration
     output_obj["summary"]["full_duration"] = full_duration
     output_obj["summary"]["throughput"] = throughput
@@ -231,9 +352,47 @@ def write_output(config, results_list, concurrency, duration):
     output_obj["summary"]["total_failures"] = error_count
     output_obj["summary"]["failure_rate"] = error_count / req_count * 100
 
-    json_out = json.dumps(output_obj, cls=customEncoder, indent=2)
+    # Retries and admission-control rejections, counted per attempt
+    total_retries = int(df_all["retries"].sum())
+    total_rejections = int(df_all["rejections"].sum())
+    output_obj["summary"]["total_retries"] = total_retries
+    output_obj["summary"]["requests_retried"] = int((df_all["retries"] > 0).sum())
+    output_obj["summary"]["total_rejections"] = total_rejections
+    output_obj["summary"]["rejection_rate"] = total_rejections / (req_count + total_retries) * 100
+    if total_retries or total_rejections:
+        print(f"Retries: {total_retries}, rejected attempts: {total_rejections}")
+
+    # Failures by error class and code, with how long each took to fail
+    errors = error_breakdown(df_all)
+    output_obj["summary"]["errors"] = errors
+    for row in errors:
+        print(
+            f"Errors {row['error_class']} (code {row['error_code']}): {row['count']}, "
+            f"median latency to failure {row['latency_to_failure']['median']} ms"
+        )
+
+    # Prefill and decode estimates, to tell which one a regression came from
+    output_obj["summary"]["decomposition"] = decompose(df_test_duration, df_all)
+
+    # Throughput of the requests that met the SLO only
+    if slo is not None:
+        slo_summary = slo.summary(df_all)
+        output_obj["summary"]["slo"] = slo_summary
+        print(
+            f"SLO attainment: {slo_summary['attainment_rate']}% of {req_count} requests, "
+            f"goodput: {slo_summary['goodput_requests_per_sec']} requests / sec, "
+            f"{slo_summary['goodput_tokens_per_sec']} tokens / sec"
+        )
+
+    # Throughput and latency over time, to spot warmup, stalls and collapse
+    timeseries_interval = output_options.get("timeseries_interval", DEFAULT_INTERVAL)
+    if timeseries_interval:
+        output_obj["timeseries"] = compute_timeseries(
+            df_all, timeseries_interval, output_options.get("timeseries_rolling", DEFAULT_ROLLING)
+        )
+
     with outfile.open("w") as f:
-        f.write(json_out)
+        json.dump(output_obj, f, cls=customEncoder, indent=2)
 
 
 def get_summary(df: pd.DataFrame, output_obj: dict, summary_key: str):
@@ -241,14 +400,58 @@ def get_summary(df: pd.DataFrame, output_obj: dict, summary_key: str):
     output_obj["summary"][summary_key] = {}
     output_obj["summary"][summary_key]["min"] = df[summary_key].min()
     output_obj["summary"][summary_key]["max"] = df[summary_key].max()
-    output_obj["summary"][summary_key]["median"] = df[summary_key].median()
+    # One pass over the sorted values for all percentiles
+    quantiles = df[summary_key].quantile(SUMMARY_QUANTILES)
+    output_obj["summary"][summary_key]["median"] = quantiles[0.5]
     output_obj["summary"][summary_key]["mean"] = df[summary_key].mean()
-    output_obj["summary"][summary_key]["percentile_80"] = df[summary_key].quantile(0.80)
-    output_obj["summary"][summary_key]["percentile_90"] = df[summary_key].quantile(0.90)
-    output_obj["summary"][summary_key]["percentile_95"] = df[summary_key].quantile(0.95)
-    output_obj["summary"][summary_key]["percentile_99"] = df[summary_key].quantile(0.99)
+    for q in SUMMARY_QUANTILES[1:]:
+        output_obj["summary"][summary_key][f"percentile_{round(q * 100)}"] = quantiles[q]
     # Replace NaNs with None
     output_obj["summary"][summary_key].update(
         {k: None for k, v in output_obj["summary"][summary_key].items() if np.isnan(v)}
     )
     return output_obj
+
+
+def get_sketch_summary(histogram: LogHistogram, output_obj: dict, summary_key: str):
+    """Get the summary from a histogram, with the same keys as get_summary."""
+    output_obj["summary"][summary_key] = {}
+    output_obj["summary"][summary_key]["min"] = histogram.min if histogram.count else None
+    output_obj["summary"][summary_key]["max"] = histogram.max if histogram.count else None
+    output_obj["summary"][summary_key]["median"] = histogram.quantile(0.5)
+    output_obj["summary"][summary_key]["mean"] = histogram.mean()
+    for q in SUMMARY_QUANTILES[1:]:
+        output_obj["summary"][summary_key][f"percentile_{round(q * 100)}"] = histogram.quantile(q)
+    output_obj["summary"][summary_key]["relative_accuracy"] = histogram.relative_accuracy
+    return output_obj
+
+
+def load_results(outfile):
+    """Load an output file and its results.
+
+    :param outfile: output file written by write_output
+    :returns: the output object and a DataFrame of its results, read from
+        the results file if they were streamed to one
+    """
+    outfile = Path(outfile)
+    with outfile.open("r", encoding="utf-8") as f:
+        output_obj = json.load(f)
+
+    if "results" in output_obj:
+        return output_obj, pd.DataFrame(output_obj["results"])
+
+    results_file = Path(output_obj["results_file"])
+    if not results_file.exists():
+        # The output directory was moved or the path was relative to another directory
+        results_file = outfile.parent / results_file.name
+    if results_file.suffix == ".parquet":
+        try:
+            df = pd.read_parquet(results_file)
+        except ImportError as err:
+            raise ImportError(
+                "reading parquet results requires the pyarrow package, "
+                "install it with: pip install llm-load-test[parquet]"
+            ) from err
+    else:
+        df = pd.read_json(results_file, lines=True, dtype=False)
+    return output_obj, df
@@ -0,0 +1,104 @@
+"""Tests of the result collector."""
+
+import json
+import multiprocessing
+
+from llm_load_test.result import RequestResult, ResultBlock
+from llm_load_test.result_writer import JSONLResultWriter, ResultCollector
+from llm_load_test.sketch import LatencySketches
+from llm_load_test.token_counter import TokenCounter
+
+import pytest
+
+STOP_TIME = 1000.0
+
+
+def make_result(start_time, first_token_time, end_time, output_tokens=11):
+    """Return a successful streamed result, complete before the user's own deadline."""
+    result = RequestResult(0, 1, 100)
+    result.start_time = start_time
+    result.first_token_time = first_token_time
+    result.end_time = end_time
+    result.output_tokens = result.output_tokens_before_timeout = output_tokens
+    result.calculate_results()
+    return result
+
+
+def send_block(pipe, results):
+    """Send results the way a user does, as a block with its sketches."""
+    block = ResultBlock.from_results(results)
+    pipe.send((block, LatencySketches.from_block(block)))
+
+
+def collect(before_stop, after_stop):
+    """Collect results sent before and after the stop, return them as a DataFrame with the sketches."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    collector = ResultCollector([receiver])
+    send_block(sender, before_stop)
+    collector.poll()
+    collector.stop(STOP_TIME)
+    send_block(sender, after_stop)
+    sender.send(None)
+    return collector.finish().to_dataframe(), collector.sketches
+
+
+def test_in_flight_requests_excluded_at_stop():
+    """Requests still in flight at the stop only count the tokens received before it."""
+    done = make_result(990.0, 991.0, 995.0)
+    in_flight = make_result(996.0, 997.0, 1007.0)
+    df, sketches = collect([done], [in_flight])
+
+    # Tokens are spread evenly from the first token, 1 + 10 * 3/10 before the stop
+    assert df["output_tokens_before_timeout"].tolist() == [11, 4]
+    within_deadline = df[df["output_tokens"] == df["output_tokens_before_timeout"]]
+    assert within_deadline["end_time"].tolist() == [995.0]
+    # Only the response time of the in flight request is kept
+    assert sketches.histograms["ttft"].count == 1
+    assert sketches.histograms["itl"].count == 1
+    assert sketches.histograms["response_time"].count == 2
+
+
+def test_no_token_before_stop():
+    """A request whose first token came after the stop has no tokens before it."""
+    in_flight = make_result(999.0, 1001.0, 1005.0)
+    df, sketches = collect([], [in_flight])
+
+    assert df["output_tokens_before_timeout"].tolist() == [0]
+    assert sketches.histograms["ttft"].count == 0
+
+
+def test_requests_done_before_stop_kept():
+    """Results sent after the stop that completed before it are unchanged."""
+    done = make_result(990.0, 991.0, 999.0)
+    df, sketches = collect([], [done])
+
+    assert df["output_tokens_before_timeout"].tolist() == [11]
+    assert sketches.histograms["itl"].count == 1
+    assert sketches.histograms["itl"].quantile(0.5) == pytest.approx(800, rel=0.02)
+
+
+class CharCounter(TokenCounter):
+    """Count one token per character."""
+
+    def _count_batch(self, texts, add_special_tokens):
+        return [len(text) for text in texts]
+
+
+def test_token_counting_streams_raw_results(tmp_path):
+    """Raw results are written as they arrive and rewritten with the counted tokens."""
+    path = tmp_path / "output.results.jsonl"
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    collector = ResultCollector([receiver], JSONLResultWriter(path), CharCounter(), {1: "prompt"})
+    result = make_result(990.0, 991.0, 995.0)
+    result.output_text = "abcde"
+    send_block(sender, [result])
+    collector.poll()
+
+    raw = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [row["output_tokens"] for row in raw] == [11]
+
+    sender.send(None)
+    collector.finish()
+    counted = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(row["input_tokens"], row["output_tokens"], row["client_counted"]) for row in counted] == [(6, 5, 1)]
+    assert counted[0]["output_text"] == "abcde"
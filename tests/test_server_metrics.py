@@ -0,0 +1,176 @@
+"""Tests of the server metrics sampler against a local stub endpoint."""
+
+import http.server
+import threading
+import time
+
+from llm_load_test.server_metrics import ServerMetricsSampler, parse_prometheus_text
+
+import pytest
+
+METRICS_PAYLOAD = """\
+# HELP vllm:num_requests_running Number of requests currently running on GPU.
+# TYPE vllm:num_requests_running gauge
+vllm:num_requests_running{model_name="granite"} 7.0
+# HELP vllm:num_requests_waiting Number of requests waiting to be processed.
+# TYPE vllm:num_requests_waiting gauge
+vllm:num_requests_waiting{model_name="granite"} 3.0
+# TYPE vllm:gpu_cache_usage_perc gauge
+vllm:gpu_cache_usage_perc{model_name="granite"} 0.42
+# TYPE vllm:num_preemptions_total counter
+vllm:num_preemptions_total{model_name="granite"} 12.0
+# TYPE tgi_queue_size gauge
+tgi_queue_size 5
+# TYPE tgi_batch_current_size gauge
+tgi_batch_current_size 16
+# TYPE process_cpu_seconds_total counter
+process_cpu_seconds_total 123.4
+"""
+
+INTERVAL = 0.1
+
+
+class StubMetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve METRICS_PAYLOAD on /metrics, or a 500 error while the server is failing."""
+
+    def do_GET(self):  # noqa: N802
+        """Answer a scrape."""
+        if self.server.failing or self.path != "/metrics":
+            self.send_error(500)
+            return
+        body = self.server.payload.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002
+        """Keep the test output quiet."""
+
+
+@pytest.fixture
+def stub_server():
+    """Start a stub /metrics endpoint on a free local port."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubMetricsHandler)
+    server.payload = METRICS_PAYLOAD
+    server.failing = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def metrics_url(server):
+    """Return the /metrics URL of the stub server."""
+    host, port = server.server_address
+    return f"http://{host}:{port}/metrics"
+
+
+def run_sampler(sampler, intervals):
+    """Run the sampler for a number of intervals and return its series with the wall clock bounds."""
+    before = time.time()
+    sampler.start()
+    time.sleep(intervals * INTERVAL + INTERVAL / 2)
+    series = sampler.stop()
+    return series, before, time.time()
+
+
+def test_parse_prometheus_text_filters_metrics():
+    """Only the requested metrics are kept, with their labels."""
+    samples = parse_prometheus_text(METRICS_PAYLOAD, ["vllm:num_requests_running", "tgi_queue_size"])
+    assert samples == {
+        'vllm:num_requests_running{model_name="granite"}': 7.0,
+        "tgi_queue_size": 5.0,
+    }
+
+
+def test_parse_prometheus_text_label_values_with_spaces():
+    """Label values may contain spaces and lines may carry a timestamp."""
+    samples = parse_prometheus_text('vllm:num_requests_running{model_name="a b"} 2 1700000000000\nbad_line\n')
+    assert samples == {'vllm:num_requests_running{model_name="a b"}': 2.0}
+
+
+def test_sampler_parses_gauges(stub_server):
+    """Every sample holds the default vLLM and TGI metrics of the payload."""
+    sampler = ServerMetricsSampler(metrics_url(stub_server), interval=INTERVAL)
+    series, _, _ = run_sampler(sampler, 4)
+
+    assert series["url"] == metrics_url(stub_server)
+    assert series["interval"] == INTERVAL
+    # One sample per interval plus the final one taken on stop
+    assert len(series["samples"]) >= 4
+    assert sampler.failures == 0
+    for sample in series["samples"]:
+        assert sample["metrics"] == {
+            'vllm:num_requests_running{model_name="granite"}': 7.0,
+            'vllm:num_requests_waiting{model_name="granite"}': 3.0,
+            'vllm:gpu_cache_usage_perc{model_name="granite"}': 0.42,
+            'vllm:num_preemptions_total{model_name="granite"}': 12.0,
+            "tgi_queue_size": 5.0,
+            "tgi_batch_current_size": 16.0,
+        }
+
+
+def test_sampler_timestamps_follow_test_clock(stub_server):
+    """Samples use the wall clock of the results and keep the interval cadence."""
+    sampler = ServerMetricsSampler(metrics_url(stub_server), interval=INTERVAL)
+    series, before, after = run_sampler(sampler, 4)
+
+    samples = series["samples"]
+    assert before <= series["start_time"] <= samples[0]["time"]
+    assert samples[-1]["time"] <= after
+    times = [sample["time"] for sample in samples]
+    assert times == sorted(times)
+    for sample in samples:
+        # Same wall clock as the request results, elapsed from the sampler start
+        assert sample["elapsed"] == pytest.approx(sample["time"] - series["start_time"])
+    # Samples before the final one are taken on the interval cadence
+    for sample in samples[:-1]:
+        ticks = round(sample["elapsed"] / INTERVAL)
+        assert sample["elapsed"] == pytest.approx(ticks * INTERVAL, abs=INTERVAL / 2)
+
+
+def test_sampler_counts_failed_scrapes(stub_server):
+    """Failed scrapes are counted and skipped without stopping the sampler."""
+    stub_server.failing = True
+    sampler = ServerMetricsSampler(metrics_url(stub_server), interval=INTERVAL)
+    series, _, _ = run_sampler(sampler, 3)
+
+    assert series["samples"] == []
+    assert sampler.failures >= 3
+
+
+def test_sampler_recovers_after_failed_scrapes(stub_server):
+    """Sampling resumes once the endpoint answers again."""
+    stub_server.failing = True
+    sampler = ServerMetricsSampler(metrics_url(stub_server), interval=INTERVAL)
+    sampler.start()
+    time.sleep(INTERVAL * 2.5)
+    stub_server.failing = False
+    time.sleep(INTERVAL * 2.5)
+    series = sampler.stop()
+
+    assert sampler.failures >= 2
+    assert len(series["samples"]) >= 2
+    assert all(sample["metrics"]["tgi_queue_size"] == 5.0 for sample in series["samples"])
+
+
+def test_sampler_unreachable_endpoint():
+    """Connection errors are counted like failed scrapes."""
+    # Bind and close a socket to get a port nothing listens on
+    server = http.server.HTTPServer(("127.0.0.1", 0), StubMetricsHandler)
+    host, port = server.server_address
+    server.server_close()
+    sampler = ServerMetricsSampler(f"http://{host}:{port}/metrics", interval=INTERVAL)
+    series, _, _ = run_sampler(sampler, 2)
+
+    assert series["samples"] == []
+    assert sampler.failures >= 2
+
+
+def test_sampler_rejects_non_positive_interval():
+    """The interval must be positive."""
+    with pytest.raises(ValueError):
+        ServerMetricsSampler("http://127.0.0.1/metrics", interval=0)